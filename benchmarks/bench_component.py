@@ -0,0 +1,130 @@
+'''
+End-to-end benchmark of the component against a local mock Graph API.
+
+Runs the real `Component.run` on synthetic lists served by `mock_graph.MockGraphServer` and reports the throughput,
+the number of requests, the peak memory and the time spent writing the results. Requires the component
+dependencies (incl. the kbc library) to be installed, e.g. run it in the component docker image.
+
+Usage:
+    python benchmarks/bench_component.py --rows 100000 --columns 30 --lists 4 \\
+        --params '{"max_parallel_lists": 4}' --latency-ms 20 --throttle-every 50
+'''
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+import result  # noqa: E402
+from mock_graph import MockGraphOptions, MockGraphServer  # noqa: E402
+from ms_graph.async_client import AsyncClient  # noqa: E402
+from ms_graph.client import Client  # noqa: E402
+
+
+class WriteTimer:
+    """
+    Measures the time spent in the `write_rows` of the list data writers, summed across all threads.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def install(self, writer_class):
+        write_rows = writer_class.write_rows
+        timer = self
+
+        def timed_write_rows(writer, rows, user_values=None):
+            start = time.perf_counter()
+            # streamed rows are downloaded while being written, the time then includes the download
+            write_rows(writer, rows, user_values)
+            with timer._lock:
+                timer.seconds += time.perf_counter() - start
+
+        writer_class.write_rows = timed_write_rows
+
+
+def write_config(data_dir, parameters):
+    os.makedirs(os.path.join(data_dir, 'in'))
+    config = {'parameters': parameters,
+              'authorization': {'oauth_api': {'credentials': {'#data': json.dumps({'refresh_token': 'refresh'}),
+                                                              'appKey': 'app', '#appSecret': 'secret'}}}}
+    with open(os.path.join(data_dir, 'config.json'), 'w') as cfg_file:
+        json.dump(config, cfg_file)
+
+
+def build_parameters(lists, extra_parameters):
+    parameters = {'base_host_name': 'bench.sharepoint.com',
+                  'lists': [{'site_url_rel_path': '/sites/bench', 'list_name': f'List {i}',
+                             'include_additional_cols': False, 'use_display_names': True,
+                             'load_setup': {'load_mode_incremental': False, 'result_table_name': f'list_{i}'}}
+                            for i in range(1, lists + 1)]}
+    parameters.update(extra_parameters)
+    return parameters
+
+
+def run_component(server, data_dir):
+    for client_class in (Client, AsyncClient):
+        client_class.OAUTH_LOGIN_URL = server.login_url
+        client_class.BASE_URL = server.base_url
+    os.environ['KBC_DATADIR'] = data_dir
+    # imported after the data dir is set
+    from component import Component
+    Component().run()
+
+
+def output_size(data_dir):
+    size = 0
+    for root, _, files in os.walk(os.path.join(data_dir, 'out')):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='items per list')
+    parser.add_argument('--columns', type=int, default=20, help='columns per list')
+    parser.add_argument('--lists', type=int, default=1, help='number of lists')
+    parser.add_argument('--page-size', type=int, default=200, help='items per page')
+    parser.add_argument('--value-length', type=int, default=20, help='length of the text values')
+    parser.add_argument('--latency-ms', type=int, default=0, help='delay of each response')
+    parser.add_argument('--throttle-every', type=int, default=0, help='throttle every n-th request with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the throttled responses')
+    parser.add_argument('--params', default='{}', help='JSON of additional component parameters')
+    args = parser.parse_args()
+
+    options = MockGraphOptions(rows=args.rows, columns=args.columns, page_size=args.page_size, lists=args.lists,
+                               value_length=args.value_length, latency_ms=args.latency_ms,
+                               throttle_every=args.throttle_every, retry_after=args.retry_after)
+    timer = WriteTimer()
+    timer.install(result.ListDataResultWriter)
+    timer.install(result.ListDataParquetWriter)
+
+    with tempfile.TemporaryDirectory() as data_dir, MockGraphServer(options) as server:
+        write_config(data_dir, build_parameters(args.lists, json.loads(args.params)))
+        start = time.perf_counter()
+        run_component(server, data_dir)
+        elapsed = time.perf_counter() - start
+        out_size = output_size(data_dir)
+
+    total_rows = args.rows * args.lists
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'rows          {total_rows:12,}')
+    print(f'elapsed       {elapsed:12.2f} s')
+    print(f'rows/s        {total_rows / elapsed:12,.0f}')
+    print(f'requests      {server.request_count:12,} ({server.throttled_count:,} throttled)')
+    print(f'requests/s    {server.request_count / elapsed:12,.1f}')
+    print(f'peak RSS      {peak_rss_mb:12,.1f} MB')
+    print(f'output size   {out_size / 1024 / 1024:12,.1f} MB')
+    print(f'writing       {timer.seconds:12.2f} s (summed across threads)')
+    print(f'network+other {max(elapsed - timer.seconds, 0):12.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Micro-benchmark of the list data writer.
+
+Compares the previous per-row approach (rename fields of each row dict to display names, write via csv.DictWriter)
+with the compiled row projection of the ListDataResultWriter on a synthetic list.
+
+Usage:
+    python benchmarks/bench_row_writer.py [number of rows] [number of columns]
+'''
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
+
+from result import ListDataResultWriter, LIST_ID  # noqa: E402
+
+PAGE_SIZE = 200
+
+
+def generate_columns(column_count):
+    list_columns = [{'name': 'ID', 'displayName': 'ID'}]
+    for i in range(1, column_count):
+        column = {'name': f'field_{i}', 'displayName': f'Field {i}'}
+        if not i % 3:
+            column['number'] = {}
+        list_columns.append(column)
+    return list_columns
+
+
+def generate_pages(row_count, column_count):
+    for start in range(0, row_count, PAGE_SIZE):
+        page = []
+        for i in range(start, min(start + PAGE_SIZE, row_count)):
+            row = {'id': str(i), '@odata.etag': f'"{i},1"', 'ContentType': 'Item', '_UIVersionString': '1.0'}
+            for c in range(1, column_count):
+                row[f'field_{c}'] = f'value {i} {c}' if c % 3 else i * c
+            page.append(row)
+        yield page
+
+
+def write_legacy(out_dir, list_columns, pages):
+    """
+    The previous implementation - renames the row fields inplace and writes them via DictWriter.
+    """
+    header = [c['displayName'] for c in list_columns] + [LIST_ID]
+    with open(os.path.join(out_dir, 'legacy.csv'), 'w', newline='', encoding='utf-8') as out:
+        writer = csv.DictWriter(out, fieldnames=header, extrasaction='ignore')
+        writer.writeheader()
+        for page in pages:
+            for data in page:
+                for key in list_columns:
+                    if key['name'] == 'ID':
+                        key['name'] = 'id'
+                    if data.get(key['name']):
+                        data[key['displayName']] = data.pop(key['name'])
+                writer.writerow({**data, LIST_ID: 'list-id'})
+
+
+def write_compiled(out_dir, list_columns, pages):
+    writer = ListDataResultWriter(out_dir, list_columns, 'compiled')
+    for page in pages:
+        writer.write_rows(page, user_values={LIST_ID: 'list-id'})
+    writer.close()
+
+
+def measure(name, write_func, row_count, column_count):
+    pages = list(generate_pages(row_count, column_count))
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        write_func(out_dir, generate_columns(column_count), pages)
+        elapsed = time.perf_counter() - start
+    print(f'{name:<10} {elapsed:8.2f} s {row_count / elapsed:12,.0f} rows/s')
+    return elapsed
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f'Writing {rows:,} rows with {cols} columns')
+    legacy = measure('legacy', write_legacy, rows, cols)
+    compiled = measure('compiled', write_compiled, rows, cols)
+    print(f'speedup    {legacy / compiled:8.2f} x')
@@ -0,0 +1,214 @@
+'''
+Local mock of the Graph API endpoints used by the component, serving synthetic lists.
+
+Each site has lists named `List 1` ... `List {lists}` with the same columns and items. The server runs
+in a separate process, so that it does not compete with the measured component for the GIL.
+'''
+import json
+import multiprocessing
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+SITE_ID = 'bench.sharepoint.com,1,1'
+
+
+class MockGraphOptions:
+
+    def __init__(self, rows=10000, columns=20, page_size=200, lists=1, value_length=20, latency_ms=0,
+                 throttle_every=0, retry_after=1):
+        """
+
+        :param rows: number of items of each list
+        :param columns: number of columns of each list, including ID
+        :param page_size: number of items per page
+        :param lists: number of lists
+        :param value_length: length of the text values
+        :param latency_ms: delay of each response
+        :param throttle_every: every n-th request is throttled with 429, 0 disables the throttling
+        :param retry_after: Retry-After of the throttled responses in seconds
+        """
+        self.rows = rows
+        self.columns = columns
+        self.page_size = page_size
+        self.lists = lists
+        self.value_length = value_length
+        self.latency_ms = latency_ms
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+
+
+class MockGraphServer:
+    """
+    Usage:
+        with MockGraphServer(MockGraphOptions(rows=100000)) as server:
+            ... requests to server.base_url, server.login_url
+        print(server.request_count, server.throttled_count)
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self._requests = multiprocessing.Value('i', 0)
+        self._throttled = multiprocessing.Value('i', 0)
+        self._port = multiprocessing.Value('i', 0)
+        self._ready = multiprocessing.Event()
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._port.value}/v1.0/'
+
+    @property
+    def login_url(self):
+        return f'http://127.0.0.1:{self._port.value}/login'
+
+    @property
+    def request_count(self):
+        return self._requests.value
+
+    @property
+    def throttled_count(self):
+        return self._throttled.value
+
+    def start(self):
+        self._process = multiprocessing.Process(target=_serve, daemon=True,
+                                                args=(self.options, self._port, self._requests, self._throttled,
+                                                      self._ready))
+        self._process.start()
+        self._ready.wait(10)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+def _serve(options, port, requests, throttled, ready):
+    handler = type('Handler', (_GraphHandler,), {'options': options, 'requests': requests, 'throttled': throttled})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    port.value = server.server_port
+    ready.set()
+    server.serve_forever()
+
+
+class _GraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+    requests = None
+    throttled = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/login':
+            return self._send(200, {'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 3600})
+        if self._throttle():
+            return
+        responses = []
+        for sub_request in json.loads(body)['requests']:
+            status, sub_body = self._route(urlsplit('/v1.0/' + sub_request['url'].lstrip('/')))
+            responses.append({'id': sub_request['id'], 'status': status, 'body': sub_body,
+                              'headers': {'Content-Type': 'application/json'}})
+        self._send(200, {'responses': responses})
+
+    def do_GET(self):
+        if self._throttle():
+            return
+        self._send(*self._route(urlsplit(self.path)))
+
+    def _throttle(self):
+        with self.requests.get_lock():
+            self.requests.value += 1
+            request_number = self.requests.value
+        if self.options.latency_ms:
+            time.sleep(self.options.latency_ms / 1000)
+        if self.options.throttle_every and request_number % self.options.throttle_every == 0:
+            with self.throttled.get_lock():
+                self.throttled.value += 1
+            self._send(429, {'error': {'code': 'TooManyRequests', 'message': 'Throttled'}},
+                       headers={'Retry-After': str(self.options.retry_after)})
+            return True
+        return False
+
+    def _send(self, status, body, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, url):
+        path = url.path[len('/v1.0/'):].strip('/')
+        query = dict(parse_qsl(url.query))
+        if path.startswith('sites/') and ':' in path:
+            return 200, {'id': SITE_ID, 'webUrl': 'https://bench.sharepoint.com'}
+        if path == f'sites/{SITE_ID}/lists':
+            return 200, {'value': [self._list(i) for i in range(1, self.options.lists + 1)
+                                   if query.get('$filter', f"'List {i}'").endswith(f"'List {i}'")]}
+        match = re.fullmatch(f'sites/{re.escape(SITE_ID)}/lists/list-(\\d+)(/items(/delta)?)?', path)
+        if not match:
+            return 404, {'error': {'code': 'itemNotFound', 'message': f'{path} not found'}}
+        if not match.group(2):
+            sh_list = self._list(int(match.group(1)))
+            if 'expand' in query:
+                sh_list['columns'] = self._columns()
+            return 200, sh_list
+        return 200, self._items_page(url.path, query, is_delta=bool(match.group(3)))
+
+    @staticmethod
+    def _list(number):
+        return {'id': f'list-{number}', 'displayName': f'List {number}', 'name': f'List{number}',
+                'eTag': '"1"', 'lastModifiedDateTime': '2020-01-01T00:00:00Z',
+                'webUrl': f'https://bench.sharepoint.com/Lists/List{number}',
+                'list': {'template': 'genericList', 'hidden': False}}
+
+    def _columns(self):
+        list_columns = [{'name': 'ID', 'displayName': 'ID', 'number': {}}]
+        for i in range(1, self.options.columns):
+            column = {'name': f'Field{i}', 'displayName': f'Field {i}'}
+            if i % 3 == 0:
+                column['number'] = {}
+            list_columns.append(column)
+        return list_columns
+
+    def _items_page(self, path, query, is_delta):
+        options = self.options
+        start = int(query.get('$skiptoken', 0))
+        page_size = int(query.get('$top', options.page_size))
+        ids = range(1, options.rows + 1)
+        id_range = re.findall(r'fields/ID (?:ge|lt) (\d+)', query.get('$filter', ''))
+        if id_range:
+            ids = range(max(1, int(id_range[0])), min(options.rows + 1, int(id_range[1])))
+        if query.get('$orderby') == 'fields/ID desc':
+            ids = ids[::-1]
+        select = re.search(r'select=([^)]*)', query.get('expand', ''))
+        fields = select.group(1).split(',') if select else None
+
+        page = {'value': [{'id': str(i), 'fields': self._fields(i, fields)} for i in ids[start:start + page_size]]}
+        base_url = f'http://{self.headers["Host"]}{path}'
+        if start + page_size < len(ids):
+            page['@odata.nextLink'] = f'{base_url}?{urlencode({**query, "$skiptoken": start + page_size})}'
+        elif is_delta:
+            page['@odata.deltaLink'] = f'{base_url}?token=latest'
+        return json.dumps(page).encode()
+
+    def _fields(self, item_id, select):
+        text = ('v' * self.options.value_length)
+        fields = {'@odata.etag': f'"{item_id},1"', 'id': str(item_id)}
+        for i in range(1, self.options.columns):
+            name = f'Field{i}'
+            if select is None or name in select:
+                fields[name] = item_id * i if i % 3 == 0 else text
+        return fields
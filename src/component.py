@@ -3,18 +3,33 @@ Template Component main class.
 
 '''
 
+import asyncio
+import copy
+import itertools
 import json
 import logging
+import operator
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 
+import requests
 from kbc.env_handler import KBCEnvHandler
 
+import discovery
 import result
+from ms_graph import columns
+from ms_graph.async_client import AsyncClient
 from ms_graph.client import Client
-from ms_graph.exceptions import BaseError, BadRequest
-from result import ListDataResultWriter, ListResultWriter
+from ms_graph.exceptions import BaseError, BadRequest, Gone, InternalServerError
+from ms_graph.page_size import PageSize
+from metadata_cache import MetadataCache
+from result import ListDataParquetWriter, ListDataResultWriter, ListResultWriter, DeletedItemsResultWriter, \
+    ExplodedListDataWriter, MultiValueResultWriter, CompressedListDataWriter
 
 # global constants'
 # configuration variables
@@ -22,16 +37,50 @@ APP_SECRET = '#appSecret'
 APP_KEY = 'appKey'
 CONFIG_REFRESH_TOKEN = 'refresh_token'
 STATE_REFRESH_TOKEN = "#refresh_token"
+STATE_DELTA_LINKS = 'delta_links'
+STATE_CHECKPOINTS = 'checkpoints'
+STATE_METADATA_CACHE = 'metadata_cache'
+STATE_FILE_ETAGS = 'file_etags'
+STATE_WATERMARKS = 'watermarks'
 KEY_API_TOKEN = '#api_token'
 KEY_BASE_HOST = 'base_host_name'
+KEY_MAX_PARALLEL_LISTS = 'max_parallel_lists'
+KEY_MAX_PARALLEL_DOWNLOADS = 'max_parallel_downloads'
+KEY_PAGE_PREFETCH_DEPTH = 'page_prefetch_depth'
+KEY_CONNECTION_POOL_SIZE = 'connection_pool_size'
+KEY_CLIENT_ENGINE = 'client_engine'
+KEY_MAX_REQUESTS_PER_SECOND = 'max_requests_per_second'
+KEY_STREAM_ITEMS = 'stream_item_pages'
+KEY_PAGE_SIZE = 'page_size'
+KEY_ADAPTIVE_PAGE_SIZE = 'adaptive_page_size'
+KEY_REQUEST_TIMEOUT = 'request_timeout_s'
+KEY_METADATA_CACHE_TTL = 'metadata_cache_ttl_hours'
+KEY_OUTPUT_FORMAT = 'output_format'
+KEY_SLICE_SIZE_MB = 'slice_size_mb'
+KEY_RUN_REPORT = 'run_report'
+KEY_DISCOVERY = 'discovery'
+KEY_DISCOVERY_ENABLED = 'enabled'
+KEY_DISCOVERY_SITE_PATHS = 'site_paths'
+KEY_DISCOVERY_SITE_SEARCH = 'site_search'
+KEY_DISCOVERY_LIST_PATTERN = 'list_name_pattern'
+KEY_DISCOVERY_PATTERN_TYPE = 'pattern_type'
+KEY_DISCOVERY_INCLUDE_LIBRARIES = 'include_document_libraries'
 KEY_LISTS = 'lists'
 KEY_LIST_SITE_REL_PATH = 'site_url_rel_path'
 KEY_LIST_NAME = 'list_name'
 KEY_LIST_INCLUDE_ADD_COLS = 'include_additional_cols'
+KEY_LIST_COLUMNS = 'columns'
+KEY_LIST_FILTER = 'filter'
+KEY_LIST_EXPLODE_MULTI_VALUES = 'explode_multi_value_columns'
+KEY_LIST_DOWNLOAD_FILES = 'download_files'
 KEY_USE_DISPLAY_NAMES = 'use_display_names'
 KEY_LIST_LOAD_SETUP = 'load_setup'
 KEY_LIST_LOAD_MODE = 'load_mode_incremental'
 KEY_LIST_RESULT_NAME = 'result_table_name'
+KEY_LIST_USE_DELTA = 'use_delta_query'
+KEY_LIST_SLICES = 'parallel_slices'
+KEY_LIST_RESUMABLE = 'resumable'
+KEY_LIST_WATERMARK = 'watermark'
 
 # #### Keep for debug
 KEY_DEBUG = 'debug'
@@ -40,16 +89,53 @@ MANDATORY_IMAGE_PARS = []
 
 OAUTH_APP_SCOPE = 'offline_access Files.Read Sites.Read.All'
 
+ENGINE_SYNC = 'sync'
+ENGINE_ASYNC = 'async'
+
+FORMAT_CSV = 'csv'
+FORMAT_PARQUET = 'parquet'
+FORMAT_CSV_GZIP = 'csv_gzip'
+
+RUN_REPORT_FILE = 'run_report.json'
+
+# initial page size of the adaptive mode
+DEFAULT_ADAPTIVE_PAGE_SIZE = 500
+DEFAULT_PARALLEL_DOWNLOADS = 4
+# uncompressed size of the compressed csv slices
+DEFAULT_SLICE_SIZE_MB = 100
+
+# options selecting how the list items are downloaded, in the order of precedence
+DOWNLOAD_MODE_TITLES = {KEY_LIST_USE_DELTA: 'Download only changes (delta query)',
+                        KEY_LIST_WATERMARK: 'Download only modified items (watermark)',
+                        KEY_LIST_SLICES: 'Parallel slices',
+                        KEY_LIST_RESUMABLE: 'Resume failed downloads',
+                        KEY_STREAM_ITEMS: 'Stream item pages'}
+# options not implemented by the async engine, they are ignored with a warning
+ASYNC_IGNORED_OPTIONS = {KEY_PAGE_PREFETCH_DEPTH: 'Prefetched pages',
+                         KEY_STREAM_ITEMS: 'Stream item pages',
+                         KEY_PAGE_SIZE: 'Page size',
+                         KEY_ADAPTIVE_PAGE_SIZE: 'Adaptive page size',
+                         KEY_METADATA_CACHE_TTL: 'Metadata cache TTL'}
+ASYNC_IGNORED_LIST_OPTIONS = {KEY_LIST_USE_DELTA: 'Download only changes (delta query)',
+                              KEY_LIST_FILTER: 'Filter',
+                              KEY_LIST_WATERMARK: 'Download only modified items (watermark)',
+                              KEY_LIST_SLICES: 'Parallel slices',
+                              KEY_LIST_RESUMABLE: 'Resume failed downloads',
+                              KEY_LIST_DOWNLOAD_FILES: 'Download files'}
+
+# modification time of the list items, stored as the watermark
+WATERMARK_FIELD = 'Modified'
+
 
 class UserException(Exception):
     pass
 
 
-def _initialize_client(refresh_tokens, app_key, app_secret):
+def _initialize_client(refresh_tokens, app_key, app_secret, client_options):
     for refresh_token in refresh_tokens:
         try:
             client = Client(refresh_token=refresh_token, client_id=app_key,
-                            client_secret=app_secret, scope=OAUTH_APP_SCOPE)
+                            client_secret=app_secret, scope=OAUTH_APP_SCOPE, **client_options)
             return client
         except BadRequest as exc:
             logging.exception(f"Refresh token failed, retrying connection with new refresh token. {exc}")
@@ -57,6 +143,16 @@ def _initialize_client(refresh_tokens, app_key, app_secret):
     raise UserException('Authentication failed, reauthorize the extractor in extractor configuration!')
 
 
+def _combine_filters(*filters):
+    """
+    Joins the OData filter expressions by `and`, empty expressions are skipped.
+    """
+    filters = [f for f in filters if f]
+    if len(filters) > 1:
+        return ' and '.join(f'({f})' for f in filters)
+    return filters[0] if filters else None
+
+
 class Component(KBCEnvHandler):
 
     def __init__(self, debug=False):
@@ -82,11 +178,18 @@ class Component(KBCEnvHandler):
                 # normalize config - structure used for UI
                 ls[KEY_LIST_LOAD_MODE] = ls[KEY_LIST_LOAD_SETUP][KEY_LIST_LOAD_MODE]
                 ls[KEY_LIST_RESULT_NAME] = ls[KEY_LIST_LOAD_SETUP][KEY_LIST_RESULT_NAME]
+                ls[KEY_LIST_USE_DELTA] = ls[KEY_LIST_LOAD_SETUP].get(KEY_LIST_USE_DELTA, False)
+                ls[KEY_LIST_SLICES] = ls[KEY_LIST_LOAD_SETUP].get(KEY_LIST_SLICES, 0)
+                ls[KEY_LIST_RESUMABLE] = ls[KEY_LIST_LOAD_SETUP].get(KEY_LIST_RESUMABLE, False)
+                ls[KEY_LIST_WATERMARK] = ls[KEY_LIST_LOAD_SETUP].get(KEY_LIST_WATERMARK, False)
 
         except ValueError as e:
             logging.exception(e)
             exit(1)
 
+        if self.cfg_params.get(KEY_OUTPUT_FORMAT) == FORMAT_PARQUET and result.pa is None:
+            raise UserException('The Parquet output format requires the pyarrow package.')
+
         refresh_tokens = []
 
         previous_state = self.get_state_file()
@@ -104,68 +207,955 @@ class Component(KBCEnvHandler):
         app_key = self.get_authorization()[APP_KEY]
         app_secret = self.get_authorization()[APP_SECRET]
 
-        self.client = _initialize_client(refresh_tokens, app_key, app_secret)
+        # each worker may use one connection for the consumer and one for the page prefetch, for each slice
+        max_slices = max([ls.get(KEY_LIST_SLICES, 0) for ls in self.cfg_params[KEY_LISTS]] + [1])
+        connections_per_worker = 2 * max_slices
+        if any(ls.get(KEY_LIST_DOWNLOAD_FILES) for ls in self.cfg_params[KEY_LISTS]) \
+                or self.cfg_params.get(KEY_DISCOVERY, {}).get(KEY_LIST_DOWNLOAD_FILES):
+            connections_per_worker += self.cfg_params.get(KEY_MAX_PARALLEL_DOWNLOADS) or DEFAULT_PARALLEL_DOWNLOADS
+        default_pool_size = max(10, connections_per_worker * (self.cfg_params.get(KEY_MAX_PARALLEL_LISTS) or 1))
+        client_options = {'page_prefetch_depth': self.cfg_params.get(KEY_PAGE_PREFETCH_DEPTH, 1),
+                          'pool_maxsize': self.cfg_params.get(KEY_CONNECTION_POOL_SIZE) or default_pool_size,
+                          'max_requests_per_second': self.cfg_params.get(KEY_MAX_REQUESTS_PER_SECOND) or 25,
+                          'read_timeout': self.cfg_params.get(KEY_REQUEST_TIMEOUT) or 120}
+        self.client = _initialize_client(refresh_tokens, app_key, app_secret, client_options)
+        self._app_key = app_key
+        self._app_secret = app_secret
         self.list_metadata_wr = ListResultWriter(self.tables_out_path)
-        self.write_state_file({STATE_REFRESH_TOKEN: self.client.refresh_token})
+        # guards the shared metadata writer and state when lists are downloaded in parallel
+        self._lock = threading.Lock()
+        # run report, rows written per list id and details of each downloaded list
+        self._rows_written = {}
+        self._page_sizes = {}
+        self._list_runs = []
+        self._metadata_cache = MetadataCache(previous_state.get(STATE_METADATA_CACHE),
+                                             ttl_seconds=(self.cfg_params.get(KEY_METADATA_CACHE_TTL) or 0) * 3600,
+                                             columns_version=columns.COLUMNS_EXPAND)
+        self.state = {STATE_REFRESH_TOKEN: self.client.refresh_token,
+                      STATE_DELTA_LINKS: previous_state.get(STATE_DELTA_LINKS, {}),
+                      STATE_CHECKPOINTS: previous_state.get(STATE_CHECKPOINTS, {}),
+                      STATE_METADATA_CACHE: previous_state.get(STATE_METADATA_CACHE, {}),
+                      STATE_FILE_ETAGS: previous_state.get(STATE_FILE_ETAGS, {}),
+                      STATE_WATERMARKS: previous_state.get(STATE_WATERMARKS, {})}
+        self.write_state_file(self.state)
+        self.client.on_token_refresh = self._store_refresh_token
 
     def run(self):
         '''
         Main execution code
         '''
         params = self.cfg_params  # noqa
-        for lst_par in params[KEY_LISTS]:
-            try:
-                logging.info(
-                    f'Downloading list "{lst_par[KEY_LIST_NAME]}" '
-                    f'from the site: {params[KEY_BASE_HOST] + lst_par[KEY_LIST_SITE_REL_PATH]}')
-                logging.info('Validating site and list references...')
-                site = self.client.get_site_by_relative_url(params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH])
-                if not site.get('id'):
-                    raise RuntimeError(
-                        f'No site with given url: '
-                        f'{"/".join([params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH]])} found.')
-
-                sh_list = self.client.get_site_list_by_name(site['id'], lst_par[KEY_LIST_NAME])
-                if not sh_list:
-                    raise RuntimeError(
-                        f'No list named "{lst_par[KEY_LIST_NAME]}" found on site : '
-                        f'{"/".join([params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH]])} .')
-
-                logging.info('Getting list details...')
-                list_columns = self.client.get_site_list_columns(site['id'], sh_list['id'],
-                                                                 include_system=lst_par.get(KEY_LIST_INCLUDE_ADD_COLS,
-                                                                                            False),
-                                                                 use_display_colnames=lst_par.get(KEY_USE_DISPLAY_NAMES,
-                                                                                                  True))
-                logging.info('Collecting list data...')
-                data_results = self._collect_and_write_list(site['id'], sh_list, list_columns, lst_par)
-                self.create_manifests(results=data_results, incremental=lst_par.get(KEY_LIST_LOAD_MODE, False))
-            except BaseError as ex:
-                logging.exception(ex)
-                exit(1)
+        started = time.perf_counter()
+        max_workers = params.get(KEY_MAX_PARALLEL_LISTS) or 1
+        lists, discovered_lists = params[KEY_LISTS], {}
+        if params.get(KEY_DISCOVERY, {}).get(KEY_DISCOVERY_ENABLED):
+            lists, discovered_lists = self._add_discovered_lists(lists)
+        if params.get(KEY_CLIENT_ENGINE, ENGINE_SYNC) == ENGINE_ASYNC:
+            self._download_lists_async(lists, max_workers)
+        else:
+            self._download_lists(lists, max_workers, discovered_lists)
 
         logging.info('Writing metadata results')
         self.list_metadata_wr.close()
         metadata_tables = self.list_metadata_wr.collect_results()
 
         self.create_manifests(results=metadata_tables, incremental=True)
+        if params.get(KEY_CLIENT_ENGINE, ENGINE_SYNC) != ENGINE_ASYNC:
+            self.state[STATE_METADATA_CACHE] = self._metadata_cache.entries
+        self.write_state_file(self.state)
+        logging.info(f'HTTP connections: {self.client.connection_stats}')
+        logging.info(f'Throttling: {self.client.rate_limiter.metrics}')
+        logging.info(f'Requests: {self.client.metrics.totals}')
+        if params.get(KEY_RUN_REPORT):
+            self._write_run_report(time.perf_counter() - started)
         logging.info('Extraction finished!')
 
-    def _collect_and_write_list(self, site_id, sh_lst, list_columns, lst_par):
-        data_wr = ListDataResultWriter(self.tables_out_path, list_columns, lst_par[KEY_LIST_RESULT_NAME])
-        for fl in self.client.get_site_list_fields(site_id, sh_lst['id']):
-            for f in fl:
-                logging.debug(f"List row: {f}")
-                if isinstance(f, list):
-                    f = json.dumps(f)
-                data_wr.write(f, user_values={result.LIST_ID: sh_lst['id']})
-        # write metadata
-        self.list_metadata_wr.write(sh_lst, user_values={result.SITE_ID: site_id,
+    def _store_refresh_token(self, refresh_token):
+        """
+        Stores the refresh token rotated during the run, the previous one may no longer be valid.
+        """
+        with self._lock:
+            self.state[STATE_REFRESH_TOKEN] = refresh_token
+            self.write_state_file(self.state)
+
+    def _add_discovered_lists(self, lists):
+        """
+        Adds configurations of the discovered lists to the configured lists. Lists already configured are skipped.
+
+        :param lists: configured lists
+        :return: tuple (all lists, dict {list index: tuple (site, list)} of the discovered lists)
+        """
+        discovery_cfg = self.cfg_params[KEY_DISCOVERY]
+        pattern = discovery_cfg.get(KEY_DISCOVERY_LIST_PATTERN)
+        try:
+            name_matcher = discovery.compile_name_matcher(pattern, discovery_cfg.get(KEY_DISCOVERY_PATTERN_TYPE,
+                                                                                     discovery.PATTERN_GLOB))
+        except re.error as ex:
+            raise UserException(f'Invalid list name pattern "{pattern}": {ex}')
+        logging.info('Discovering lists...')
+        try:
+            discovered = discovery.discover_lists(
+                self.client, self.cfg_params[KEY_BASE_HOST],
+                site_paths=discovery_cfg.get(KEY_DISCOVERY_SITE_PATHS),
+                site_search=discovery_cfg.get(KEY_DISCOVERY_SITE_SEARCH),
+                name_matcher=name_matcher,
+                include_document_libraries=discovery_cfg.get(KEY_DISCOVERY_INCLUDE_LIBRARIES, False),
+                page_size=self._create_page_size())
+        except BaseError as ex:
+            logging.exception(ex)
+            exit(1)
+
+        all_lists = list(lists)
+        configured = {self._get_cache_key(lst_par) for lst_par in lists}
+        used_names = {lst_par[KEY_LIST_RESULT_NAME] for lst_par in lists}
+        discovered_lists = {}
+        for site, site_path, sh_list in discovered:
+            lst_par = {KEY_LIST_SITE_REL_PATH: site_path,
+                       KEY_LIST_NAME: sh_list['displayName'],
+                       KEY_LIST_INCLUDE_ADD_COLS: discovery_cfg.get(KEY_LIST_INCLUDE_ADD_COLS, False),
+                       KEY_USE_DISPLAY_NAMES: discovery_cfg.get(KEY_USE_DISPLAY_NAMES, True),
+                       KEY_LIST_LOAD_MODE: discovery_cfg.get(KEY_LIST_LOAD_MODE, False),
+                       KEY_LIST_DOWNLOAD_FILES: discovery_cfg.get(KEY_LIST_DOWNLOAD_FILES, False)}
+            if self._get_cache_key(lst_par) in configured:
+                continue
+            lst_par[KEY_LIST_RESULT_NAME] = discovery.build_table_name(site_path, sh_list['displayName'], used_names,
+                                                                       sh_list['id'])
+            discovered_lists[len(all_lists)] = (site, sh_list)
+            all_lists.append(lst_par)
+        return all_lists, discovered_lists
+
+    def _download_lists(self, lists, max_workers, discovered_lists=None):
+        resolved_lists = {}
+        if len(lists) > 1 or discovered_lists:
+            try:
+                resolved_lists = self._resolve_lists(lists, discovered_lists)
+            except BaseError as ex:
+                logging.exception(ex)
+                exit(1)
+        logging.info(f'Downloading {len(lists)} lists using {max_workers} parallel workers.')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._download_and_finalize_list, lst_par, resolved_lists.pop(i, None))
+                       for i, lst_par in enumerate(lists)]
+            # the first failure stops the run, no matter which list failed
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except BaseError as ex:
+                    logging.exception(ex)
+                    self._cancel_pending(futures)
+                    exit(1)
+                except Exception:
+                    self._cancel_pending(futures)
+                    raise
+
+    def _download_and_finalize_list(self, lst_par, resolved_list=None):
+        """
+        Downloads the list and writes the manifests of its tables right away, so that nothing is kept
+        until the end of the run.
+        """
+        data_results, incremental = self._download_list(lst_par, resolved_list)
+        self._create_data_manifests(data_results, incremental)
+
+    def _download_list(self, lst_par, resolved_list=None):
+        """
+        Resolves the list references and downloads the list data. Runs in a worker thread.
+
+        :param lst_par: list configuration
+        :param resolved_list: tuple (site, list, columns) already resolved by `_resolve_lists`
+                              or the exception raised during the resolution.
+        :return: tuple (data results, incremental load flag)
+        """
+        params = self.cfg_params
+        logging.info(
+            f'Downloading list "{lst_par[KEY_LIST_NAME]}" '
+            f'from the site: {params[KEY_BASE_HOST] + lst_par[KEY_LIST_SITE_REL_PATH]}')
+        if isinstance(resolved_list, Exception):
+            raise resolved_list
+        started = time.perf_counter()
+        site, sh_list, list_columns = resolved_list or self._resolve_list(lst_par)
+
+        try:
+            data_results = self._download_list_data(site, sh_list, list_columns, lst_par)
+        except BadRequest as ex:
+            cache_key = self._get_cache_key(lst_par)
+            if not self._metadata_cache.was_served(cache_key):
+                raise
+            # other bad requests, e.g. an invalid filter, fail the same way with the current columns
+            if not self._cached_columns_changed(cache_key, site, sh_list):
+                raise
+            # e.g. a selected column was deleted or renamed
+            logging.warning(f'The cached columns of the list "{lst_par[KEY_LIST_NAME]}" do not match the list data, '
+                            f'refreshing the list details. Reason: {ex}')
+            self._metadata_cache.invalidate(cache_key)
+            site, sh_list, list_columns = self._resolve_list(lst_par)
+            data_results = self._download_list_data(site, sh_list, list_columns, lst_par)
+        if lst_par.get(KEY_LIST_DOWNLOAD_FILES):
+            self._download_list_files(site['id'], sh_list, lst_par)
+        self._add_list_run(lst_par, sh_list['id'], time.perf_counter() - started)
+        logging.info(f'List "{lst_par[KEY_LIST_NAME]}" downloaded.')
+        return data_results, lst_par.get(KEY_LIST_LOAD_MODE, False)
+
+    def _cached_columns_changed(self, cache_key, site, sh_list):
+        """
+        Compares the cached column definitions with the current columns of the list.
+        """
+        entry = self._metadata_cache.get(cache_key)
+        try:
+            current_columns = self.client.get_site_list_column_definitions(site['id'], sh_list['id'])
+        except BaseError:
+            # the cached list is no longer available
+            return True
+        return not entry or entry['columns'] != current_columns
+
+    def _download_list_data(self, site, sh_list, list_columns, lst_par):
+        if lst_par.get(KEY_LIST_COLUMNS):
+            list_columns = self._filter_columns(list_columns, lst_par[KEY_LIST_COLUMNS], lst_par[KEY_LIST_NAME])
+        logging.info(f'Collecting data of the list "{lst_par[KEY_LIST_NAME]}"...')
+        return self._collect_and_write_list(site['id'], sh_list, list_columns, lst_par)
+
+    def _resolve_list(self, lst_par):
+        """
+        Validates site and list references and gets the list columns. Cached references are used if still valid.
+
+        :param lst_par: list configuration
+        :return: tuple (site, list, columns)
+        """
+        params = self.cfg_params
+        cache_key = self._get_cache_key(lst_par)
+        site, sh_list, raw_columns = self._get_cached_list(cache_key, lst_par)
+        if not site:
+            logging.info(f'Validating site and list references of the list "{lst_par[KEY_LIST_NAME]}"...')
+            site = self.client.get_site_by_relative_url(params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH])
+            if not site.get('id'):
+                raise RuntimeError(f'No site with given url: {self._get_site_url(lst_par)} found.')
+
+            sh_list = self.client.get_site_list_by_name(site['id'], lst_par[KEY_LIST_NAME])
+            if not sh_list:
+                raise RuntimeError(
+                    f'No list named "{lst_par[KEY_LIST_NAME]}" found on site : {self._get_site_url(lst_par)} .')
+
+        if raw_columns is None:
+            logging.info(f'Getting details of the list "{lst_par[KEY_LIST_NAME]}"...')
+            raw_columns = self.client.get_site_list_column_definitions(site['id'], sh_list['id'])
+            self._metadata_cache.put(cache_key, site, sh_list, raw_columns)
+        return site, sh_list, self._process_columns(raw_columns, lst_par)
+
+    def _get_cached_list(self, cache_key, lst_par):
+        """
+        Gets the list metadata from the cache, expired entries are validated by a list lookup.
+
+        :return: tuple (site, list, unprocessed columns), items that have to be looked up again are None
+        """
+        entry = self._metadata_cache.get(cache_key)
+        if not entry:
+            return None, None, None
+        if self._metadata_cache.is_fresh(entry):
+            logging.info(f'Using cached details of the list "{lst_par[KEY_LIST_NAME]}".')
+            self._metadata_cache.mark_served(cache_key)
+            return entry['site'], entry['list'], entry['columns']
+        try:
+            current_list = self.client.get_site_list(entry['site']['id'], entry['list']['id'])
+        except BaseError as ex:
+            current_list = ex
+        return self._revalidate_cache_entry(cache_key, entry, current_list, lst_par)
+
+    def _revalidate_cache_entry(self, cache_key, entry, current_list, lst_par):
+        """
+        Compares the expired cache entry with the current list object.
+
+        :param current_list: current list object or the exception raised by the lookup
+        :return: tuple (site, list, unprocessed columns), items that have to be looked up again are None
+        """
+        if isinstance(current_list, Exception):
+            logging.info(f'The cached list "{lst_par[KEY_LIST_NAME]}" is no longer available, '
+                         f'looking it up again. Reason: {current_list}')
+            self._metadata_cache.invalidate(cache_key)
+            return None, None, None
+        if not self._metadata_cache.is_valid_version(entry, current_list):
+            logging.info(f'The list "{lst_par[KEY_LIST_NAME]}" has changed since it was cached.')
+            return entry['site'], current_list, None
+        logging.info(f'Using cached details of the list "{lst_par[KEY_LIST_NAME]}", the list has not changed.')
+        self._metadata_cache.put(cache_key, entry['site'], current_list, entry['columns'])
+        self._metadata_cache.mark_served(cache_key)
+        return entry['site'], current_list, entry['columns']
+
+    def _resolve_lists(self, lists, discovered_lists=None):
+        """
+        Resolves sites, lists and columns of all configured lists using batch requests,
+        i.e. three batch round trips per 20 lists instead of three requests per list.
+        Valid cached references are used, expired cache entries are validated by a single batch round trip.
+
+        :param lists: list configurations
+        :param discovered_lists: dict {list index: tuple (site, list)} of lists with already known site and list
+        :return: dict {list index: tuple (site, list, columns)},
+                 lists that failed to resolve have the exception as a value
+        """
+        logging.info(f'Validating site and list references of {len(lists)} lists...')
+        discovered_lists = discovered_lists or {}
+        # partially resolved lists are tuples (site,) and (site, list), unprocessed columns are added last
+        resolved = {}
+        expired = {}
+        for i, lst_par in enumerate(lists):
+            cache_key = self._get_cache_key(lst_par)
+            entry = self._metadata_cache.get(cache_key)
+            if entry and self._metadata_cache.is_fresh(entry):
+                self._metadata_cache.mark_served(cache_key)
+                resolved[i] = (entry['site'], entry['list'], entry['columns'])
+            elif entry and i in discovered_lists:
+                # the current list object is already known
+                cached = self._revalidate_cache_entry(cache_key, entry, discovered_lists[i][1], lst_par)
+                resolved[i] = cached if cached[2] is not None else cached[:2]
+            elif entry:
+                expired[i] = entry
+            elif i in discovered_lists:
+                resolved[i] = discovered_lists[i]
+
+        current_lists = self.client.get_site_lists_batch(
+            {(entry['site']['id'], entry['list']['id']) for entry in expired.values()})
+        for i, entry in expired.items():
+            current_list = current_lists[(entry['site']['id'], entry['list']['id'])]
+            cached = self._revalidate_cache_entry(self._get_cache_key(lists[i]), entry, current_list, lists[i])
+            if cached[0]:
+                resolved[i] = cached if cached[2] is not None else cached[:2]
+
+        pending = [i for i in range(len(lists)) if i not in resolved]
+        site_paths = {lists[i][KEY_LIST_SITE_REL_PATH] for i in pending}
+        sites = self.client.get_sites_by_relative_url_batch(self.cfg_params[KEY_BASE_HOST], site_paths)
+        for i in pending:
+            site = sites[lists[i][KEY_LIST_SITE_REL_PATH]]
+            if not isinstance(site, Exception) and not site.get('id'):
+                site = RuntimeError(f'No site with given url: {self._get_site_url(lists[i])} found.')
+            resolved[i] = site if isinstance(site, Exception) else (site,)
+
+        pending = self._get_resolved_up_to(resolved, 1)
+        sh_lists = self.client.get_site_lists_by_name_batch(
+            {(resolved[i][0]['id'], lists[i][KEY_LIST_NAME]) for i in pending})
+        for i in pending:
+            sh_list = sh_lists[(resolved[i][0]['id'], lists[i][KEY_LIST_NAME])]
+            if not sh_list:
+                sh_list = RuntimeError(
+                    f'No list named "{lists[i][KEY_LIST_NAME]}" found on site : {self._get_site_url(lists[i])} .')
+            resolved[i] = sh_list if isinstance(sh_list, Exception) else (resolved[i][0], sh_list)
+
+        logging.info('Getting list details...')
+        pending = self._get_resolved_up_to(resolved, 2)
+        list_columns = self.client.get_site_list_columns_batch(
+            {(resolved[i][0]['id'], resolved[i][1]['id']) for i in pending})
+        for i in pending:
+            site, sh_list = resolved[i]
+            raw_columns = list_columns[(site['id'], sh_list['id'])]
+            if isinstance(raw_columns, Exception):
+                resolved[i] = raw_columns
+                continue
+            self._metadata_cache.put(self._get_cache_key(lists[i]), site, sh_list, raw_columns)
+            resolved[i] = (site, sh_list, raw_columns)
+
+        for i in self._get_resolved_up_to(resolved, 3):
+            site, sh_list, raw_columns = resolved[i]
+            resolved[i] = (site, sh_list, self._process_columns(raw_columns, lists[i]))
+        return resolved
+
+    @staticmethod
+    def _get_resolved_up_to(resolved, resolved_count):
+        return [i for i, res in resolved.items() if isinstance(res, tuple) and len(res) == resolved_count]
+
+    @staticmethod
+    def _process_columns(raw_columns, lst_par):
+        # the unprocessed columns are cached and the same list may be configured more than once
+        return columns.process_list_columns(copy.deepcopy(raw_columns),
+                                            include_system=lst_par.get(KEY_LIST_INCLUDE_ADD_COLS, False),
+                                            use_display_colnames=lst_par.get(KEY_USE_DISPLAY_NAMES, True))
+
+    def _get_cache_key(self, lst_par):
+        return MetadataCache.build_key(self.cfg_params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH],
+                                       lst_par[KEY_LIST_NAME])
+
+    def _download_lists_async(self, lists, max_workers):
+        logging.info(f'Downloading {len(lists)} lists using the async engine, {max_workers} lists at a time.')
+        ignored = self._get_async_ignored_options(self.cfg_params, ASYNC_IGNORED_OPTIONS)
+        if ignored:
+            logging.warning(f'Ignoring {ignored}, not supported by the async engine.')
+        if self.cfg_params.get(KEY_RUN_REPORT):
+            logging.warning('Requests of the async engine are not recorded in the run report.')
+        try:
+            asyncio.run(self._download_lists_concurrently(lists, max_workers))
+        except BaseError as ex:
+            logging.exception(ex)
+            exit(1)
+
+    async def _download_lists_concurrently(self, lists, max_workers):
+        semaphore = asyncio.Semaphore(max_workers)
+        async_client = AsyncClient(refresh_token=self.state[STATE_REFRESH_TOKEN], client_id=self._app_key,
+                                   client_secret=self._app_secret, scope=OAUTH_APP_SCOPE,
+                                   max_connections=self.client.pool_maxsize,
+                                   rate_limiter=self.client.rate_limiter)
+        # the refresh token is rotated by the async client too
+        async_client.on_token_refresh = self._store_refresh_token
+        async with async_client:
+            await asyncio.gather(*[self._download_list_async(async_client, lst_par, semaphore)
+                                   for lst_par in lists])
+
+    async def _download_list_async(self, async_client, lst_par, semaphore):
+        """
+        Async variant of the `_download_and_finalize_list`. Lists are always downloaded fully by paged requests,
+        see `ASYNC_IGNORED_LIST_OPTIONS`.
+        """
+        params = self.cfg_params
+        async with semaphore:
+            started = time.perf_counter()
+            logging.info(
+                f'Downloading list "{lst_par[KEY_LIST_NAME]}" '
+                f'from the site: {params[KEY_BASE_HOST] + lst_par[KEY_LIST_SITE_REL_PATH]}')
+            site = await async_client.get_site_by_relative_url(params[KEY_BASE_HOST],
+                                                               lst_par[KEY_LIST_SITE_REL_PATH])
+            if not site.get('id'):
+                raise RuntimeError(f'No site with given url: {self._get_site_url(lst_par)} found.')
+
+            sh_list = await async_client.get_site_list_by_name(site['id'], lst_par[KEY_LIST_NAME])
+            if not sh_list:
+                raise RuntimeError(
+                    f'No list named "{lst_par[KEY_LIST_NAME]}" found on site : {self._get_site_url(lst_par)} .')
+
+            list_columns = await async_client.get_site_list_columns(
+                site['id'], sh_list['id'],
+                include_system=lst_par.get(KEY_LIST_INCLUDE_ADD_COLS, False),
+                use_display_colnames=lst_par.get(KEY_USE_DISPLAY_NAMES, True))
+            if lst_par.get(KEY_LIST_COLUMNS):
+                list_columns = self._filter_columns(list_columns, lst_par[KEY_LIST_COLUMNS], lst_par[KEY_LIST_NAME])
+            ignored = self._get_async_ignored_options(lst_par, ASYNC_IGNORED_LIST_OPTIONS)
+            if ignored:
+                logging.warning(f'The list "{lst_par[KEY_LIST_NAME]}" is downloaded fully by the async engine, '
+                                f'ignoring {ignored}.')
+
+            data_wr = self._create_data_writer(list_columns, lst_par)
+            select = self._get_field_projection(list_columns, lst_par)
+            try:
+                async for fl in async_client.get_site_list_fields(site['id'], sh_list['id'], select=select):
+                    self._write_list_rows(data_wr, fl, sh_list['id'])
+            finally:
+                data_wr.close()
+            with self._lock:
+                self.list_metadata_wr.write(sh_list,
+                                            user_values={result.SITE_ID: site['id'],
                                                          result.RES_TABLE_NAME: lst_par[KEY_LIST_RESULT_NAME]})
+            self._create_data_manifests(data_wr.collect_results(), lst_par.get(KEY_LIST_LOAD_MODE, False))
+            self._add_list_run(lst_par, sh_list['id'], time.perf_counter() - started)
+            logging.info(f'List "{lst_par[KEY_LIST_NAME]}" downloaded.')
+
+    @staticmethod
+    def _get_async_ignored_options(options, titles):
+        """
+        :return: titles of the enabled options not supported by the async engine, e.g. '"Page size", "Filter"'
+        """
+        # a single slice is the plain download
+        enabled = [key for key in titles if options.get(key) and not (key == KEY_LIST_SLICES and options[key] <= 1)]
+        return ', '.join(f'"{titles[key]}"' for key in enabled)
+
+    def _create_data_manifests(self, data_results, incremental):
+        # sliced tables are headless, the columns are listed in the manifest
+        sliced = [r for r in data_results if os.path.isdir(r.full_path)]
+        self.create_manifests(results=[r for r in data_results if r not in sliced], incremental=incremental)
+        self.create_manifests(results=sliced, headless=True, incremental=incremental)
+
+    def _get_site_url(self, lst_par):
+        return "/".join([self.cfg_params[KEY_BASE_HOST], lst_par[KEY_LIST_SITE_REL_PATH]])
+
+    @staticmethod
+    def _cancel_pending(futures):
+        for f in futures:
+            f.cancel()
+
+    def _collect_and_write_list(self, site_id, sh_lst, list_columns, lst_par):
+        data_wr = self._create_data_writer(list_columns, lst_par)
+        try:
+            results = self._write_list_data(site_id, sh_lst, list_columns, lst_par, data_wr)
+        finally:
+            # the files must not stay open when the download fails and is retried
+            data_wr.close()
+        # write metadata, the writer is shared by all workers
+        with self._lock:
+            self.list_metadata_wr.write(sh_lst, user_values={result.SITE_ID: site_id,
+                                                             result.RES_TABLE_NAME: lst_par[KEY_LIST_RESULT_NAME]})
+        return data_wr.collect_results() + results
 
-        data_wr.close()
+    def _write_list_data(self, site_id, sh_lst, list_columns, lst_par, data_wr):
+        """
+        Downloads the list items using the configured download mode.
+
+        :return: results of the additional tables, e.g. the deleted items or the slices
+        """
+        select = self._get_field_projection(list_columns, lst_par)
+        page_size = self._create_page_size()
+        item_filter = lst_par.get(KEY_LIST_FILTER)
+        mode = self._get_download_mode(lst_par)
+        if mode == KEY_LIST_USE_DELTA:
+            if item_filter:
+                logging.warning(f'The filter is not supported by the delta query, all changed items of the list '
+                                f'"{lst_par[KEY_LIST_NAME]}" will be downloaded.')
+            results = self._collect_and_write_list_delta(site_id, sh_lst, data_wr, lst_par, select)
+            # the delta query pages are sized by the API
+            page_size = None
+        elif mode == KEY_LIST_WATERMARK:
+            self._collect_and_write_list_watermark(site_id, sh_lst['id'], data_wr, lst_par, select, page_size)
+            results = []
+        elif mode == KEY_LIST_SLICES:
+            results = self._collect_and_write_list_sliced(site_id, sh_lst['id'], list_columns, lst_par, select,
+                                                          page_size)
+        elif mode == KEY_LIST_RESUMABLE:
+            self._collect_and_write_list_resumable(site_id, sh_lst['id'], data_wr, lst_par, select, page_size)
+            results = []
+        elif mode == KEY_STREAM_ITEMS:
+            rows = self.client.get_site_list_fields_stream(site_id, sh_lst['id'], select=select,
+                                                           page_size=page_size, filter=item_filter)
+            self._write_list_rows(data_wr, rows, sh_lst['id'])
+            results = []
+        else:
+            for fl in self.client.get_site_list_fields(site_id, sh_lst['id'], select=select, page_size=page_size,
+                                                       filter=item_filter):
+                self._write_list_rows(data_wr, fl, sh_lst['id'])
+            results = []
+        if page_size:
+            self._log_page_size(page_size, sh_lst['id'], lst_par)
+        return results
+
+    def _collect_and_write_list_resumable(self, site_id, list_id, data_wr, lst_par, select, page_size=None):
+        """
+        Downloads the list page by page. If the download fails, the link to the page following the last written
+        page is stored in the state as a checkpoint and the run continues with the rows written so far.
+        The next run resumes the download from the checkpoint. The link contains the query, so the checkpoint
+        is discarded when the selected columns or the filter change.
+        """
+        checkpoint_key = lst_par[KEY_LIST_RESULT_NAME]
+        item_filter = lst_par.get(KEY_LIST_FILTER)
+        checkpoint = self.state[STATE_CHECKPOINTS].get(checkpoint_key)
+        if checkpoint and checkpoint['list_id'] != list_id:
+            checkpoint = None
+        elif checkpoint and (checkpoint['select'] != select or checkpoint['filter'] != item_filter):
+            logging.warning(f'The columns or the filter of the list "{lst_par[KEY_LIST_NAME]}" have changed since '
+                            f'the last run, the checkpoint is discarded and the list is downloaded from the beginning.')
+            checkpoint = None
+        next_link = checkpoint['next_link'] if checkpoint else None
+        rows_written = checkpoint['rows_written'] if checkpoint else 0
+        if checkpoint:
+            logging.info(f'Resuming download of the list "{lst_par[KEY_LIST_NAME]}" from the checkpoint, '
+                         f'{rows_written} rows were downloaded by previous runs.')
+
+        pages = self.client.get_site_list_item_pages(site_id, list_id, select=select, next_link=next_link,
+                                                     page_size=page_size, filter=item_filter)
+        pages_written = 0
+        try:
+            for fields, page_next_link in pages:
+                self._write_list_rows(data_wr, fields, list_id)
+                rows_written += len(fields)
+                pages_written += 1
+                next_link = page_next_link
+        except (BaseError, requests.exceptions.RequestException) as ex:
+            if not pages_written and checkpoint and isinstance(ex, (BadRequest, Gone)):
+                logging.warning(f'The checkpoint of the list "{lst_par[KEY_LIST_NAME]}" is no longer valid, '
+                                f'downloading the list from the beginning. Reason: {ex}')
+                with self._lock:
+                    self.state[STATE_CHECKPOINTS].pop(checkpoint_key, None)
+                return self._collect_and_write_list_resumable(site_id, list_id, data_wr, lst_par, select, page_size)
+            if not pages_written:
+                # nothing downloaded in this run
+                raise
+            logging.warning(f'Download of the list "{lst_par[KEY_LIST_NAME]}" failed after {rows_written} rows, '
+                            f'the rows downloaded so far are stored and the next run will resume from the last '
+                            f'downloaded page. Reason: {ex}')
+            with self._lock:
+                self.state[STATE_CHECKPOINTS][checkpoint_key] = {'list_id': list_id,
+                                                                 'next_link': next_link,
+                                                                 'rows_written': rows_written,
+                                                                 'select': select,
+                                                                 'filter': item_filter}
+            return
+
+        logging.info(f'List "{lst_par[KEY_LIST_NAME]}" downloaded completely, {rows_written} rows in total.')
+        with self._lock:
+            self.state[STATE_CHECKPOINTS].pop(checkpoint_key, None)
+
+    def _collect_and_write_list_sliced(self, site_id, list_id, list_columns, lst_par, select, page_size=None):
+        """
+        Splits the items into ID ranges that are downloaded in parallel, each range is written as a separate slice
+        of the result table.
+        """
+        max_id = self.client.get_site_list_max_item_id(site_id, list_id)
+        if not max_id:
+            return []
+        slice_size = max_id // lst_par[KEY_LIST_SLICES] + 1
+        id_ranges = [(start, start + slice_size) for start in range(1, max_id + 1, slice_size)]
+        logging.info(f'Downloading list "{lst_par[KEY_LIST_NAME]}" in {len(id_ranges)} slices '
+                     f'of {slice_size} item IDs.')
+        with ThreadPoolExecutor(max_workers=len(id_ranges)) as executor:
+            futures = [executor.submit(self._write_list_slice, site_id, list_id, list_columns, lst_par, select,
+                                       f'part_{i:04d}', id_range, page_size)
+                       for i, id_range in enumerate(id_ranges)]
+            slice_results = [future.result() for future in futures]
+        # the slices belong to the same sliced tables
+        return list({res.file_name: res for results in slice_results for res in results}.values())
+
+    def _write_list_slice(self, site_id, list_id, list_columns, lst_par, select, slice_name, id_range,
+                          page_size=None):
+        data_wr = self._create_data_writer(list_columns, lst_par, slice_name=slice_name)
+        id_filter = f'fields/ID ge {id_range[0]} and fields/ID lt {id_range[1]}'
+        slice_filter = _combine_filters(id_filter, lst_par.get(KEY_LIST_FILTER))
+        try:
+            # the page size is shared by all slices of the list
+            for fl in self.client.get_site_list_fields(site_id, list_id, select=select, filter=slice_filter,
+                                                       page_size=page_size):
+                self._write_list_rows(data_wr, fl, list_id)
+        finally:
+            data_wr.close()
         return data_wr.collect_results()
 
+    def _collect_and_write_list_delta(self, site_id, sh_lst, data_wr, lst_par, select):
+        """
+        Writes only items changed since the last run, deleted item ids are written into a separate table.
+        Stores the new delta link in the state together with the selected fields. The delta link contains
+        the field projection of the sync that created it, so a full sync is started when the selection changes.
+        """
+        delta_key = f"{site_id}/{sh_lst['id']}"
+        stored = self.state[STATE_DELTA_LINKS].get(delta_key)
+        delta_link = None
+        if stored and stored['select'] == select:
+            delta_link = stored['delta_link']
+        elif stored:
+            logging.warning(f'The columns of the list "{lst_par[KEY_LIST_NAME]}" have changed since the last run, '
+                            f'running full sync of the list. Items deleted since the last run will not be reported.')
+        if delta_link:
+            logging.info('Downloading changes since the last run using the delta query.')
+        else:
+            logging.info('No delta token found, downloading all items using the delta query.')
+        deleted_wr = DeletedItemsResultWriter(self.tables_out_path, lst_par[KEY_LIST_RESULT_NAME])
+        try:
+            try:
+                new_delta_link = self._write_delta_pages(site_id, sh_lst['id'], data_wr, deleted_wr, delta_link,
+                                                         select)
+            except Gone:
+                if not delta_link:
+                    raise
+                logging.warning('The delta token has expired, running full resync of the list. '
+                                'Items deleted since the last run will not be reported.')
+                new_delta_link = self._write_delta_pages(site_id, sh_lst['id'], data_wr, deleted_wr, None, select)
+        finally:
+            deleted_wr.close()
+
+        with self._lock:
+            self.state[STATE_DELTA_LINKS][delta_key] = {'delta_link': new_delta_link, 'select': select}
+        return deleted_wr.collect_results()
+
+    def _collect_and_write_list_watermark(self, site_id, list_id, data_wr, lst_par, select, page_size=None):
+        """
+        Writes only items modified since the last run, i.e. items with the modification time at or after
+        the watermark. The highest modification time of the written items is stored in the state
+        as the new watermark, together with the filter. When the filter changes, all matching items
+        are downloaded again, since items that newly match may have been modified before the watermark.
+
+        If the API rejects the filter (filtering by a non-indexed column of a list over the list view threshold),
+        all items are requested and filtered by the watermark here.
+        """
+        watermark_key = f'{site_id}/{list_id}'
+        item_filter = lst_par.get(KEY_LIST_FILTER)
+        stored = self.state[STATE_WATERMARKS].get(watermark_key)
+        watermark = None
+        if stored and stored['filter'] == item_filter:
+            watermark = stored['watermark']
+        elif stored:
+            logging.info(f'The filter of the list "{lst_par[KEY_LIST_NAME]}" has changed since the last run, '
+                         f'the watermark is reset.')
+        if select is not None and WATERMARK_FIELD not in select:
+            select = select + [WATERMARK_FIELD]
+        if watermark:
+            logging.info(f'Downloading items of the list "{lst_par[KEY_LIST_NAME]}" modified since {watermark}.')
+            watermark_filter = _combine_filters(item_filter, f"fields/{WATERMARK_FIELD} ge '{watermark}'")
+        else:
+            logging.info(f'No watermark found, downloading all items of the list "{lst_par[KEY_LIST_NAME]}".')
+            watermark_filter = item_filter
+
+        pages = self.client.get_site_list_fields(site_id, list_id, select=select, filter=watermark_filter,
+                                                 page_size=page_size)
+        written = {'pages': 0, 'watermark': watermark}
+        try:
+            self._write_pages_since(data_wr, pages, list_id, None, written)
+        except (BadRequest, InternalServerError, requests.exceptions.RetryError) as ex:
+            if not watermark or written['pages']:
+                raise
+            logging.warning(f'Filtering the list "{lst_par[KEY_LIST_NAME]}" by the {WATERMARK_FIELD} column failed, '
+                            f'all items will be downloaded and filtered by the watermark. Index the column '
+                            f'to filter the items on the server. Reason: {ex}')
+            pages = self.client.get_site_list_fields(site_id, list_id, select=select, filter=item_filter,
+                                                     page_size=page_size)
+            self._write_pages_since(data_wr, pages, list_id, watermark, written)
+
+        if written['watermark']:
+            with self._lock:
+                self.state[STATE_WATERMARKS][watermark_key] = {'watermark': written['watermark'],
+                                                               'filter': item_filter}
+
+    def _write_pages_since(self, data_wr, pages, list_id, since, written):
+        """
+        Writes the pages, tracks the number of written pages and the highest modification time in `written`.
+
+        :param since: items modified before are skipped, None writes all items
+        """
+        for page in pages:
+            if since:
+                page = [fields for fields in page if (fields.get(WATERMARK_FIELD) or '') >= since]
+            self._write_list_rows(data_wr, page, list_id)
+            written['pages'] += 1
+            # ISO 8601 UTC times are ordered as strings
+            page_max = max((fields.get(WATERMARK_FIELD) or '' for fields in page), default='')
+            if page_max > (written['watermark'] or ''):
+                written['watermark'] = page_max
+
+    def _write_delta_pages(self, site_id, list_id, data_wr, deleted_wr, delta_link, select):
+        new_delta_link = None
+        delta_pages = self.client.get_site_list_items_delta(site_id, list_id, delta_link, select=select)
+        for changed, deleted, page_delta_link in delta_pages:
+            self._write_list_rows(data_wr, changed, list_id)
+            for item_id in deleted:
+                deleted_wr.write({'id': item_id}, user_values={result.LIST_ID: list_id})
+            new_delta_link = page_delta_link or new_delta_link
+        return new_delta_link
+
+    def _download_list_files(self, site_id, sh_list, lst_par):
+        """
+        Downloads files of a document library into Storage files, in parallel. Files whose eTag did not change
+        since the last run are skipped, the eTags are stored in the state.
+        """
+        if sh_list.get('list', {}).get('template') != discovery.LIST_TEMPLATE_DOCUMENT_LIBRARY:
+            logging.warning(f'The list "{lst_par[KEY_LIST_NAME]}" is not a document library, '
+                            f'there are no files to download.')
+            return
+        etags_key = f"{site_id}/{sh_list['id']}"
+        previous_etags = self.state[STATE_FILE_ETAGS].get(etags_key, {})
+        etags = {}
+        skipped = 0
+        max_workers = self.cfg_params.get(KEY_MAX_PARALLEL_DOWNLOADS) or DEFAULT_PARALLEL_DOWNLOADS
+        logging.info(f'Downloading files of the list "{lst_par[KEY_LIST_NAME]}" using {max_workers} parallel '
+                     f'downloads.')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            try:
+                for drive_items in self.client.get_site_list_drive_items(site_id, sh_list['id'],
+                                                                         page_size=self._create_page_size()):
+                    for item_id, drive_item in drive_items:
+                        if 'file' not in drive_item:
+                            # folder
+                            continue
+                        etag = drive_item.get('eTag')
+                        # files without an eTag cannot be compared and are always downloaded
+                        if etag and previous_etags.get(item_id) == etag:
+                            etags[item_id] = etag
+                            skipped += 1
+                            continue
+                        pending.add(executor.submit(self._download_file, item_id, drive_item, lst_par))
+                        # keeps the number of queued downloads bounded
+                        if len(pending) >= 2 * max_workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            etags.update(f.result() for f in done)
+                etags.update(f.result() for f in as_completed(pending))
+            except Exception:
+                self._cancel_pending(pending)
+                raise
+        with self._lock:
+            self.state[STATE_FILE_ETAGS][etags_key] = etags
+        logging.info(f'{len(etags) - skipped} files of the list "{lst_par[KEY_LIST_NAME]}" downloaded, '
+                     f'{skipped} unchanged files skipped.')
+
+    def _download_file(self, item_id, drive_item, lst_par):
+        """
+        Downloads the file into `{result table name}_{item id}_{file name}` tagged with the result table name.
+
+        :return: tuple (list item id, file eTag)
+        """
+        file_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', f"{lst_par[KEY_LIST_RESULT_NAME]}_{item_id}_{drive_item['name']}")
+        out_path = os.path.join(self.files_out_path, file_name)
+        os.makedirs(self.files_out_path, exist_ok=True)
+        self.client.download_drive_item(drive_item['parentReference']['driveId'], drive_item['id'], out_path,
+                                        size=drive_item.get('size'))
+        result.write_file_manifest(out_path, [lst_par[KEY_LIST_RESULT_NAME], 'sharepoint_file'])
+        return item_id, drive_item.get('eTag')
+
+    def _create_page_size(self):
+        """
+        Page size of the list items requests, None to use the API default.
+        """
+        size = self.cfg_params.get(KEY_PAGE_SIZE) or 0
+        adaptive = self.cfg_params.get(KEY_ADAPTIVE_PAGE_SIZE, False)
+        if not size and not adaptive:
+            return None
+        return PageSize(size or DEFAULT_ADAPTIVE_PAGE_SIZE, adaptive=adaptive)
+
+    def _log_page_size(self, page_size, list_id, lst_par):
+        if page_size.adaptive:
+            logging.info(f'List "{lst_par[KEY_LIST_NAME]}" was downloaded with the page size {page_size.size} '
+                         f'(adjusted between {page_size.smallest_used} and {page_size.largest_used}).')
+        else:
+            logging.info(f'List "{lst_par[KEY_LIST_NAME]}" was downloaded with the page size {page_size.size}.')
+        with self._lock:
+            self._page_sizes[list_id] = page_size.size
+
+    def _create_data_writer(self, list_columns, lst_par, slice_name=None):
+        """
+        Creates writer of the list data in the configured output format. Multi-value columns are written
+        into child tables if configured.
+        """
+        multi_value_columns = []
+        if lst_par.get(KEY_LIST_EXPLODE_MULTI_VALUES):
+            multi_value_columns = [c for c in list_columns if columns.is_multi_value(c)]
+            list_columns = [c for c in list_columns if not columns.is_multi_value(c)]
+
+        if self.cfg_params.get(KEY_OUTPUT_FORMAT) == FORMAT_PARQUET:
+            data_wr = ListDataParquetWriter(self.files_out_path, list_columns, lst_par[KEY_LIST_RESULT_NAME],
+                                            slice_name=slice_name)
+        elif self.cfg_params.get(KEY_OUTPUT_FORMAT) == FORMAT_CSV_GZIP:
+            slice_size = (self.cfg_params.get(KEY_SLICE_SIZE_MB) or DEFAULT_SLICE_SIZE_MB) * 1024 * 1024
+            data_wr = CompressedListDataWriter(self.tables_out_path, list_columns, lst_par[KEY_LIST_RESULT_NAME],
+                                               slice_size, slice_name=slice_name)
+        else:
+            data_wr = ListDataResultWriter(self.tables_out_path, list_columns, lst_par[KEY_LIST_RESULT_NAME],
+                                           slice_name=slice_name)
+        if not multi_value_columns:
+            return data_wr
+        value_writers = [MultiValueResultWriter(self.tables_out_path, c, lst_par[KEY_LIST_RESULT_NAME],
+                                                slice_name=slice_name)
+                         for c in multi_value_columns]
+        return ExplodedListDataWriter(data_wr, value_writers)
+
+    def _write_list_rows(self, data_wr, rows, list_id):
+        if isinstance(rows, list):
+            data_wr.write_rows(rows, user_values={result.LIST_ID: list_id})
+            row_count = len(rows)
+        else:
+            # streamed rows are counted while being written, without a per row Python call
+            counter = itertools.count()
+            data_wr.write_rows(map(operator.itemgetter(0), zip(rows, counter)), user_values={result.LIST_ID: list_id})
+            row_count = next(counter)
+        with self._lock:
+            self._rows_written[list_id] = self._rows_written.get(list_id, 0) + row_count
+
+    def _add_list_run(self, lst_par, list_id, duration):
+        with self._lock:
+            self._list_runs.append({'list_id': list_id,
+                                    'list_name': lst_par[KEY_LIST_NAME],
+                                    'site': lst_par[KEY_LIST_SITE_REL_PATH],
+                                    'result_table': lst_par[KEY_LIST_RESULT_NAME],
+                                    'duration_s': round(duration, 3)})
+
+    def _write_run_report(self, duration):
+        """
+        Writes the run report with the request metrics per endpoint, list and site into Storage files.
+        Requests of the async engine are not included.
+        """
+        list_requests = self.client.metrics.lists
+        lists = []
+        sites = {}
+        for list_run in self._list_runs:
+            list_report = {**list_run,
+                           'rows_written': self._rows_written.get(list_run['list_id'], 0),
+                           'page_size': self._page_sizes.get(list_run['list_id']),
+                           **list_requests.get(list_run['list_id'], {})}
+            lists.append(list_report)
+            site = sites.setdefault(list_run['site'], {'lists': 0, 'duration_s': 0.0, 'rows_written': 0,
+                                                       'requests': 0, 'bytes_received': 0})
+            site['lists'] += 1
+            for key in ('duration_s', 'rows_written', 'requests', 'bytes_received'):
+                site[key] += list_report.get(key, 0)
+        for site in sites.values():
+            site['duration_s'] = round(site['duration_s'], 3)
+        lists.sort(key=lambda r: r['duration_s'], reverse=True)
+
+        report = {'run_id': os.environ.get('KBC_RUNID'),
+                  'duration_s': round(duration, 3),
+                  'totals': {**self.client.metrics.totals, 'rows_written': sum(self._rows_written.values())},
+                  'throttling': self.client.rate_limiter.metrics,
+                  'connections': self.client.connection_stats,
+                  'endpoints': self.client.metrics.endpoints,
+                  'sites': sites,
+                  'lists': lists}
+        os.makedirs(self.files_out_path, exist_ok=True)
+        report_path = os.path.join(self.files_out_path, RUN_REPORT_FILE)
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        result.write_file_manifest(report_path, ['run_report'])
+        logging.info(f'Run report written to {RUN_REPORT_FILE}.')
+
+    @staticmethod
+    def _filter_columns(list_columns, column_names, list_name):
+        """
+        Keeps only columns matching the configured names. Both API and display names are matched.
+        The ID column is always kept, since it is the primary key.
+        """
+        selected = []
+        found_names = set()
+        for col in list_columns:
+            # Person columns are renamed to {name}LookupId
+            api_name = col['name'][:-len('LookupId')] if col['name'].endswith('LookupId') else col['name']
+            matches = {col['name'], api_name, col['displayName']}.intersection(column_names)
+            if matches or col['name'].lower() == 'id':
+                selected.append(col)
+                found_names.update(matches)
+        missing = [c for c in column_names if c not in found_names]
+        if missing:
+            logging.warning(f'Columns {missing} were not found in the list "{list_name}".')
+        return selected
+
+    @staticmethod
+    def _get_field_projection(list_columns, lst_par):
+        """
+        Names of fields to download. None if all fields are downloaded.
+        """
+        if lst_par.get(KEY_LIST_INCLUDE_ADD_COLS, False) and not lst_par.get(KEY_LIST_COLUMNS):
+            return None
+        return [c['name'] for c in list_columns]
+
+    def _get_download_mode(self, lst_par):
+        """
+        Selects how the list items are downloaded. Only one mode is used, enabled options overridden
+        by a mode of higher precedence are reported.
+
+        :return: key of the option of the selected mode, see `DOWNLOAD_MODE_TITLES`, None for the paged download
+        """
+        enabled = [mode for mode, used in ((KEY_LIST_USE_DELTA, self._use_delta_query(lst_par)),
+                                           (KEY_LIST_WATERMARK, self._use_watermark(lst_par)),
+                                           (KEY_LIST_SLICES, lst_par.get(KEY_LIST_SLICES, 0) > 1),
+                                           (KEY_LIST_RESUMABLE, self._use_checkpoints(lst_par)),
+                                           (KEY_STREAM_ITEMS, self.cfg_params.get(KEY_STREAM_ITEMS, False)))
+                   if used]
+        if len(enabled) > 1:
+            ignored = ', '.join(f'"{DOWNLOAD_MODE_TITLES[mode]}"' for mode in enabled[1:])
+            logging.warning(f'The list "{lst_par[KEY_LIST_NAME]}" is downloaded using the '
+                            f'"{DOWNLOAD_MODE_TITLES[enabled[0]]}" option, ignoring {ignored}.')
+        return enabled[0] if enabled else None
+
+    def _use_checkpoints(self, lst_par):
+        if not lst_par.get(KEY_LIST_RESUMABLE):
+            return False
+        if not lst_par.get(KEY_LIST_LOAD_MODE):
+            logging.warning(f'Resumable download is supported only with the Incremental Update load type, '
+                            f'list "{lst_par[KEY_LIST_NAME]}" will be downloaded without checkpoints.')
+            return False
+        return True
+
+    def _use_watermark(self, lst_par):
+        if not lst_par.get(KEY_LIST_WATERMARK):
+            return False
+        if not lst_par.get(KEY_LIST_LOAD_MODE):
+            logging.warning(f'Watermark is supported only with the Incremental Update load type, '
+                            f'list "{lst_par[KEY_LIST_NAME]}" will be downloaded fully.')
+            return False
+        return True
+
+    def _use_delta_query(self, lst_par):
+        if not lst_par.get(KEY_LIST_USE_DELTA):
+            return False
+        if not lst_par.get(KEY_LIST_LOAD_MODE):
+            logging.warning(f'Delta query is supported only with the Incremental Update load type, '
+                            f'list "{lst_par[KEY_LIST_NAME]}" will be downloaded fully.')
+            return False
+        return True
+
 
 """
         Main entrypoint
@@ -0,0 +1,112 @@
+"""
+Discovery of sites and lists to download, used instead of listing each list in the configuration.
+"""
+import fnmatch
+import logging
+import re
+from urllib.parse import urlparse
+
+PATTERN_GLOB = 'glob'
+PATTERN_REGEX = 'regex'
+
+LIST_TEMPLATE_DOCUMENT_LIBRARY = 'documentLibrary'
+ROOT_SITE_PATH = '/sites/root'
+
+
+def compile_name_matcher(pattern, pattern_type=PATTERN_GLOB):
+    """
+    Builds a case sensitive matcher of the list display names.
+
+    :param pattern: glob, e.g. `Orders*`, or a regular expression matching the whole name
+    :param pattern_type: glob or regex
+    :return: function (list name) -> bool
+    """
+    if not pattern:
+        return lambda name: True
+    if pattern_type == PATTERN_REGEX:
+        regex = re.compile(pattern)
+        return lambda name: regex.fullmatch(name) is not None
+    return lambda name: fnmatch.fnmatchcase(name, pattern)
+
+
+def get_site_path(site):
+    """
+    Relative path of the site, e.g. /sites/MySite, derived from the site web url.
+    The root site path is /sites/root.
+    """
+    return urlparse(site['webUrl']).path.rstrip('/') or ROOT_SITE_PATH
+
+
+def discover_lists(client, hostname, site_paths=None, site_search='*', name_matcher=None,
+                   include_document_libraries=False, page_size=None):
+    """
+    Finds lists of the given sites or of all sites matching the search.
+
+    :param client: ms_graph.client.Client
+    :param hostname: e.g. mytenant.sharepoint.com, sites of other hosts are skipped
+    :param site_paths: relative paths of the sites, the sites are searched for if not specified
+    :param site_search: site search keywords, `*` matches all sites
+    :param name_matcher: see `compile_name_matcher`
+    :param include_document_libraries:
+    :param page_size: ms_graph.page_size.PageSize of the site search and the lists of the sites
+    :return: list of tuples (site, site path, list) ordered by the site path and the list name
+    """
+    if site_paths:
+        sites = _get_sites_by_path(client, hostname, site_paths)
+    else:
+        sites = {}
+        for site in client.search_sites(site_search or '*', page_size=page_size):
+            if urlparse(site.get('webUrl', '')).hostname != hostname:
+                logging.debug(f'Skipping site {site.get("webUrl")} of another host.')
+                continue
+            sites[site['id']] = (site, get_site_path(site))
+    logging.info(f'Getting lists of {len(sites)} sites...')
+
+    name_matcher = name_matcher or compile_name_matcher(None)
+    site_lists = client.get_sites_lists_batch(list(sites), page_size=page_size)
+    discovered = []
+    for site_id, sh_lists in site_lists.items():
+        site, site_path = sites[site_id]
+        if isinstance(sh_lists, Exception):
+            logging.warning(f'Lists of the site {site_path} cannot be listed, skipping the site. Reason: {sh_lists}')
+            continue
+        for sh_list in sh_lists:
+            list_props = sh_list.get('list', {})
+            if list_props.get('hidden'):
+                continue
+            if list_props.get('template') == LIST_TEMPLATE_DOCUMENT_LIBRARY and not include_document_libraries:
+                continue
+            if name_matcher(sh_list['displayName']):
+                discovered.append((site, site_path, sh_list))
+    discovered.sort(key=lambda d: (d[1], d[2]['displayName'], d[2]['id']))
+    logging.info(f'Discovered {len(discovered)} lists on {len(sites)} sites.')
+    return discovered
+
+
+def _get_sites_by_path(client, hostname, site_paths):
+    sites = {}
+    for site_path, site in client.get_sites_by_relative_url_batch(hostname, site_paths).items():
+        if isinstance(site, Exception):
+            raise site
+        if not site.get('id'):
+            raise RuntimeError(f'No site with given url: {hostname}/{site_path} found.')
+        sites[site['id']] = (site, site_path)
+    return sites
+
+
+def build_table_name(site_path, list_name, used_names, list_id=''):
+    """
+    Builds a unique result table name from the site and list names, e.g. MySite_Orders.
+
+    :param site_path:
+    :param list_name:
+    :param used_names: set of already used table names, the new name is added
+    :param list_id: used to make the name unique
+    :return:
+    """
+    site_name = site_path.rstrip('/').split('/')[-1] or 'root'
+    name = re.sub(r'[^A-Za-z0-9_-]+', '_', f'{site_name}_{list_name}').strip('_')
+    if name in used_names:
+        name = f"{name}_{re.sub(r'[^A-Za-z0-9]', '', list_id)[:8]}"
+    used_names.add(name)
+    return name
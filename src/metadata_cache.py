@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+class MetadataCache:
+    """
+    Cache of resolved sites, lists and unprocessed list columns, persisted in the component state between runs.
+
+    Entries are keyed by the host, site path and list name. Entries younger than the TTL are used as they are,
+    older entries have to be validated against the current `eTag`/`lastModifiedDateTime` of the list first,
+    see `is_valid_version`.
+    """
+
+    def __init__(self, entries=None, ttl_seconds=0, time_func=time.time, columns_version=None):
+        """
+
+        :param entries: entries loaded from the state
+        :param ttl_seconds: age of an entry in seconds until it has to be validated
+        :param time_func:
+        :param columns_version: identifies the requested column properties, entries cached with
+                                a different version are dropped
+        """
+        self.ttl_seconds = ttl_seconds
+        self.columns_version = columns_version
+        self._time = time_func
+        self._entries = {key: entry for key, entry in (entries or {}).items()
+                         if entry.get('columns_version') == columns_version}
+        self._used_keys = set()
+        self._served_keys = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def build_key(hostname, site_path, list_name):
+        return f'{hostname}/{site_path.strip("/")}/{list_name}'
+
+    @property
+    def entries(self):
+        """
+        Entries of the lists used in this run, to be stored in the state. Lists no longer configured are dropped.
+        """
+        with self._lock:
+            return {key: self._entries[key] for key in self._used_keys if key in self._entries}
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: cached entry dict with keys site, list, columns or None
+        """
+        with self._lock:
+            self._used_keys.add(key)
+            return self._entries.get(key)
+
+    def is_fresh(self, entry):
+        return self._time() - entry['cached_at'] < self.ttl_seconds
+
+    @staticmethod
+    def is_valid_version(entry, sh_list):
+        """
+        Checks whether the cached list is the same version as the current list object.
+        """
+        cached_version = (entry['list'].get('eTag'), entry['list'].get('lastModifiedDateTime'))
+        return any(cached_version) and cached_version == (sh_list.get('eTag'), sh_list.get('lastModifiedDateTime'))
+
+    def put(self, key, site, sh_list, list_columns):
+        """
+        Stores the resolved metadata of the list.
+
+        :param key:
+        :param site: site object
+        :param sh_list: list object
+        :param list_columns: unprocessed column definitions
+        """
+        with self._lock:
+            self._used_keys.add(key)
+            self._entries[key] = {'site': {'id': site['id']},
+                                  'list': dict(sh_list),
+                                  'columns': list_columns,
+                                  'columns_version': self.columns_version,
+                                  'cached_at': self._time()}
+
+    def mark_served(self, key):
+        """
+        Marks the entry as used without a fresh lookup in this run, see `was_served`.
+        """
+        with self._lock:
+            self._served_keys.add(key)
+
+    def was_served(self, key):
+        with self._lock:
+            return key in self._served_keys
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._served_keys.discard(key)
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+
+import aiohttp
+from yarl import URL
+
+from ms_graph import columns, exceptions
+from ms_graph.rate_limiter import THROTTLE_STATUS_CODES
+
+
+class AsyncClient:
+    """
+    Asyncio based Graph API client. Offers the same list methods as the synchronous `ms_graph.client.Client`,
+    paged results are returned as async generators.
+
+    Usage:
+        async with AsyncClient(refresh_token, client_secret, client_id, scope) as client:
+            async for page in client.get_site_list_fields(site_id, list_id):
+                ...
+    """
+    OAUTH_LOGIN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+    MAX_RETRIES = 10
+    BASE_URL = 'https://graph.microsoft.com/v1.0/'
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, refresh_token, client_secret, client_id, scope, max_connections=100, backoff_factor=0.3,
+                 rate_limiter=None):
+        """
+
+        :param refresh_token:
+        :param client_secret:
+        :param client_id:
+        :param scope:
+        :param max_connections: max number of simultaneously open connections
+        :param backoff_factor: exponential backoff factor used when no Retry-After header is sent
+        :param rate_limiter: optional `ms_graph.rate_limiter.AdaptiveRateLimiter` pacing the requests,
+                             e.g. shared with the synchronous client
+        """
+        self.base_url = self.BASE_URL
+        self.max_connections = max_connections
+        self.backoff_factor = backoff_factor
+        self.rate_limiter = rate_limiter
+        self.__refresh_token = refresh_token
+        self.__client_secret = client_secret
+        self.__client_id = client_id
+        self.__scope = scope
+        # called with the new refresh token after each refresh, the refresh token is rotated by every refresh
+        self.on_token_refresh = None
+        self._access_token = None
+        self._session = None
+        self._refresh_lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def refresh_token(self):
+        return self.__refresh_token
+
+    async def open(self):
+        """
+        Opens the HTTP session and requests the access token.
+        """
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self._refresh_lock = asyncio.Lock()
+        try:
+            await self.request_tokens()
+        except Exception:
+            await self.close()
+            raise
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    async def request_tokens(self):
+        """
+        Requests a new access token and the rotated refresh token.
+        """
+        data = {"client_id": self.__client_id,
+                "client_secret": self.__client_secret,
+                "refresh_token": self.__refresh_token,
+                "grant_type": "refresh_token",
+                "scope": self.__scope}
+        async with self._session.post(self.OAUTH_LOGIN_URL, data=data) as resp:
+            parsed = await self._parse_response(resp, 'login')
+        self._access_token = parsed['access_token']
+        self.__refresh_token = parsed['refresh_token']
+        if self.on_token_refresh:
+            self.on_token_refresh(self.__refresh_token)
+
+    async def _get(self, url, endpoint, params=None):
+        """
+        GET request retried on throttling, server errors and connection errors. Expired access token is refreshed.
+
+        :param url: str or yarl.URL
+        :param endpoint: endpoint name used in error messages
+        :param params:
+        :return: parsed response
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            last_attempt = attempt == self.MAX_RETRIES
+            if self.rate_limiter:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            access_token = self._access_token
+            headers = {"Authorization": 'Bearer ' + access_token}
+            try:
+                async with self._session.get(url, params=params, headers=headers) as resp:
+                    if self.rate_limiter:
+                        self.rate_limiter.on_response(resp.status, resp.headers)
+                    if resp.status == 401 and not last_attempt:
+                        await self._refresh_expired_token(access_token)
+                        continue
+                    if resp.status not in self.RETRY_STATUS_CODES or last_attempt:
+                        return await self._parse_response(resp, endpoint)
+                    delay = self._get_retry_delay(resp, attempt)
+                    reason = f'status {resp.status}'
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if last_attempt:
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                reason = f'error: {ex!r}'
+            logging.debug(f'Request to {endpoint} failed with {reason}, retrying in {delay}s.')
+            await asyncio.sleep(delay)
+
+    async def _refresh_expired_token(self, expired_token):
+        async with self._refresh_lock:
+            # another request might have refreshed the token in the meantime
+            if self._access_token == expired_token:
+                await self.request_tokens()
+
+    def _get_retry_delay(self, resp, attempt):
+        if self.rate_limiter and resp.status in THROTTLE_STATUS_CODES:
+            # the rate limiter pauses all requests for the Retry-After period
+            return 0
+        retry_after = resp.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff_factor * (2 ** attempt)
+
+    async def _get_paged_result_pages(self, endpoint, parameters, start_url=None):
+        # next links are already encoded
+        next_url = URL(start_url, encoded=True) if start_url else self.base_url + endpoint
+        while next_url:
+            req_response = await self._get(next_url, endpoint, params=parameters)
+            # the next url has parameters
+            parameters = None
+            next_link = req_response.get('@odata.nextLink')
+            next_url = URL(next_link, encoded=True) if next_link else None
+            yield req_response
+
+    async def get_site_by_relative_url(self, hostname, site_path):
+        """
+
+        :param hostname: e.g. mytenant.sharepoint.com
+        :param site_path: e.g. /site/MyTeamSite
+        :return:
+        """
+        url = self.base_url + f'/sites/{hostname}:/{site_path}'
+        return await self._get(url, 'sites')
+
+    async def get_site_lists(self, site_id, filter=''):
+        endpoint = f'/sites/{site_id}/lists'
+
+        lists = []
+        async for ls in self._get_paged_result_pages(endpoint, {"$filter": filter}):
+            lists.extend(ls['value'])
+        return lists
+
+    async def get_site_list_by_name(self, site_id, list_name):
+        """
+
+        :param site_id: site id
+        :param list_name: unique list name (case sensitive)
+        :return: list object
+        """
+        lists = await self.get_site_lists(site_id, f"displayName eq '{list_name}'")
+        res_list = [ls for ls in lists if ls['displayName'] == list_name]
+
+        return res_list[0] if res_list else None
+
+    async def get_site_list_columns(self, site_id, list_id, include_system=False, use_display_colnames=True,
+                                    expand_par=columns.COLUMNS_EXPAND):
+        """
+        Gets array of columns available in the specified list.
+
+        :param site_id:
+        :param list_id:
+        :param include_system:
+        :param use_display_colnames:
+        :param expand_par:
+        :return:
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}'
+        parameters = {'expand': expand_par}
+
+        list_columns = []
+        async for ls in self._get_paged_result_pages(endpoint, parameters):
+            list_columns.extend(ls['columns'])
+
+        return columns.process_list_columns(list_columns, include_system, use_display_colnames)
+
+    async def get_site_list_fields(self, site_id, list_id, select=None):
+        """
+        Gets fields of all list items.
+
+        :param site_id:
+        :param list_id:
+        :param select: list of field (API) names to download, all fields are returned if not specified.
+        :return: async generator of item fields pages
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items'
+        params = {'expand': columns.build_fields_expand(select)}
+        async for r in self._get_paged_result_pages(endpoint, params):
+            yield [f['fields'] for f in r['value']]
+
+    async def _parse_response(self, response, endpoint):
+        status_code = response.status
+        if 'application/json' in response.headers.get('Content-Type', ''):
+            r = await response.json()
+        else:
+            r = await response.text()
+        if status_code in (200, 201, 202):
+            return r
+        elif status_code == 204:
+            return None
+        else:
+            exceptions.raise_for_status(status_code, endpoint, r)
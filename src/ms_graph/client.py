@@ -1,72 +1,188 @@
 import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import quote, urlencode
 
+import ijson
 import requests
 from kbc.client_base import HttpClientBase
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from ms_graph import exceptions
+from ms_graph import columns, exceptions
+from ms_graph.instrumentation import RequestMetrics
+from ms_graph.rate_limiter import AdaptiveRateLimiter, THROTTLE_STATUS_CODES
+
+# marks the last item in the prefetch buffer
+_END_OF_PAGES = object()
 
 
 class Client(HttpClientBase):
     OAUTH_LOGIN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
     MAX_RETRIES = 10
     BASE_URL = 'https://graph.microsoft.com/v1.0/'
-    SYSTEM_LIST_COLUMNS = ["ComplianceAssetId",
-                           "ContentType",
-                           # "Modified",
-                           # "Created",
-                           # "Author",
-                           # "Editor",
-                           "Attachments",
-                           "Edit",
-                           "LinkTitleNoMenu",
-                           "LinkTitle",
-                           "DocIcon",
-                           "ItemChildCount",
-                           "FolderChildCount",
-                           "AppAuthor",
-                           "AppEditor"]
-
-    def __init__(self, refresh_token, client_secret, client_id, scope):
+    # max number of sub-requests in a single JSON batch
+    BATCH_MAX_REQUESTS = 20
+    BATCH_RETRY_STATUS_CODES = THROTTLE_STATUS_CODES + (500, 502, 504)
+    # allows filtering and sorting by non-indexed columns
+    NON_INDEXED_QUERY_HEADER = {'Prefer': 'HonorNonIndexedQueriesWarningMayFailRandomly'}
+    # file contents are written to the disk in chunks of this size
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    # the access token is refreshed this number of seconds before it expires
+    TOKEN_REFRESH_MARGIN = 300
+    # used when the token response does not contain the expires_in
+    DEFAULT_TOKEN_LIFETIME = 3600
+    # max seconds to open a connection
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, refresh_token, client_secret, client_id, scope, page_prefetch_depth=0, pool_maxsize=10,
+                 max_requests_per_second=25, read_timeout=120, time_func=time.monotonic):
+        """
+
+        :param refresh_token:
+        :param client_secret:
+        :param client_id:
+        :param scope:
+        :param page_prefetch_depth: max number of result pages downloaded in the background ahead of the consumer.
+                                    0 downloads next page only when the current one is processed.
+        :param pool_maxsize: max number of kept-alive connections per host, should cover the number of concurrent
+                             requests.
+        :param max_requests_per_second: upper bound of the adaptive request rate shared by all threads
+        :param read_timeout: max seconds waiting for the response data, a stalled request fails with a timeout
+        :param time_func: monotonic clock used for the access token expiration
+        """
+        # throttling (429, 503) is handled by the rate limiter, urllib3 retries only connection errors and
+        # the other 5xx responses, see `requests_retry_session`
         HttpClientBase.__init__(self, base_url=self.BASE_URL, max_retries=self.MAX_RETRIES, backoff_factor=0.3,
-                                status_forcelist=(429, 503, 500, 502, 504))
-        # refresh always on init
+                                status_forcelist=(500, 502, 504))
+        self.rate_limiter = AdaptiveRateLimiter(max_rate=max_requests_per_second)
+        self.metrics = RequestMetrics()
+        self.page_prefetch_depth = page_prefetch_depth
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (self.CONNECT_TIMEOUT, read_timeout)
+        # long-lived sessions, connections are kept alive and reused by all requests
+        self._session = self._create_session()
+        self._auth_session = self._create_session()
         self.__refresh_token = refresh_token
         self.__clien_secret = client_secret
         self.__client_id = client_id
         self.__scope = scope
-        access_token, self.__refresh_token = self.request_tokens()
-        # set auth header
-        self._auth_header = {"Authorization": 'Bearer ' + access_token,
-                             "Content-Type": "application/json"}
+        self._time = time_func
+        # called with the new refresh token after each refresh, the refresh token is rotated by every refresh
+        self.on_token_refresh = None
+        # only one thread refreshes the tokens, the others wait for the result
+        self._refresh_lock = threading.Lock()
+        self._access_token = None
+        self._token_expires_at = 0
+        # refresh always on init
+        self.request_tokens()
 
     @property
     def refresh_token(self):
         return self.__refresh_token
 
-    def __response_hook(self, res, *args, **kwargs):
-        # refresh token if expired
-        if res.status_code == 401:
-            access_token, refresh_token = self.request_tokens()
-            # update auth header
-            self._auth_header = {"Authorization": 'Bearer ' + access_token,
-                                 "Content-Type": "application/json"}
-            # reset header
-            res.request.headers['Authorization'] = 'Bearer ' + access_token
-            s = requests.Session()
-            # retry request
-            return self.requests_retry_session(session=s).send(res.request)
-
     def request_tokens(self):
+        """
+        Requests a new access token and the rotated refresh token.
+        """
         data = {"client_id": self.__client_id,
                 "client_secret": self.__clien_secret,
                 "refresh_token": self.__refresh_token,
                 "grant_type": "refresh_token",
                 "scope": self.__scope}
-        r = requests.post(url=self.OAUTH_LOGIN_URL, data=data)
+        requested_at = self._time()
+        r = self._auth_session.post(url=self.OAUTH_LOGIN_URL, data=data, timeout=self.timeout)
         parsed = self._parse_response(r, 'login')
-        return parsed['access_token'], parsed['refresh_token']
+        expires_in = int(parsed.get('expires_in') or self.DEFAULT_TOKEN_LIFETIME)
+        self._token_expires_at = requested_at + max(expires_in - self.TOKEN_REFRESH_MARGIN, expires_in / 2)
+        self.__refresh_token = parsed['refresh_token']
+        self._access_token = parsed['access_token']
+        if self.on_token_refresh:
+            self.on_token_refresh(self.__refresh_token)
+
+    def _get_access_token(self):
+        """
+        Valid access token, refreshed when it is about to expire.
+        """
+        access_token = self._access_token
+        if self._time() >= self._token_expires_at:
+            self._refresh_expired_token(access_token)
+            access_token = self._access_token
+        return access_token
+
+    def _refresh_expired_token(self, expired_token):
+        with self._refresh_lock:
+            # another thread might have refreshed the token in the meantime
+            if self._access_token == expired_token:
+                logging.debug('Refreshing the access token.')
+                self.request_tokens()
+                self.metrics.record_token_refresh()
+
+    @staticmethod
+    def _get_auth_header(access_token):
+        return {"Authorization": 'Bearer ' + access_token,
+                "Content-Type": "application/json"}
+
+    def get_raw(self, url, params=None, headers=None, **kwargs):
+        """
+        GET request using the shared session. Throttled requests are retried after the Retry-After period,
+        requests rejected with 401 are retried with a refreshed access token.
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            access_token = self._get_access_token()
+            all_headers = {**self._get_auth_header(access_token), **(headers or {})}
+            start = time.perf_counter()
+            resp = self._session.get(url, params=params or {}, headers=all_headers, timeout=self.timeout, **kwargs)
+            self._record_request(resp, time.perf_counter() - start, streamed=kwargs.get('stream', False))
+            self.rate_limiter.on_response(resp.status_code, resp.headers)
+            if resp.status_code == 401 and attempt < self.MAX_RETRIES:
+                # e.g. the token was revoked before its expiration
+                resp.close()
+                self._refresh_expired_token(access_token)
+                continue
+            if resp.status_code not in THROTTLE_STATUS_CODES or attempt == self.MAX_RETRIES:
+                return resp
+            logging.debug(f'Request throttled with status {resp.status_code}, retrying.')
+
+    def _record_request(self, resp, elapsed, streamed=False):
+        # the body of a streamed response is not read yet, its size is known only from the Content-Length
+        if streamed:
+            bytes_received = int(resp.headers.get('Content-Length') or 0)
+        else:
+            bytes_received = len(resp.content)
+        self.metrics.record(resp.request.url, resp.status_code, elapsed, bytes_received, self._get_retry_count(resp))
+
+    @staticmethod
+    def _get_retry_count(resp):
+        # retries made by urllib3 on connection errors and 500, 502, 504 responses, throttled responses
+        # are retried by the callers
+        return len(getattr(getattr(resp.raw, 'retries', None), 'history', None) or ())
+
+    @property
+    def connection_stats(self):
+        """
+        Number of HTTP connections opened and of requests sent over an already open connection.
+        """
+        opened = 0
+        requests_sent = 0
+        for session in (self._session, self._auth_session):
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool:
+                        opened += pool.num_connections
+                        requests_sent += pool.num_requests
+        return {'connections_opened': opened,
+                'connections_reused': max(requests_sent - opened, 0)}
+
+    def _create_session(self):
+        session = requests.Session()
+        session.headers.update({'Connection': 'keep-alive'})
+        return self.requests_retry_session(session=session)
 
     def requests_retry_session(self, session=None):
         session = session or requests.Session()
@@ -76,23 +192,34 @@ class Client(HttpClientBase):
             connect=self.max_retries,
             backoff_factor=self.backoff_factor,
             status_forcelist=self.status_forcelist,
-            method_whitelist=('GET', 'POST', 'PATCH', 'UPDATE')
+            method_whitelist=('GET', 'POST', 'PATCH', 'UPDATE'),
+            # urllib3 would retry throttled responses with the Retry-After header before the rate limiter sees them
+            respect_retry_after_header=False
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=self.pool_maxsize)
         session.mount('http://', adapter)
         session.mount('https://', adapter)
-        # append response hook
-        session.hooks['response'].append(self.__response_hook)
         return session
 
-    def _get_paged_result_pages(self, endpoint, parameters):
+    def _get_paged_result_pages(self, endpoint, parameters, start_url=None, headers=None, page_size=None):
+        pages = self._iterate_result_pages(endpoint, parameters, start_url, headers, page_size)
+        if self.page_prefetch_depth > 0:
+            pages = self._prefetch_pages(pages, self.page_prefetch_depth)
+        return pages
+
+    def _iterate_result_pages(self, endpoint, parameters, start_url=None, headers=None, page_size=None):
 
         has_more = True
-        next_url = self.base_url + endpoint
+        next_url = start_url or self.base_url + endpoint
         while has_more:
 
-            resp = self.get_raw(next_url, params=parameters)
+            resp = self._get_page(next_url, parameters, headers, page_size)
+            if resp is None:
+                # failed, retry with a smaller page
+                continue
             req_response = self._parse_response(resp, endpoint)
+            if page_size:
+                page_size.on_page(resp.elapsed.total_seconds(), len(resp.content), self._get_retry_count(resp))
 
             if req_response.get('@odata.nextLink'):
                 has_more = True
@@ -104,6 +231,52 @@ class Client(HttpClientBase):
 
             yield req_response
 
+    @staticmethod
+    def _prefetch_pages(pages, depth):
+        """
+        Downloads the pages in a background thread while the consumer processes the current one.
+        At most `depth` pages are kept in the buffer so the memory stays bounded.
+
+        :param pages: page generator
+        :param depth: max number of buffered pages
+        :return: generator of pages
+        """
+        page_buffer = queue.Queue(maxsize=depth)
+        stopped = threading.Event()
+
+        def put(item):
+            # give up when the consumer stops reading
+            while not stopped.is_set():
+                try:
+                    page_buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for page in pages:
+                    if not put((page, None)):
+                        return
+            except Exception as e:
+                put((None, e))
+                return
+            put((_END_OF_PAGES, None))
+
+        producer = threading.Thread(target=produce, name='page-prefetch', daemon=True)
+        producer.start()
+        try:
+            while True:
+                page, error = page_buffer.get()
+                if error:
+                    raise error
+                if page is _END_OF_PAGES:
+                    return
+                yield page
+        finally:
+            stopped.set()
+
     def get_site_by_relative_url(self, hostname, site_path):
         """
 
@@ -115,11 +288,171 @@ class Client(HttpClientBase):
         resp = self._parse_response(self.get_raw(url), 'sites')
         return resp
 
-    def get_site_lists(self, site_id, filter=''):
+    def search_sites(self, query='*', page_size=None):
+        """
+        Searches sites the user has access to.
+
+        :param query: search keywords, `*` returns all sites
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :return: generator of site objects
+        """
+        for page in self._get_paged_result_pages('/sites', {'search': query}, page_size=page_size):
+            yield from page['value']
+
+    def get_sites_by_relative_url_batch(self, hostname, site_paths):
+        """
+        Batch variant of the `get_site_by_relative_url`.
+
+        :param hostname: e.g. mytenant.sharepoint.com
+        :param site_paths: list of site paths e.g. /site/MyTeamSite
+        :return: dict {site path: site}, failed lookups have the exception as a value
+        """
+        urls = {path: f"/sites/{hostname}:/{path.lstrip('/')}" for path in site_paths}
+        return self.batch_get(urls)
+
+    def get_site_lists_by_name_batch(self, site_list_names):
+        """
+        Batch variant of the `get_site_list_by_name`.
+
+        :param site_list_names: list of tuples (site id, list name)
+        :return: dict {(site id, list name): list object or None}, failed lookups have the exception as a value
+        """
+        urls = {}
+        for site_id, list_name in site_list_names:
+            query = urlencode({'$filter': f"displayName eq '{list_name}'"}, quote_via=quote)
+            urls[(site_id, list_name)] = f'/sites/{site_id}/lists?{query}'
+
+        results = self.batch_get(urls)
+        for (site_id, list_name), res in results.items():
+            if not isinstance(res, exceptions.BaseError):
+                res_list = [ls for ls in res['value'] if ls['displayName'] == list_name]
+                results[(site_id, list_name)] = res_list[0] if res_list else None
+        return results
+
+    def get_sites_lists_batch(self, site_ids, page_size=None):
+        """
+        Gets all lists of multiple sites, the first page of each site is requested using batch requests.
+
+        :param site_ids: list of site ids
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :return: dict {site id: list of list objects}, failed lookups have the exception as a value
+        """
+        urls = {}
+        for site_id in site_ids:
+            urls[site_id] = f'/sites/{site_id}/lists'
+            if page_size:
+                urls[site_id], _ = page_size.apply(urls[site_id], None)
+        results = self.batch_get(urls)
+        for site_id, res in results.items():
+            if isinstance(res, exceptions.BaseError):
+                continue
+            site_lists = res['value']
+            if res.get('@odata.nextLink'):
+                for page in self._get_paged_result_pages(f'/sites/{site_id}/lists', None,
+                                                         start_url=res['@odata.nextLink'], page_size=page_size):
+                    site_lists.extend(page['value'])
+            results[site_id] = site_lists
+        return results
+
+    def get_site_lists_batch(self, site_list_ids):
+        """
+        Batch variant of the `get_site_list`.
+
+        :param site_list_ids: list of tuples (site id, list id)
+        :return: dict {(site id, list id): list object}, failed lookups have the exception as a value
+        """
+        return self.batch_get({(site_id, list_id): f'/sites/{site_id}/lists/{list_id}'
+                               for site_id, list_id in site_list_ids})
+
+    def get_site_list_columns_batch(self, site_list_ids, expand_par=columns.COLUMNS_EXPAND):
+        """
+        Gets unprocessed column definitions of multiple lists, see `columns.process_list_columns`.
+
+        :param site_list_ids: list of tuples (site id, list id)
+        :param expand_par:
+        :return: dict {(site id, list id): columns}, failed lookups have the exception as a value
+        """
+        query = urlencode({'expand': expand_par}, quote_via=quote)
+        urls = {(site_id, list_id): f'/sites/{site_id}/lists/{list_id}?{query}' for site_id, list_id in site_list_ids}
+        results = self.batch_get(urls)
+        for key, res in results.items():
+            if not isinstance(res, exceptions.BaseError):
+                results[key] = res['columns']
+        return results
+
+    def batch_get(self, urls):
+        """
+        Sends GET requests packed in JSON batches of up to 20 sub-requests. Throttled and failed sub-requests
+        are retried in following batches.
+
+        :param urls: dict {key: url relative to the API version, e.g. /sites/root}
+        :return: dict {key: parsed response body}, failed requests have the exception as a value
+        """
+        keys = list(urls)
+        pending = {str(i): urls[key] for i, key in enumerate(keys)}
+        responses = {}
+        for attempt in range(self.MAX_RETRIES + 1):
+            retry = {}
+            retry_delay = 0
+            request_ids = list(pending)
+            for i in range(0, len(request_ids), self.BATCH_MAX_REQUESTS):
+                batch = [{'id': request_id, 'method': 'GET', 'url': pending[request_id]}
+                         for request_id in request_ids[i:i + self.BATCH_MAX_REQUESTS]]
+                resp = self._post_batch(batch)
+                for sub_response in self._parse_response(resp, '$batch')['responses']:
+                    request_id = sub_response['id']
+                    status_code = sub_response['status']
+                    if status_code in self.BATCH_RETRY_STATUS_CODES and attempt < self.MAX_RETRIES:
+                        retry[request_id] = pending[request_id]
+                        if status_code in THROTTLE_STATUS_CODES:
+                            # the wait is done by the rate limiter
+                            self.rate_limiter.on_response(status_code, sub_response.get('headers', {}))
+                        else:
+                            retry_delay = max(retry_delay, self.backoff_factor * (2 ** attempt))
+                    else:
+                        responses[request_id] = self._parse_batch_response(sub_response, pending[request_id])
+            if not retry:
+                break
+            logging.debug(f'{len(retry)} batch requests failed, retrying in {retry_delay}s.')
+            time.sleep(retry_delay)
+            pending = retry
+        return {key: responses[str(i)] for i, key in enumerate(keys)}
+
+    def _post_batch(self, batch):
+        """
+        Sends the JSON batch, the whole batch is retried when throttled or rejected with 401, see `get_raw`.
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            access_token = self._get_access_token()
+            start = time.perf_counter()
+            resp = self._session.post(self.base_url + '$batch', json={'requests': batch},
+                                      headers=self._get_auth_header(access_token), timeout=self.timeout)
+            self._record_request(resp, time.perf_counter() - start)
+            self.rate_limiter.on_response(resp.status_code, resp.headers)
+            if resp.status_code == 401 and attempt < self.MAX_RETRIES:
+                self._refresh_expired_token(access_token)
+                continue
+            if resp.status_code not in THROTTLE_STATUS_CODES or attempt == self.MAX_RETRIES:
+                return resp
+            logging.debug(f'Batch request throttled with status {resp.status_code}, retrying.')
+
+    @staticmethod
+    def _parse_batch_response(sub_response, url):
+        status_code = sub_response['status']
+        body = sub_response.get('body')
+        if 200 <= status_code < 300:
+            return body
+        try:
+            exceptions.raise_for_status(status_code, url, body or {})
+        except exceptions.BaseError as e:
+            return e
+
+    def get_site_lists(self, site_id, filter='', page_size=None):
         endpoint = f'/sites/{site_id}/lists'
 
         lists = []
-        for ls in self._get_paged_result_pages(endpoint, {"$filter": filter}):
+        for ls in self._get_paged_result_pages(endpoint, {"$filter": filter}, page_size=page_size):
             lists.extend(ls['value'])
         return lists
 
@@ -135,8 +468,18 @@ class Client(HttpClientBase):
 
         return res_list[0] if res_list else None
 
+    def get_site_list(self, site_id, list_id):
+        """
+
+        :param site_id: site id
+        :param list_id: list id
+        :return: list object
+        """
+        url = self.base_url + f'/sites/{site_id}/lists/{list_id}'
+        return self._parse_response(self.get_raw(url), 'lists')
+
     def get_site_list_columns(self, site_id, list_id, include_system=False, use_display_colnames=True,
-                              expand_par='columns(select=name, description, displayName, personOrGroup)'):
+                              expand_par=columns.COLUMNS_EXPAND):
         """
         Gets array of columns available in the specified list.
 
@@ -147,36 +490,254 @@ class Client(HttpClientBase):
         :param expand_par:
         :return:
         """
+        list_columns = self.get_site_list_column_definitions(site_id, list_id, expand_par)
+        return columns.process_list_columns(list_columns, include_system, use_display_colnames)
+
+    def get_site_list_column_definitions(self, site_id, list_id, expand_par=columns.COLUMNS_EXPAND):
+        """
+        Gets unprocessed column definitions of the list, see `columns.process_list_columns`.
+
+        :param site_id:
+        :param list_id:
+        :param expand_par:
+        :return: list of column definitions
+        """
         endpoint = f'/sites/{site_id}/lists/{list_id}'
         parameters = {'expand': expand_par}
 
-        columns = []
+        list_columns = []
         for ls in self._get_paged_result_pages(endpoint, parameters):
-            columns.extend(ls['columns'])
+            list_columns.extend(ls['columns'])
+        return list_columns
 
-        if not include_system:
-            columns = [c for c in columns if
-                       c['name'] not in self.SYSTEM_LIST_COLUMNS and not c['name'].startswith('_')]
+    def get_site_list_fields(self, site_id, list_id, select=None, filter=None, page_size=None):
+        """
+        Gets fields of all list items.
 
-        # convert Person type to lookupIds
-        for col in columns:
-            if col.get('personOrGroup') and not col.get('personOrGroup').get('allowMultipleSelection'):
-                col['name'] = col['name'] + 'LookupId'
+        :param site_id:
+        :param list_id:
+        :param select: list of field (API) names to download, all fields are returned if not specified.
+        :param filter: OData filter of the items, e.g. fields/ID ge 100. Filtering by non-indexed columns is allowed,
+                       but it may fail on large lists.
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :return: generator of item fields pages
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items'
+        params, headers = self._get_items_query(select, filter)
+        for r in self._get_paged_result_pages(endpoint, params, headers=headers, page_size=page_size):
+            yield [f['fields'] for f in r['value']]
 
-        if use_display_colnames:
-            logging.info('Using display column names.')
-            self._dedupe_header(columns)
-        else:
-            logging.info('Using unique API column names.')
-            # use api names as display - already unique
-            self._name_as_display_names(columns)
-        return columns
+    def get_site_list_item_pages(self, site_id, list_id, select=None, next_link=None, page_size=None, filter=None):
+        """
+        Gets fields of all list items page by page together with the link to the following page,
+        so that an interrupted download may be resumed.
 
-    def get_site_list_fields(self, site_id, list_id):
+        :param site_id:
+        :param list_id:
+        :param select: list of field (API) names to download, all fields are returned if not specified.
+        :param next_link: @odata.nextLink to resume the download from, the link already contains the query.
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :param filter: OData filter of the items, see `get_site_list_fields`
+        :return: generator of tuples (item fields page, link to the following page or None for the last page)
+        """
         endpoint = f'/sites/{site_id}/lists/{list_id}/items'
-        params = {'expand': 'fields'}
-        for r in self._get_paged_result_pages(endpoint, params):
-            yield [f['fields'] for f in r['value']]
+        params, headers = self._get_items_query(select, filter)
+        if next_link:
+            params = {}
+        for r in self._get_paged_result_pages(endpoint, params, start_url=next_link, headers=headers,
+                                              page_size=page_size):
+            yield [f['fields'] for f in r['value']], r.get('@odata.nextLink')
+
+    def get_site_list_max_item_id(self, site_id, list_id):
+        """
+        Gets the highest item ID of the list.
+
+        :param site_id:
+        :param list_id:
+        :return: int, 0 if the list is empty
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items'
+        params = {'expand': 'fields(select=ID)', '$orderby': 'fields/ID desc', '$top': 1}
+        resp = self._parse_response(self.get_raw(self.base_url + endpoint, params=params,
+                                                 headers=self.NON_INDEXED_QUERY_HEADER), endpoint)
+        return int(resp['value'][0]['id']) if resp['value'] else 0
+
+    def get_site_list_fields_stream(self, site_id, list_id, select=None, page_size=None, filter=None):
+        """
+        Streaming variant of the `get_site_list_fields`. Item fields are parsed incrementally from the response body
+        and returned one by one, so only a single item is held in memory regardless of the page size.
+
+        :param site_id:
+        :param list_id:
+        :param select: list of field (API) names to download, all fields are returned if not specified.
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :param filter: OData filter of the items, see `get_site_list_fields`
+        :return: generator of item fields
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items'
+        params, headers = self._get_items_query(select, filter)
+        for item in self._stream_result_items(endpoint, params, headers=headers, page_size=page_size):
+            yield item['fields']
+
+    def _get_items_query(self, select=None, filter=None):
+        """
+        Query parameters and headers of the list items requests.
+
+        :return: tuple (parameters, headers)
+        """
+        params = {'expand': columns.build_fields_expand(select)}
+        if not filter:
+            return params, None
+        params['$filter'] = filter
+        return params, self.NON_INDEXED_QUERY_HEADER
+
+    def _get_page(self, url, parameters, headers=None, page_size=None, **kwargs):
+        """
+        Requests a result page of the current page size.
+
+        :return: response or None if the request failed and should be retried with the reduced page size
+        """
+        if page_size:
+            url, parameters = page_size.apply(url, parameters)
+        try:
+            return self.get_raw(url, params=parameters, headers=headers, **kwargs)
+        except (requests.exceptions.RetryError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as ex:
+            # e.g. the server timed out preparing a large page
+            if not page_size or not page_size.on_error():
+                raise
+            logging.warning(f'Request of a result page failed, retrying with page size {page_size.size}. '
+                            f'Reason: {ex}')
+            return None
+
+    def _stream_result_items(self, endpoint, parameters, start_url=None, headers=None, page_size=None):
+        """
+        Iterates items of the `value` array of all result pages without loading the whole pages.
+        """
+        next_url = start_url or self.base_url + endpoint
+        while next_url:
+            resp = self._get_page(next_url, parameters, headers=headers, page_size=page_size, stream=True)
+            if resp is None:
+                continue
+            # the next url has parameters
+            parameters = {}
+            try:
+                if resp.status_code != 200 or 'application/json' not in resp.headers.get('Content-Type', ''):
+                    # not a result page, reads the whole body and raises
+                    self._parse_response(resp, endpoint)
+                    return
+                if page_size:
+                    page_size.on_page(resp.elapsed.total_seconds(), int(resp.headers.get('Content-Length') or 0),
+                                      self._get_retry_count(resp))
+                links = {}
+                # let urllib3 decompress the gzipped body
+                resp.raw.decode_content = True
+                yield from self._parse_items_stream(resp.raw, links)
+                next_url = links.get('@odata.nextLink')
+            finally:
+                resp.close()
+
+    @staticmethod
+    def _parse_items_stream(stream, links):
+        """
+        Parses items of the `value` array one by one.
+
+        :param stream: file-like response body
+        :param links: dict filled with the top level @odata links of the page
+        :return: generator of items
+        """
+        builder = None
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == 'value.item' and event == 'end_map':
+                    yield builder.value
+                    builder = None
+            elif prefix == 'value.item' and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix.startswith('@odata.') and event == 'string':
+                links[prefix] = value
+
+    def get_site_list_items_delta(self, site_id, list_id, delta_link=None, select=None):
+        """
+        Gets list items changed since the state represented by the delta link. All items are returned
+        when no delta link is specified.
+
+        :param site_id:
+        :param list_id:
+        :param delta_link: @odata.deltaLink returned by the previous sync
+        :param select: list of field (API) names to download, all fields are returned if not specified.
+                       Ignored when the delta link is specified, the link already contains the query.
+        :return: generator of tuples (changed item fields, deleted item ids, delta link).
+                 The delta link is present only in the last page.
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items/delta'
+        params = {} if delta_link else {'expand': columns.build_fields_expand(select)}
+        for r in self._get_paged_result_pages(endpoint, params, start_url=delta_link):
+            changed = []
+            deleted = []
+            for item in r['value']:
+                if 'deleted' in item or '@removed' in item:
+                    deleted.append(item['id'])
+                else:
+                    changed.append(item['fields'])
+            yield changed, deleted, r.get('@odata.deltaLink')
+
+    def get_site_list_drive_items(self, site_id, list_id, page_size=None):
+        """
+        Gets drive items (files and folders) of all items of a document library.
+
+        :param site_id:
+        :param list_id:
+        :param page_size: ms_graph.page_size.PageSize, the API default page size is used if not specified
+        :return: generator of pages of tuples (list item id, drive item)
+        """
+        endpoint = f'/sites/{site_id}/lists/{list_id}/items'
+        params = {'expand': 'driveItem', '$select': 'id'}
+        for r in self._get_paged_result_pages(endpoint, params, page_size=page_size):
+            yield [(item['id'], item['driveItem']) for item in r['value'] if item.get('driveItem')]
+
+    def download_drive_item(self, drive_id, item_id, out_path, size=None):
+        """
+        Downloads the file content, streamed to the disk in chunks. The content is written into `{out_path}.part`
+        that is renamed when complete. A broken download is resumed by a Range request from the downloaded size.
+
+        :param drive_id:
+        :param item_id: drive item id
+        :param out_path: path of the downloaded file
+        :param size: expected file size in bytes, if known
+        """
+        endpoint = f'/drives/{drive_id}/items/{item_id}/content'
+        part_path = out_path + '.part'
+        for attempt in range(self.MAX_RETRIES + 1):
+            downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f'bytes={downloaded}-'} if downloaded else None
+            try:
+                # the content url redirects to a pre-authenticated download url
+                resp = self.get_raw(self.base_url + endpoint, headers=headers, stream=True)
+                with resp:
+                    if resp.status_code == 416:
+                        # nothing left to download
+                        break
+                    if resp.status_code not in (200, 206):
+                        self._parse_response(resp, endpoint)
+                    # the whole file is returned if the server does not support ranges
+                    with open(part_path, 'ab' if resp.status_code == 206 else 'wb') as out:
+                        for chunk in resp.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                            out.write(chunk)
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as ex:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                logging.warning(f'Download of the file {os.path.basename(out_path)} was interrupted, resuming. '
+                                f'Reason: {ex}')
+                continue
+            if size is None or os.path.getsize(part_path) >= size:
+                break
+        else:
+            raise RuntimeError(f'Download of the file {os.path.basename(out_path)} is incomplete, '
+                               f'{os.path.getsize(part_path)} of {size} bytes downloaded.')
+        os.replace(part_path, out_path)
 
     def _parse_response(self, response, endpoint):
         status_code = response.status_code
@@ -188,64 +749,5 @@ class Client(HttpClientBase):
             return r
         elif status_code == 204:
             return None
-        elif status_code == 400:
-            raise exceptions.BadRequest(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 401:
-            raise exceptions.Unauthorized(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 403:
-            raise exceptions.Forbidden(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 404:
-            raise exceptions.NotFound(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 405:
-            raise exceptions.MethodNotAllowed(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 406:
-            raise exceptions.NotAcceptable(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 409:
-            raise exceptions.Conflict(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 410:
-            raise exceptions.Gone(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 411:
-            raise exceptions.LengthRequired(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 412:
-            raise exceptions.PreconditionFailed(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 413:
-            raise exceptions.RequestEntityTooLarge(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 415:
-            raise exceptions.UnsupportedMediaType(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 416:
-            raise exceptions.RequestedRangeNotSatisfiable(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 422:
-            raise exceptions.UnprocessableEntity(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 429:
-            raise exceptions.TooManyRequests(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 500:
-            raise exceptions.InternalServerError(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 501:
-            raise exceptions.NotImplemented(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 503:
-            raise exceptions.ServiceUnavailable(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 504:
-            raise exceptions.GatewayTimeout(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 507:
-            raise exceptions.InsufficientStorage(f'Calling endpoint {endpoint} failed', r)
-        elif status_code == 509:
-            raise exceptions.BandwidthLimitExceeded(f'Calling endpoint {endpoint} failed', r)
         else:
-            raise exceptions.UnknownError(f'Calling endpoint {endpoint} failed', r)
-
-    def _dedupe_header(self, columns):
-        col_keys = dict()
-        dup_headers = set()
-        for col in columns:
-            if col['displayName'] in col_keys:
-                dup_headers.add(col['displayName'])
-                col['displayName'] = col['displayName'] + '_' + col['name']
-            else:
-                col_keys[col['displayName']] = col
-        # update first value names as well
-        for c in dup_headers:
-            col_keys[c]['displayName'] = col_keys[c]['displayName'] + '_' + col_keys[c]['name']
-
-    def _name_as_display_names(self, columns):
-        for col in columns:
-            col['displayName'] = col['name']
+            exceptions.raise_for_status(status_code, endpoint, r)
@@ -0,0 +1,121 @@
+"""
+List column definitions processing shared by the sync and async clients.
+"""
+import logging
+
+SYSTEM_LIST_COLUMNS = ["ComplianceAssetId",
+                       "ContentType",
+                       # "Modified",
+                       # "Created",
+                       # "Author",
+                       # "Editor",
+                       "Attachments",
+                       "Edit",
+                       "LinkTitleNoMenu",
+                       "LinkTitle",
+                       "DocIcon",
+                       "ItemChildCount",
+                       "FolderChildCount",
+                       "AppAuthor",
+                       "AppEditor"]
+
+COLUMNS_EXPAND = ('columns(select=name, description, displayName, personOrGroup, boolean, choice, currency, '
+                  'dateTime, lookup, number)')
+
+COLUMN_TYPE_STRING = 'string'
+COLUMN_TYPE_INTEGER = 'integer'
+COLUMN_TYPE_NUMBER = 'number'
+COLUMN_TYPE_BOOLEAN = 'boolean'
+COLUMN_TYPE_DATETIME = 'dateTime'
+# columns of these types always contain a single value
+SCALAR_COLUMN_TYPES = (COLUMN_TYPE_INTEGER, COLUMN_TYPE_NUMBER, COLUMN_TYPE_BOOLEAN, COLUMN_TYPE_DATETIME)
+
+
+def process_list_columns(columns, include_system=False, use_display_colnames=True):
+    """
+    Filters system columns and resolves unique result column names (displayName) of the list columns.
+
+    :param columns: column definitions as returned by the API
+    :param include_system:
+    :param use_display_colnames:
+    :return: list of columns
+    """
+    if not include_system:
+        columns = [c for c in columns if
+                   c['name'] not in SYSTEM_LIST_COLUMNS and not c['name'].startswith('_')]
+
+    # convert Person type to lookupIds
+    for col in columns:
+        if col.get('personOrGroup') and not col.get('personOrGroup').get('allowMultipleSelection'):
+            col['name'] = col['name'] + 'LookupId'
+
+    if use_display_colnames:
+        logging.info('Using display column names.')
+        _dedupe_header(columns)
+    else:
+        logging.info('Using unique API column names.')
+        # use api names as display - already unique
+        _name_as_display_names(columns)
+    return columns
+
+
+def get_column_type(col):
+    """
+    Type of the column values based on the column type facet, see COLUMN_TYPE_* constants.
+    Values of the other columns (text, choice, lookup, ...) are strings, multi-value columns and columns
+    with object values (e.g. hyperlink) contain JSON.
+
+    :param col: processed column definition
+    :return:
+    """
+    if col['name'] == 'ID' or (col.get('personOrGroup') and col['name'].endswith('LookupId')):
+        return COLUMN_TYPE_INTEGER
+    if 'number' in col or 'currency' in col:
+        return COLUMN_TYPE_NUMBER
+    if 'boolean' in col:
+        return COLUMN_TYPE_BOOLEAN
+    if 'dateTime' in col:
+        return COLUMN_TYPE_DATETIME
+    return COLUMN_TYPE_STRING
+
+
+def is_multi_value(col):
+    """
+    Checks whether the column is a multiple choice, multi-value lookup or multi-value person column.
+    """
+    return bool(col.get('personOrGroup', {}).get('allowMultipleSelection')
+                or col.get('lookup', {}).get('allowMultipleValues')
+                or col.get('choice', {}).get('displayAs') == 'checkBoxes')
+
+
+def build_fields_expand(select=None):
+    """
+    Builds the item fields expand parameter.
+
+    :param select: list of field (API) names to download, all fields are returned if not specified.
+    :return:
+    """
+    if not select:
+        return 'fields'
+    # id is always needed to identify the item
+    select_names = ['id'] + [name for name in select if name.lower() != 'id']
+    return f"fields(select={','.join(select_names)})"
+
+
+def _dedupe_header(columns):
+    col_keys = dict()
+    dup_headers = set()
+    for col in columns:
+        if col['displayName'] in col_keys:
+            dup_headers.add(col['displayName'])
+            col['displayName'] = col['displayName'] + '_' + col['name']
+        else:
+            col_keys[col['displayName']] = col
+    # update first value names as well
+    for c in dup_headers:
+        col_keys[c]['displayName'] = col_keys[c]['displayName'] + '_' + col_keys[c]['name']
+
+
+def _name_as_display_names(columns):
+    for col in columns:
+        col['displayName'] = col['name']
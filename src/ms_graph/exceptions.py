@@ -113,3 +113,40 @@ class InsufficientStorage(BaseError):
 
 class BandwidthLimitExceeded(BaseError):
     pass
+
+
+STATUS_CODE_ERRORS = {400: BadRequest,
+                      401: Unauthorized,
+                      403: Forbidden,
+                      404: NotFound,
+                      405: MethodNotAllowed,
+                      406: NotAcceptable,
+                      409: Conflict,
+                      410: Gone,
+                      411: LengthRequired,
+                      412: PreconditionFailed,
+                      413: RequestEntityTooLarge,
+                      415: UnsupportedMediaType,
+                      416: RequestedRangeNotSatisfiable,
+                      422: UnprocessableEntity,
+                      429: TooManyRequests,
+                      500: InternalServerError,
+                      501: NotImplemented,
+                      503: ServiceUnavailable,
+                      504: GatewayTimeout,
+                      507: InsufficientStorage,
+                      509: BandwidthLimitExceeded}
+
+
+def raise_for_status(status_code, endpoint, error_obj):
+    """
+    Raises error matching the status code of a failed response.
+
+    :param status_code: HTTP status code
+    :param endpoint: called endpoint, used in the message
+    :param error_obj: parsed response body
+    """
+    if not isinstance(error_obj, dict):
+        error_obj = {"error": error_obj}
+    error_class = STATUS_CODE_ERRORS.get(status_code, UnknownError)
+    raise error_class(f'Calling endpoint {endpoint} failed', error_obj)
@@ -0,0 +1,126 @@
+import re
+import threading
+from urllib.parse import urlsplit
+
+from ms_graph.rate_limiter import THROTTLE_STATUS_CODES
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_LIST_URL = re.compile(r'/lists/([^/?]+)')
+_ENDPOINT_IDS = ((re.compile(r'/{2,}'), '/'),
+                 # site id or path addressing, e.g. /sites/host:/sites/MySite or /sites/host:/sites/MySite:/lists
+                 (re.compile(r'/sites/[^/:]+(:/[^:]*:?)?'), '/sites/{site}'),
+                 (re.compile(r'/lists/[^/?]+'), '/lists/{list}'),
+                 (re.compile(r'/items/(?!delta)[^/?]+'), '/items/{item}'))
+
+
+class RequestMetrics:
+    """
+    Collects metrics of the API requests of all threads: latency histograms, received bytes, urllib3 retries
+    and throttled responses per endpoint, requests per list and the number of access token refreshes.
+
+    Endpoints are identified by the URL path with the ids replaced by placeholders, e.g. /sites/{site}/lists/{list}.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._lists = {}
+        self.token_refreshes = 0
+
+    def record(self, url, status_code, elapsed, bytes_received, retries=0):
+        """
+
+        :param url: request url
+        :param status_code: status code of the final response
+        :param elapsed: seconds from sending the request until the response was received, including retries
+        :param bytes_received: size of the response body
+        :param retries: number of retries made by the HTTP adapter
+        """
+        path = urlsplit(url).path
+        endpoint = get_endpoint_template(path)
+        list_match = _LIST_URL.search(path)
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'requests': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'bytes_received': 0,
+                    'latency_ms': {'total': 0.0, 'max': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)}}
+            stats['requests'] += 1
+            stats['retries'] += retries
+            stats['bytes_received'] += bytes_received
+            if status_code in THROTTLE_STATUS_CODES:
+                stats['throttled'] += 1
+            elif status_code >= 400:
+                stats['errors'] += 1
+            latency = stats['latency_ms']
+            latency['total'] += elapsed_ms
+            latency['max'] = max(latency['max'], elapsed_ms)
+            latency['histogram'][_get_bucket(elapsed_ms)] += 1
+
+            if list_match:
+                list_stats = self._lists.setdefault(list_match.group(1),
+                                                    {'requests': 0, 'bytes_received': 0, 'request_time_s': 0.0})
+                list_stats['requests'] += 1
+                list_stats['bytes_received'] += bytes_received
+                list_stats['request_time_s'] += elapsed
+
+    def record_token_refresh(self):
+        with self._lock:
+            self.token_refreshes += 1
+
+    @property
+    def endpoints(self):
+        """
+        Metrics per endpoint, the latency histogram is a dict {bucket upper bound in ms: count}.
+        """
+        with self._lock:
+            report = {}
+            for endpoint, stats in self._endpoints.items():
+                latency = stats['latency_ms']
+                report[endpoint] = {**stats,
+                                    'latency_ms': {'avg': round(latency['total'] / stats['requests'], 1),
+                                                   'max': round(latency['max'], 1),
+                                                   'histogram': _format_histogram(latency['histogram'])}}
+            return report
+
+    @property
+    def lists(self):
+        """
+        Metrics of the requests per list id.
+        """
+        with self._lock:
+            return {list_id: {**stats, 'request_time_s': round(stats['request_time_s'], 3)}
+                    for list_id, stats in self._lists.items()}
+
+    @property
+    def totals(self):
+        with self._lock:
+            return {'requests': sum(s['requests'] for s in self._endpoints.values()),
+                    'retries': sum(s['retries'] for s in self._endpoints.values()),
+                    'throttled': sum(s['throttled'] for s in self._endpoints.values()),
+                    'bytes_received': sum(s['bytes_received'] for s in self._endpoints.values()),
+                    'token_refreshes': self.token_refreshes}
+
+
+def get_endpoint_template(path):
+    """
+    Replaces the ids in the url path with placeholders, e.g. /v1.0/sites/{site}/lists/{list}/items.
+    """
+    for pattern, placeholder in _ENDPOINT_IDS:
+        path = pattern.sub(placeholder, path)
+    return path
+
+
+def _get_bucket(elapsed_ms):
+    for i, upper_bound in enumerate(LATENCY_BUCKETS_MS):
+        if elapsed_ms <= upper_bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _format_histogram(counts):
+    labels = [f'<={b}' for b in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}']
+    return {label: count for label, count in zip(labels, counts) if count}
@@ -0,0 +1,89 @@
+import re
+import threading
+
+# $top in the query of a next link, either plain or percent encoded
+_TOP_PARAMETER = re.compile(r'([?&](?:\$|%24)top=)\d+', re.IGNORECASE)
+
+
+class PageSize:
+    """
+    Number of items requested per result page (`$top`), shared by all requests of a single list download.
+
+    In the adaptive mode the size is doubled after a page that was received within half of the `target_latency`
+    and that is smaller than half of the `max_page_bytes`. It is halved after a page that took longer than
+    the `target_latency` or that needed retries (5xx responses, connection errors) and when the request fails.
+    """
+
+    def __init__(self, size, adaptive=False, min_size=100, max_size=5000, target_latency=5.0,
+                 max_page_bytes=16 * 1024 * 1024):
+        """
+
+        :param size: initial number of items per page
+        :param adaptive: adjust the size based on the response latency and size
+        :param min_size: min items per page of the adaptive mode
+        :param max_size: max items per page of the adaptive mode
+        :param target_latency: max seconds to receive a page
+        :param max_page_bytes: max size of the page body
+        """
+        self.adaptive = adaptive
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.target_latency = target_latency
+        self.max_page_bytes = max_page_bytes
+        self._lock = threading.Lock()
+        self._size = size
+        self.smallest_used = size
+        self.largest_used = size
+
+    @property
+    def size(self):
+        return self._size
+
+    def on_page(self, latency, page_bytes=0, retries=0):
+        """
+        Adjusts the size based on the received page.
+
+        :param latency: seconds until the response headers were received
+        :param page_bytes: size of the page body, 0 if not known
+        :param retries: number of retries of the request
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            if retries or latency > self.target_latency:
+                self._resize(self._size // 2)
+            elif latency < self.target_latency / 2 and page_bytes * 2 <= self.max_page_bytes:
+                self._resize(self._size * 2)
+
+    def on_error(self):
+        """
+        Halves the size after a failed request.
+
+        :return: True if the size was reduced and the request may be retried with the smaller page
+        """
+        if not self.adaptive:
+            return False
+        with self._lock:
+            size = self._size
+            self._resize(size // 2)
+            return self._size < size
+
+    def apply(self, url, parameters):
+        """
+        Sets the current size to the request.
+
+        :param url: request url, e.g. a next link with the `$top` in the query
+        :param parameters: request parameters, empty for the next links
+        :return: tuple (url, parameters)
+        """
+        size = self._size
+        if parameters:
+            return url, {**parameters, '$top': size}
+        if _TOP_PARAMETER.search(url):
+            return _TOP_PARAMETER.sub(lambda m: f'{m.group(1)}{size}', url), parameters
+        return f"{url}{'&' if '?' in url else '?'}$top={size}", parameters
+
+    def _resize(self, size):
+        self._size = max(self.min_size, min(self.max_size, size))
+        self.smallest_used = min(self.smallest_used, self._size)
+        self.largest_used = max(self.largest_used, self._size)
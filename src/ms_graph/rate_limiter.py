@@ -0,0 +1,132 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+class AdaptiveRateLimiter:
+    """
+    Paces requests of all threads sharing the limiter to an adaptive rate (AIMD).
+
+    The rate grows additively with each successful (2xx, 3xx) response up to the `max_rate` and is cut by the
+    `decrease_factor` when the API throttles. A throttled response also pauses all requests for the `Retry-After`
+    period. When the Graph `RateLimit-Remaining`/`RateLimit-Reset` headers are present (sent when the tenant
+    is close to its limit), the rate is kept below the remaining budget.
+    """
+
+    def __init__(self, max_rate=25.0, min_rate=0.5, increase_step=0.5, decrease_factor=0.5, max_backoff=60,
+                 time_func=time.monotonic, sleep_func=time.sleep):
+        """
+
+        :param max_rate: max requests per second
+        :param min_rate: min requests per second
+        :param increase_step: requests per second added with each successful response
+        :param decrease_factor: multiplier of the rate applied on throttling
+        :param max_backoff: max pause in seconds when the throttled response has no Retry-After header
+        :param time_func:
+        :param sleep_func:
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_backoff = max_backoff
+        self._time = time_func
+        self._sleep = sleep_func
+        self._lock = threading.Lock()
+        self._rate = max_rate
+        self._next_slot = 0
+        self._paused_until = 0
+        self._consecutive_throttles = 0
+        self.throttle_events = 0
+        self.wait_time = 0.0
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def metrics(self):
+        return {'throttle_events': self.throttle_events,
+                'wait_time_s': round(self.wait_time, 3),
+                'current_rate': round(self._rate, 2)}
+
+    def acquire(self):
+        """
+        Blocks until the request may be sent.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            self._sleep(wait)
+
+    def reserve(self):
+        """
+        Reserves the next request slot without blocking, used by callers that wait on their own (e.g. asyncio).
+
+        :return: seconds to wait before the request is sent
+        """
+        with self._lock:
+            now = self._time()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + 1 / self._rate
+            wait = slot - now
+            self.wait_time += wait
+        return wait
+
+    def on_response(self, status_code, headers):
+        """
+        Adjusts the rate based on the response.
+
+        :param status_code:
+        :param headers: response headers
+        """
+        with self._lock:
+            if status_code in THROTTLE_STATUS_CODES:
+                self._on_throttled(headers)
+                return
+
+            rate = self._rate
+            # errors, e.g. failing 5xx responses, must not speed the requests up
+            if status_code < 400:
+                self._consecutive_throttles = 0
+                rate = min(self.max_rate, rate + self.increase_step)
+            remaining = _to_float(headers.get('RateLimit-Remaining'))
+            reset = _to_float(headers.get('RateLimit-Reset'))
+            if remaining is not None and reset:
+                # spread the remaining budget over the time until the limit window resets
+                rate = min(rate, remaining / reset)
+            self._rate = max(self.min_rate, rate)
+
+    def _on_throttled(self, headers):
+        self.throttle_events += 1
+        self._consecutive_throttles += 1
+        self._rate = max(self.min_rate, self._rate * self.decrease_factor)
+        pause = _parse_retry_after(headers.get('Retry-After'))
+        if pause is None:
+            pause = min(self.max_backoff, 2 ** (self._consecutive_throttles - 1))
+        self._paused_until = max(self._paused_until, self._time() + pause)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_retry_after(value):
+    """
+    Retry-After header is either number of seconds or HTTP date.
+    """
+    if value is None:
+        return None
+    seconds = _to_float(value)
+    if seconds is not None:
+        return max(seconds, 0)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
@@ -1,11 +1,84 @@
-from kbc.result import ResultWriter, KBCTableDef
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+
+from kbc.result import ResultWriter, KBCTableDef, KBCResult
+
+from ms_graph import columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # needed only for the Parquet output
+    pa = pq = None
 
 LIST_ID = 'list_id'
 SITE_ID = 'site_id'
 RES_TABLE_NAME = 'res_table_name'
 
+# marks the last page in the compression queue
+_END_OF_PAGES = object()
+
+KBC_BASE_TYPES = {columns.COLUMN_TYPE_STRING: 'STRING',
+                  columns.COLUMN_TYPE_INTEGER: 'INTEGER',
+                  columns.COLUMN_TYPE_NUMBER: 'NUMERIC',
+                  columns.COLUMN_TYPE_BOOLEAN: 'BOOLEAN',
+                  columns.COLUMN_TYPE_DATETIME: 'TIMESTAMP'}
+
+
+class CsvRowsResultWriter(ResultWriter):
+    """
+    Base of the writers writing csv rows directly into the output file, which is opened with the first write.
+
+    If the slice name is set, the data is written as a headless slice of the sliced table `{table name}.csv`.
+    """
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, result_dir_path, table_def, slice_name=None):
+        ResultWriter.__init__(self, result_dir_path, table_def, fix_headers=True, flatten_objects=False)
+        self.slice_name = slice_name
+        self._out_file = None
+        self._csv_writer = None
+
+    def close(self):
+        if self._out_file:
+            self._out_file.close()
+
+    def collect_results(self):
+        return list(self.results.values())
 
-class ListResultWriter(ResultWriter):
+    def _write_csv_rows(self, rows):
+        if self._csv_writer is None:
+            self._open()
+        self._csv_writer.writerows(rows)
+
+    def _open(self):
+        file_name = self.table_def.name + '.csv'
+        full_path = os.path.join(self.result_dir_path, file_name)
+        if self.slice_name:
+            os.makedirs(full_path, exist_ok=True)
+            out_path = os.path.join(full_path, self.slice_name + '.csv')
+        else:
+            out_path = full_path
+        self._out_file = open(out_path, 'w', newline='', encoding='utf-8', buffering=self.BUFFER_SIZE)
+        self._csv_writer = csv.writer(self._out_file)
+        if not self.slice_name:
+            self._csv_writer.writerow(self.table_def.columns)
+        self.results[file_name] = KBCResult(file_name, full_path, self.table_def)
+
+
+class ListResultWriter(CsvRowsResultWriter):
+    """
+    Writes the metadata of the downloaded lists into the `lists_metadata` table. Rows are buffered and appended
+    to the file in batches, so the writer may be shared by the workers for the whole run.
+    """
     COLS = ["createdDateTime",
             "description",
             "eTag",
@@ -19,52 +92,412 @@ class ListResultWriter(ResultWriter):
             "lastModifiedBy_user",
             "lastModifiedBy_email"
             ]
-    TABLE_DEF = KBCTableDef(name='lists_metadata', pk=['id', 'webUrl'], columns=COLS, destination='')
+    USER_VALUE_COLS = [SITE_ID, RES_TABLE_NAME]
+    # number of buffered rows
+    BATCH_SIZE = 100
 
     def __init__(self, result_dir_path):
-        ResultWriter.__init__(self, result_dir_path, self.TABLE_DEF, fix_headers=True,
-                              user_value_cols=[SITE_ID, RES_TABLE_NAME])
+        CsvRowsResultWriter.__init__(self, result_dir_path,
+                                     KBCTableDef(name='lists_metadata', pk=['id', 'webUrl'], columns=[],
+                                                 destination=''))
+        self.table_def.columns = self.COLS + self.USER_VALUE_COLS
+        self._batch = []
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
         # flatten obj
-        data['createdBy_user'] = data.get('createdBy', {}).get('user', {}).get('displayName')
-        data['createdBy_email'] = data.get('createdBy', {}).get('user', {}).get('email')
-        data['lastModifiedBy_user'] = data.get('lastModifiedBy', {}).get('user', {}).get('displayName')
-        data['lastModifiedBy_email'] = data.get('lastModifiedBy', {}).get('user', {}).get('email')
-        super().write(data, file_name, user_values, object_from_arrays, write_header)
+        created_by = (data.get('createdBy') or {}).get('user') or {}
+        modified_by = (data.get('lastModifiedBy') or {}).get('user') or {}
+        flattened = {**data,
+                     'createdBy_user': created_by.get('displayName'),
+                     'createdBy_email': created_by.get('email'),
+                     'lastModifiedBy_user': modified_by.get('displayName'),
+                     'lastModifiedBy_email': modified_by.get('email')}
+        self._batch.append([flattened.get(c) for c in self.COLS]
+                           + [(user_values or {}).get(c) for c in self.USER_VALUE_COLS])
+        if len(self._batch) >= self.BATCH_SIZE:
+            self.flush()
 
+    def flush(self):
+        if self._batch:
+            self._write_csv_rows(self._batch)
+            self._batch = []
 
-class ListDataResultWriter(ResultWriter):
+    def close(self):
+        self.flush()
+        CsvRowsResultWriter.close(self)
 
-    def __init__(self, result_dir_path, column_mapping, result_name):
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=result_name + '_data', pk=['ID', 'list_id'], columns=[], destination=''),
-                              fix_headers=True, flatten_objects=False)
+
+class ListDataResultWriter(CsvRowsResultWriter):
+    """
+    Writes list item fields straight into csv rows. The projection of API field names to the output columns
+    is compiled once per list, rows are not renamed or copied. Values are converted page by page, column by column,
+    only the columns that may contain multiple values or objects are converted.
+    The column types are stored in the table manifest.
+
+    If the slice name is set, the data is written as a headless slice of the sliced table `{result_name}_data.csv`.
+    """
+    # rows of item streams are converted in pages of this size
+    PAGE_SIZE = 1000
+
+    def __init__(self, result_dir_path, column_mapping, result_name, slice_name=None):
+        CsvRowsResultWriter.__init__(self, result_dir_path,
+                                     KBCTableDef(name=result_name + '_data', pk=['ID', 'list_id'], columns=[],
+                                                 destination=''),
+                                     slice_name=slice_name)
         self.column_mapping = column_mapping
         # override column names with display name
         self.table_def.columns = [c['displayName'] for c in column_mapping]
         # custom user added col
         self.user_value_cols = [LIST_ID]
         self.table_def.columns.append(LIST_ID)
+        column_types = [columns.get_column_type(c) for c in column_mapping]
+        self.table_def.column_metadata = {
+            c['displayName']: [{'key': 'KBC.datatype.basetype', 'value': KBC_BASE_TYPES[col_type]}]
+            for c, col_type in zip(column_mapping, column_types)}
+        # API field names in the output column order, ID is returned as id - because MS bullshit
+        self._project = _compile_projection(['id' if c['name'] == 'ID' else c['name'] for c in column_mapping],
+                                            [i for i, col_type in enumerate(column_types)
+                                             if col_type not in columns.SCALAR_COLUMN_TYPES])
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
-        # flatten obj
-        data = self._change_col_names(data)
-        super().write(data, user_values=user_values)
+        if data:
+            self.write_rows([data], user_values)
+
+    def write_rows(self, rows, user_values=None):
+        """
+        Writes item fields.
+
+        :param rows: iterable of item fields dicts
+        :param user_values: dict of user column values, same for all rows
+        """
+        if self._csv_writer is None:
+            self._open()
+        user_row = [(user_values or {}).get(c) for c in self.user_value_cols]
+        for page in iter_pages(rows, self.PAGE_SIZE):
+            page_rows = self._project(page)
+            for row in page_rows:
+                row.extend(user_row)
+            self._write_csv_rows(page_rows)
+
+
+class CompressedListDataWriter(ListDataResultWriter):
+    """
+    Writes list item fields as gzip compressed headless slices of the sliced table `{result_name}_data.csv`,
+    e.g. `my_table_data.csv/part_0000.csv.gz`. Each page of csv rows is handed over to a background thread
+    that streams it into the current slice, a new slice is started when the current one reaches `slice_size`
+    uncompressed characters. The download continues while the pages are compressed and only a few pages are held
+    in memory, regardless of the slice size.
 
-    def _change_col_names(self, data):
+    If the slice name is set, it prefixes the names of the compressed slices, e.g. `part_0001_0000.csv.gz`.
+    """
+    COMPRESS_LEVEL = 6
+    # pages waiting for the compression, the write waits when exceeded
+    MAX_PENDING_PAGES = 4
+
+    def __init__(self, result_dir_path, column_mapping, result_name, slice_size, slice_name=None):
+        """
+
+        :param slice_size: max number of uncompressed characters per slice
         """
-        replace name with display names inplace
-        :param data:
-        :return:
+        ListDataResultWriter.__init__(self, result_dir_path, column_mapping, result_name, slice_name=slice_name)
+        self.slice_size = slice_size
+        self._slice_prefix = f'{slice_name}_' if slice_name else 'part_'
+        self._dir_path = None
+        self._buffer = None
+        self._pages = None
+        self._compression = None
+        self._error = None
+
+    def close(self):
+        if self._compression is None:
+            return
+        self._pages.put(_END_OF_PAGES)
+        self._compression.join()
+        self._compression = None
+        if self._error:
+            raise self._error
+
+    def _open(self):
+        file_name = self.table_def.name + '.csv'
+        self._dir_path = os.path.join(self.result_dir_path, file_name)
+        os.makedirs(self._dir_path, exist_ok=True)
+        self._buffer = io.StringIO()
+        self._csv_writer = csv.writer(self._buffer)
+        self._pages = queue.Queue(maxsize=self.MAX_PENDING_PAGES)
+        self._compression = threading.Thread(target=self._compress_pages, name='compression', daemon=True)
+        self._compression.start()
+        self.results[file_name] = KBCResult(file_name, self._dir_path, self.table_def)
+
+    def _write_csv_rows(self, rows):
+        if self._csv_writer is None:
+            self._open()
+        if self._error:
+            raise self._error
+        self._csv_writer.writerows(rows)
+        self._pages.put(self._buffer.getvalue())
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def _compress_pages(self):
+        slice_count = 0
+        slice_file = None
+        slice_chars = 0
+        pages = iter(self._pages.get, _END_OF_PAGES)
+        try:
+            # zlib releases the GIL while compressing, the pages are compressed in parallel with the download
+            for page in pages:
+                if slice_file is None or slice_chars >= self.slice_size:
+                    if slice_file:
+                        slice_file.close()
+                    slice_file = self._open_slice(slice_count)
+                    slice_count += 1
+                    slice_chars = 0
+                slice_file.write(page)
+                slice_chars += len(page)
+            if slice_file is None:
+                # an empty table
+                slice_file = self._open_slice(slice_count)
+        except Exception as ex:
+            self._error = ex
+            # unblock the writes until the writer is closed
+            for _ in pages:
+                pass
+        finally:
+            if slice_file:
+                slice_file.close()
+
+    def _open_slice(self, number):
+        out_path = os.path.join(self._dir_path, f'{self._slice_prefix}{number:04d}.csv.gz')
+        return gzip.open(out_path, 'wt', compresslevel=self.COMPRESS_LEVEL, encoding='utf-8', newline='')
+
+
+class MultiValueResultWriter(CsvRowsResultWriter):
+    """
+    Writes values of a multi-value column (multiple choice, lookup or person) into the child table
+    `{result_name}_data__{column name}`, one row per value with the item ID and the position of the value.
+    Lookup and person values are written as the lookup value and the lookup id.
+    """
+    COLS = ['ID', LIST_ID, 'position', 'value', 'lookup_id']
+
+    def __init__(self, result_dir_path, column, result_name, slice_name=None):
+        table_name = f"{result_name}_data__{re.sub(r'[^A-Za-z0-9_]+', '_', column['name'])}"
+        CsvRowsResultWriter.__init__(self, result_dir_path,
+                                     KBCTableDef(name=table_name, pk=['ID', LIST_ID, 'position'], columns=[],
+                                                 destination=''),
+                                     slice_name=slice_name)
+        self.table_def.columns = list(self.COLS)
+        self.field_name = column['name']
+
+    def write_rows(self, rows, user_values=None):
+        """
+        Writes values of the column of the given items.
+
+        :param rows: list of item fields dicts
+        :param user_values: dict with the list id
         """
+        list_id = (user_values or {}).get(LIST_ID)
+        field_name = self.field_name
+        value_rows = []
+        for data in rows:
+            values = data.get(field_name)
+            if not values:
+                continue
+            if values.__class__ is not list:
+                values = [values]
+            item_id = data.get('id')
+            for position, value in enumerate(values):
+                if value.__class__ is dict:
+                    value_rows.append([item_id, list_id, position, value.get('LookupValue'), value.get('LookupId')])
+                else:
+                    value_rows.append([item_id, list_id, position, value, None])
+        if value_rows:
+            self._write_csv_rows(value_rows)
 
-        for key in self.column_mapping:
-            if key['name'] == 'ID':
-                # because MS bullshit
-                key['name'] = 'id'
 
-            if data.get(key['name']):
-                data[key['displayName']] = data.pop(key['name'])
+class ExplodedListDataWriter:
+    """
+    Writes the list data and the values of the multi-value columns into their child tables,
+    see `MultiValueResultWriter`. Has the same interface as the `ListDataResultWriter`.
+    """
+    PAGE_SIZE = 1000
 
-        return data
+    def __init__(self, data_writer, value_writers):
+        """
+
+        :param data_writer: writer of the list data without the multi-value columns
+        :param value_writers: list of `MultiValueResultWriter`
+        """
+        self.data_writer = data_writer
+        self.value_writers = value_writers
+
+    def write_rows(self, rows, user_values=None):
+        for page in iter_pages(rows, self.PAGE_SIZE):
+            self.data_writer.write_rows(page, user_values)
+            for value_wr in self.value_writers:
+                value_wr.write_rows(page, user_values)
+
+    def close(self):
+        self.data_writer.close()
+        for value_wr in self.value_writers:
+            value_wr.close()
+
+    def collect_results(self):
+        return self.data_writer.collect_results() + [res for value_wr in self.value_writers
+                                                     for res in value_wr.collect_results()]
+
+
+def iter_pages(rows, page_size):
+    """
+    Splits the rows into pages, rows that are already a list are returned as a single page.
+    """
+    if isinstance(rows, list):
+        yield rows
+        return
+    rows = iter(rows)
+    page = list(itertools.islice(rows, page_size))
+    while page:
+        yield page
+        page = list(itertools.islice(rows, page_size))
+
+
+def _compile_projection(field_names, json_columns):
+    """
+    Builds function returning values of the given fields of a page of items as csv rows.
+
+    :param field_names: API field names in the output column order
+    :param json_columns: indexes of the columns whose list and object values are serialized to JSON
+    """
+    json_types = (list, dict)
+
+    def project(page):
+        rows = [list(map(data.get, field_names)) for data in page]
+        for i in json_columns:
+            for row in rows:
+                value = row[i]
+                if value.__class__ in json_types:
+                    row[i] = json.dumps(value)
+        return rows
+
+    return project
+
+
+class ListDataParquetWriter:
+    """
+    Writes list item fields into a Parquet file in the output files folder, e.g. `{result_name}_data.parquet`.
+    Columns are typed based on the list column definitions, rows are buffered and written in row groups.
+
+    Has the same interface as the `ListDataResultWriter`, the file manifest is written on close. If the slice name
+    is set, the file is named `{result_name}_data.{slice_name}.parquet`.
+    """
+    ROW_GROUP_SIZE = 50000
+
+    def __init__(self, result_dir_path, column_mapping, result_name, slice_name=None):
+        if pa is None:
+            raise RuntimeError('The Parquet output requires the pyarrow package.')
+        table_name = result_name + '_data'
+        file_name = f'{table_name}.{slice_name}.parquet' if slice_name else f'{table_name}.parquet'
+        self.full_path = os.path.join(result_dir_path, file_name)
+        self.tags = [table_name]
+        # ID is returned as id
+        self._field_names = ['id' if c['name'] == 'ID' else c['name'] for c in column_mapping]
+        arrow_types = {columns.COLUMN_TYPE_INTEGER: pa.int64(),
+                       columns.COLUMN_TYPE_NUMBER: pa.float64(),
+                       columns.COLUMN_TYPE_BOOLEAN: pa.bool_(),
+                       columns.COLUMN_TYPE_DATETIME: pa.timestamp('s', tz='UTC')}
+        fields = [pa.field(c['displayName'], arrow_types.get(columns.get_column_type(c), pa.string()))
+                  for c in column_mapping]
+        self.schema = pa.schema(fields + [pa.field(LIST_ID, pa.string())])
+        self._buffer = [[] for _ in self.schema]
+        self._buffered_rows = 0
+        self._writer = None
+
+    def write(self, data, user_values=None):
+        if data:
+            self.write_rows([data], user_values)
+
+    def write_rows(self, rows, user_values=None):
+        """
+        Writes item fields.
+
+        :param rows: iterable of item fields dicts
+        :param user_values: dict of user column values, same for all rows
+        """
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.full_path, self.schema)
+        list_id = (user_values or {}).get(LIST_ID)
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.ROW_GROUP_SIZE - self._buffered_rows))
+            if not chunk:
+                break
+            for values, name in zip(self._buffer, self._field_names):
+                values.extend([data.get(name) for data in chunk])
+            self._buffer[-1].extend([list_id] * len(chunk))
+            self._buffered_rows += len(chunk)
+            if self._buffered_rows >= self.ROW_GROUP_SIZE:
+                self._write_row_group()
+
+    def close(self):
+        if self._writer is None:
+            return
+        if self._buffered_rows:
+            self._write_row_group()
+        self._writer.close()
+        write_file_manifest(self.full_path, self.tags)
+
+    def collect_results(self):
+        # files are not loaded into Storage tables
+        return []
+
+    def _write_row_group(self):
+        arrays = [_to_arrow_array(values, field) for values, field in zip(self._buffer, self.schema)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._buffer = [[] for _ in self.schema]
+        self._buffered_rows = 0
+
+
+def _to_arrow_array(values, field):
+    if field.type == pa.string():
+        return pa.array(_to_strings(values), pa.string())
+    try:
+        # numbers and booleans
+        return pa.array(values, field.type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    try:
+        return pa.array(_to_strings(values), pa.string()).cast(field.type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        logging.warning(f'Some values of the column "{field.name}" are not valid {field.type} values, '
+                        f'the invalid values are stored as nulls.')
+    return pa.array([_to_arrow_scalar(v, field.type) for v in _to_strings(values)], field.type)
+
+
+def _to_arrow_scalar(value, arrow_type):
+    try:
+        return pa.array([value], pa.string()).cast(arrow_type)[0].as_py()
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+
+
+def _to_strings(values):
+    """
+    Converts values to strings the same way as the csv output, multi value columns are serialized to JSON.
+    """
+    json_types = (list, dict)
+    return [v if v is None or v.__class__ is str else json.dumps(v) if v.__class__ in json_types else str(v)
+            for v in values]
+
+
+def write_file_manifest(file_path, tags):
+    with open(file_path + '.manifest', 'w') as manifest:
+        json.dump({'is_permanent': False, 'is_public': False, 'tags': tags}, manifest)
+
+
+class DeletedItemsResultWriter(ResultWriter):
+    COLS = ["id"]
+
+    def __init__(self, result_dir_path, result_name):
+        ResultWriter.__init__(self, result_dir_path,
+                              KBCTableDef(name=result_name + '_data_deleted', pk=['id', LIST_ID], columns=self.COLS,
+                                          destination=''),
+                              fix_headers=True, user_value_cols=[LIST_ID])
@@ -0,0 +1,173 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ms_graph.async_client import AsyncClient
+from ms_graph.exceptions import NotFound
+from ms_graph.rate_limiter import AdaptiveRateLimiter
+
+
+class MockGraphServer:
+    """
+    Minimal local Graph API serving a single site with one paged list.
+    """
+    SITE_ID = 'tenant.sharepoint.com,1,2'
+    LIST = {'id': 'list-1', 'displayName': 'Orders'}
+    PAGES = [[{'id': '1', 'Title': 'a'}, {'id': '2', 'Title': 'b'}],
+             [{'id': '3', 'Title': 'c'}]]
+
+    def __init__(self, expire_token_after=None, throttle_first_request=False, drop_first_connection=False):
+        self.expire_token_after = expire_token_after
+        self.throttle_first_request = throttle_first_request
+        self.drop_first_connection = drop_first_connection
+        self.token_requests = 0
+        self.data_requests = 0
+        self.server = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/login', self.login)
+        app.router.add_get('/{path:.*}', self.graph)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('/'))
+
+    async def stop(self):
+        await self.server.close()
+
+    async def login(self, request):
+        self.token_requests += 1
+        return web.json_response({'access_token': f'token-{self.token_requests}',
+                                  'refresh_token': f'refresh-{self.token_requests}'})
+
+    async def graph(self, request):
+        self.data_requests += 1
+        if self.drop_first_connection and self.data_requests == 1:
+            request.transport.close()
+            return web.Response()
+        if self.throttle_first_request and self.data_requests == 1:
+            return web.json_response({'error': {'code': 'throttled'}}, status=429, headers={'Retry-After': '0'})
+        if self.expire_token_after and self.data_requests > self.expire_token_after \
+                and request.headers['Authorization'] == 'Bearer token-1':
+            return web.json_response({'error': {'code': 'InvalidAuthenticationToken'}}, status=401)
+
+        path = request.path.strip('/')
+        if path.startswith('sites/tenant.sharepoint.com:'):
+            return web.json_response({'id': self.SITE_ID})
+        if path == f'sites/{self.SITE_ID}/lists':
+            return web.json_response({'value': [self.LIST]})
+        if path == f'sites/{self.SITE_ID}/lists/list-1':
+            return web.json_response({'columns': [{'name': 'ID', 'displayName': 'ID'},
+                                                  {'name': 'Title', 'displayName': 'Title'},
+                                                  {'name': 'Title', 'displayName': 'Title'},
+                                                  {'name': '_Hidden', 'displayName': 'Hidden'},
+                                                  {'name': 'Owner', 'displayName': 'Owner',
+                                                   'personOrGroup': {'allowMultipleSelection': False}}]})
+        if path == f'sites/{self.SITE_ID}/lists/list-1/items':
+            page = int(request.query.get('page', 0))
+            body = {'value': [{'fields': f} for f in self.PAGES[page]]}
+            if page + 1 < len(self.PAGES):
+                body['@odata.nextLink'] = str(request.url.with_query({'page': page + 1}))
+            return web.json_response(body)
+        return web.json_response({'error': {'code': 'itemNotFound', 'message': 'Not found'}}, status=404)
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    def run_with_client(self, server, test_coro, on_token_refresh=None, rate_limiter=None):
+        async def run():
+            base_url = await server.start()
+            client = AsyncClient('refresh-0', 'secret', 'client-id', 'scope', backoff_factor=0,
+                                 rate_limiter=rate_limiter)
+            client.on_token_refresh = on_token_refresh
+            client.OAUTH_LOGIN_URL = base_url + 'login'
+            client.base_url = base_url
+            try:
+                async with client:
+                    return await test_coro(client)
+            finally:
+                await server.stop()
+
+        return asyncio.get_event_loop().run_until_complete(run())
+
+    def test_resolves_site_list_and_columns(self):
+        async def resolve(client):
+            site = await client.get_site_by_relative_url('tenant.sharepoint.com', '/sites/root')
+            sh_list = await client.get_site_list_by_name(site['id'], 'Orders')
+            list_columns = await client.get_site_list_columns(site['id'], sh_list['id'])
+            return sh_list, list_columns
+
+        sh_list, list_columns = self.run_with_client(MockGraphServer(), resolve)
+
+        self.assertEqual(sh_list['id'], 'list-1')
+        self.assertEqual([c['name'] for c in list_columns], ['ID', 'Title', 'Title', 'OwnerLookupId'])
+        self.assertEqual([c['displayName'] for c in list_columns], ['ID', 'Title_Title', 'Title_Title', 'Owner'])
+
+    def test_list_fields_follow_next_link(self):
+        async def collect(client):
+            return [page async for page in client.get_site_list_fields(MockGraphServer.SITE_ID, 'list-1')]
+
+        pages = self.run_with_client(MockGraphServer(), collect)
+
+        self.assertEqual(pages, MockGraphServer.PAGES)
+
+    def test_expired_token_is_refreshed(self):
+        server = MockGraphServer(expire_token_after=1)
+        refresh_tokens = []
+
+        async def collect(client):
+            pages = [page async for page in client.get_site_list_fields(MockGraphServer.SITE_ID, 'list-1')]
+            return pages, client.refresh_token
+
+        pages, refresh_token = self.run_with_client(server, collect, on_token_refresh=refresh_tokens.append)
+
+        self.assertEqual(pages, MockGraphServer.PAGES)
+        self.assertEqual(server.token_requests, 2)
+        self.assertEqual(refresh_token, 'refresh-2')
+        self.assertEqual(refresh_tokens, ['refresh-1', 'refresh-2'])
+
+    def test_throttled_request_is_retried(self):
+        async def get_site(client):
+            return await client.get_site_by_relative_url('tenant.sharepoint.com', '/sites/root')
+
+        site = self.run_with_client(MockGraphServer(throttle_first_request=True), get_site)
+
+        self.assertEqual(site['id'], MockGraphServer.SITE_ID)
+
+    def test_dropped_connection_is_retried(self):
+        server = MockGraphServer(drop_first_connection=True)
+
+        async def get_site(client):
+            return await client.get_site_by_relative_url('tenant.sharepoint.com', '/sites/root')
+
+        site = self.run_with_client(server, get_site)
+
+        self.assertEqual(site['id'], MockGraphServer.SITE_ID)
+        self.assertEqual(server.data_requests, 2)
+
+    def test_requests_are_paced_by_rate_limiter(self):
+        rate_limiter = AdaptiveRateLimiter(max_rate=10, increase_step=1)
+
+        async def collect(client):
+            return [page async for page in client.get_site_list_fields(MockGraphServer.SITE_ID, 'list-1')]
+
+        pages = self.run_with_client(MockGraphServer(throttle_first_request=True), collect, rate_limiter=rate_limiter)
+
+        self.assertEqual(pages, MockGraphServer.PAGES)
+        self.assertEqual(rate_limiter.metrics['throttle_events'], 1)
+        # halved by the throttled response, then increased by the two pages
+        self.assertEqual(rate_limiter.rate, 7)
+        self.assertGreater(rate_limiter.wait_time, 0)
+
+    def test_not_found_raises(self):
+        async def get_list(client):
+            return await client.get_site_list_columns('unknown-site', 'list-1')
+
+        with self.assertRaises(NotFound):
+            self.run_with_client(MockGraphServer(), get_list)
+
+
+if __name__ == "__main__":
+    unittest.main()
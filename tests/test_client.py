@@ -0,0 +1,522 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from ms_graph.client import Client
+from ms_graph.exceptions import BadRequest, NotFound
+from ms_graph.page_size import PageSize
+from ms_graph.rate_limiter import AdaptiveRateLimiter
+
+
+class TokenServer:
+    """
+    Local login and Graph endpoint, access tokens are numbered by the refresh order.
+    File contents are served with Range support, the first response of each file is cut after `cut_after` bytes.
+    Canned JSON responses are served by the path with the query, e.g. `{'items?page=2': (200, {'value': []})}`,
+    optionally with response headers. A list of responses is served in order, the last one repeatedly.
+    Responses of the `slow_pages` paths are delayed by the given number of seconds.
+    Sub-requests of JSON batches are answered by the `batch_responder` called with each sub-request,
+    whole batch requests are first answered by the `batch_failures` statuses, in order.
+    """
+
+    def __init__(self, revoked_tokens=(), files=None, cut_after=None, pages=None, batch_responder=None):
+        self.token_requests = 0
+        self.revoked_tokens = set(revoked_tokens)
+        self.rejected_requests = 0
+        self.files = files or {}
+        self.cut_after = cut_after
+        self.ranges = []
+        self.pages = pages or {}
+        self.slow_pages = {}
+        self.batch_responder = batch_responder
+        self.batch_failures = []
+        self.batches = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.endswith('$batch'):
+                    if server.batch_failures:
+                        status = server.batch_failures.pop(0)
+                        return self._send(status, {'error': {'code': f'error{status}'}}, {'Retry-After': '3'})
+                    sub_requests = json.loads(body)['requests']
+                    server.batches.append(sub_requests)
+                    return self._send(200, {'responses': [server.batch_responder(r) for r in sub_requests]})
+                with server._lock:
+                    server.token_requests += 1
+                    number = server.token_requests
+                self._send(200, {'access_token': f'token-{number}', 'refresh_token': f'refresh-{number}',
+                                 'expires_in': 3600})
+
+            def do_GET(self):
+                if self.headers['Authorization'][len('Bearer '):] in server.revoked_tokens:
+                    with server._lock:
+                        server.rejected_requests += 1
+                    return self._send(401, {'error': {'code': 'InvalidAuthenticationToken'}})
+                if self.path.endswith('/content'):
+                    return self._send_file(self.path.split('/')[-2])
+                time.sleep(server.slow_pages.get(self.path.lstrip('/'), 0))
+                if self.path.lstrip('/') in server.pages:
+                    response = server.pages[self.path.lstrip('/')]
+                    if isinstance(response, list):
+                        with server._lock:
+                            response = response.pop(0) if len(response) > 1 else response[0]
+                    return self._send(*response)
+                self._send(200, {'token': self.headers['Authorization']})
+
+            def _send_file(self, item_id):
+                range_header = self.headers.get('Range')
+                server.ranges.append(range_header)
+                start = int(range_header[len('bytes='):-1]) if range_header else 0
+                content = server.files[item_id][start:]
+                self.send_response(206 if range_header else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if server.cut_after and len(server.ranges) == 1:
+                    self.wfile.write(content[:server.cut_after])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(content)
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self._server.server_port}/'
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestClientTokenRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TokenServer(revoked_tokens=['token-1'])
+        self.now = 0.0
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope', time_func=lambda: self.now,
+                             max_requests_per_second=1000)
+        self.refresh_tokens = []
+        self.client.on_token_refresh = self.refresh_tokens.append
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_token_is_refreshed_before_expiration(self):
+        self.server.revoked_tokens.clear()
+        self.now = 3600 - Client.TOKEN_REFRESH_MARGIN
+
+        resp = self.client.get_raw(self.server.url + 'sites')
+
+        self.assertEqual(resp.json(), {'token': 'Bearer token-2'})
+        self.assertEqual(self.refresh_tokens, ['refresh-2'])
+        self.assertEqual(self.client.refresh_token, 'refresh-2')
+
+    def test_rejected_token_is_refreshed_once_by_concurrent_requests(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(lambda _: self.client.get_raw(self.server.url + 'sites'), range(8)))
+
+        self.assertEqual({r.status_code for r in responses}, {200})
+        self.assertEqual(self.server.token_requests, 2)
+        self.assertEqual(self.refresh_tokens, ['refresh-2'])
+        self.assertEqual(self.client.metrics.totals['token_refreshes'], 1)
+
+
+class TestClientConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TokenServer(revoked_tokens=['token-1'])
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope', max_requests_per_second=1000)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connections_are_reused_across_token_refresh(self):
+        session = self.client._session
+
+        responses = [self.client.get_raw(self.server.url + f'sites/{i}') for i in range(5)]
+
+        self.assertEqual({r.status_code for r in responses}, {200})
+        self.assertEqual(self.server.rejected_requests, 1)
+        self.assertEqual(self.server.token_requests, 2)
+        self.assertIs(self.client._session, session)
+        # one connection of the data session for 6 requests (incl. the rejected one),
+        # one connection of the login session for 2 token requests
+        self.assertEqual(self.client.connection_stats, {'connections_opened': 2, 'connections_reused': 6})
+
+    def test_pool_size_is_configured(self):
+        client = Client('refresh-0', 'secret', 'app', 'scope', pool_maxsize=32)
+
+        adapter = client._session.get_adapter('https://graph.microsoft.com/')
+        self.assertEqual(adapter.poolmanager.connection_pool_kw['maxsize'], 32)
+        self.assertEqual(client._session.headers['Connection'], 'keep-alive')
+
+
+class TestClientThrottling(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TokenServer()
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope')
+        # the clock stands still, the waits are only recorded
+        self.waits = []
+        self.client.rate_limiter = AdaptiveRateLimiter(max_rate=10, increase_step=1, time_func=lambda: 0.0,
+                                                       sleep_func=self.waits.append)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_throttled_response_pauses_and_slows_down_rate_limiter(self):
+        self.server.pages['sites'] = [(429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': '5'}),
+                                      (200, {'value': []})]
+
+        resp = self.client.get_raw(self.server.url + 'sites')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.client.rate_limiter.metrics['throttle_events'], 1)
+        # halved by the throttled response, increased by the successful one
+        self.assertEqual(self.client.rate_limiter.rate, 6)
+        self.assertEqual(self.waits, [5])
+        self.assertEqual(self.client.metrics.totals['throttled'], 1)
+        self.assertEqual(self.client.metrics.totals['retries'], 0)
+
+
+class TestClientPageSize(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TokenServer()
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        base_url = mock.patch.object(Client, 'BASE_URL', self.server.url)
+        base_url.start()
+        self.addCleanup(base_url.stop)
+        # a single retry of the timed out request
+        max_retries = mock.patch.object(Client, 'MAX_RETRIES', 1)
+        max_retries.start()
+        self.addCleanup(max_retries.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope', read_timeout=0.2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_timed_out_page_is_requested_with_smaller_size(self):
+        self.server.pages.update({'items?$top=500': (200, {'value': ['late']}),
+                                  'items?$top=250': (200, {'value': ['on time']})})
+        self.server.slow_pages['items?$top=500'] = 1
+        page_size = PageSize(500, adaptive=True)
+
+        pages = list(self.client._get_paged_result_pages('items', {}, page_size=page_size))
+
+        self.assertEqual(pages, [{'value': ['on time']}])
+        self.assertEqual(page_size.smallest_used, 250)
+
+    def test_lists_of_sites_are_requested_with_page_size(self):
+        self.server.batch_responder = lambda r: {'id': r['id'], 'status': 200,
+                                                 'body': {'value': [{'id': 'list-1'}],
+                                                          '@odata.nextLink': self.server.url + 'lists?page=2'}}
+        self.server.pages.update({'lists?page=2&$top=300': (200, {'value': [{'id': 'list-2'}]})})
+
+        lists = self.client.get_sites_lists_batch(['site-1'], page_size=PageSize(300))
+
+        self.assertEqual(self.server.batches[0][0]['url'], '/sites/site-1/lists?$top=300')
+        self.assertEqual(lists, {'site-1': [{'id': 'list-1'}, {'id': 'list-2'}]})
+
+
+class TestClientItemQueries(unittest.TestCase):
+    PREFER_NON_INDEXED = {'Prefer': 'HonorNonIndexedQueriesWarningMayFailRandomly'}
+
+    def setUp(self):
+        self.client = Client.__new__(Client)
+        self.client.base_url = 'https://graph/'
+        self.client.get_raw = mock.Mock()
+
+    def respond(self, body):
+        self.client.get_raw.return_value = mock.Mock(status_code=200, headers={'Content-Type': 'application/json'},
+                                                     json=lambda: body)
+
+    def test_max_item_id_is_ordered_by_non_indexed_id(self):
+        self.respond({'value': [{'id': '42', 'fields': {'ID': 42}}]})
+
+        max_id = self.client.get_site_list_max_item_id('site-1', 'list-1')
+
+        self.assertEqual(max_id, 42)
+        self.client.get_raw.assert_called_once_with(
+            'https://graph//sites/site-1/lists/list-1/items',
+            params={'expand': 'fields(select=ID)', '$orderby': 'fields/ID desc', '$top': 1},
+            headers=self.PREFER_NON_INDEXED)
+
+    def test_max_item_id_of_empty_list_is_zero(self):
+        self.respond({'value': []})
+
+        self.assertEqual(self.client.get_site_list_max_item_id('site-1', 'list-1'), 0)
+
+    def test_filtered_items_query_allows_non_indexed_columns(self):
+        params, headers = self.client._get_items_query(['ID', 'Title'], 'fields/ID ge 1 and fields/ID lt 5')
+
+        self.assertEqual(params, {'expand': 'fields(select=id,Title)', '$filter': 'fields/ID ge 1 and fields/ID lt 5'})
+        self.assertEqual(headers, self.PREFER_NON_INDEXED)
+        self.assertEqual(self.client._get_items_query(['ID', 'Title']), ({'expand': 'fields(select=id,Title)'}, None))
+
+
+    def test_drive_items_of_library_items_are_listed(self):
+        page_size = PageSize(300)
+        pages = [{'value': [{'id': '1', 'driveItem': {'id': 'drive-item-1', 'file': {}}}, {'id': '2'}]},
+                 {'value': [{'id': '3', 'driveItem': {'id': 'drive-item-3', 'folder': {}}}]}]
+        self.client._get_paged_result_pages = mock.Mock(return_value=iter(pages))
+
+        drive_items = list(self.client.get_site_list_drive_items('site-1', 'list-1', page_size=page_size))
+
+        self.assertEqual(drive_items, [[('1', {'id': 'drive-item-1', 'file': {}})],
+                                       [('3', {'id': 'drive-item-3', 'folder': {}})]])
+        self.client._get_paged_result_pages.assert_called_once_with(
+            '/sites/site-1/lists/list-1/items', {'expand': 'driveItem', '$select': 'id'}, page_size=page_size)
+
+
+class TestClientFileDownload(unittest.TestCase):
+    CONTENT = bytes(range(256)) * 4096
+
+    def setUp(self):
+        self.server = TokenServer(files={'file-1': self.CONTENT}, cut_after=100000)
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        base_url = mock.patch.object(Client, 'BASE_URL', self.server.url)
+        base_url.start()
+        self.addCleanup(base_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope')
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.out_dir.cleanup()
+
+    def test_interrupted_download_is_resumed_by_range_request(self):
+        out_path = os.path.join(self.out_dir.name, 'file.bin')
+
+        self.client.download_drive_item('drive-1', 'file-1', out_path, size=len(self.CONTENT))
+
+        with open(out_path, 'rb') as out:
+            self.assertEqual(out.read(), self.CONTENT)
+        self.assertEqual(self.server.ranges, [None, 'bytes=100000-'])
+        self.assertEqual(os.listdir(self.out_dir.name), ['file.bin'])
+
+
+class ChunkedStream(io.RawIOBase):
+    """
+    Response body returned in chunks of the given size, as read from the socket.
+    """
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.data[:min(len(buffer), self.chunk_size)]
+        self.data = self.data[len(chunk):]
+        buffer[:len(chunk)] = chunk
+        self.reads += 1
+        return len(chunk)
+
+
+class TestClientItemsStream(unittest.TestCase):
+    ITEMS = [{'id': '1', 'fields': {'id': '1', 'Title': 'a', 'Tags': ['x', 'y'], 'Owner': {'LookupId': 7}}},
+             {'id': '2', 'fields': {'id': '2', 'Title': 'b', 'Amount': 1.5}}]
+
+    def setUp(self):
+        self.server = TokenServer()
+        self.server.pages.update({
+            'items': (200, {'value': self.ITEMS[:1], '@odata.nextLink': self.server.url + 'items?page=2'}),
+            'items?page=2': (200, {'value': self.ITEMS[1:]}),
+            'bad-filter': (400, {'error': {'code': 'invalidRequest', 'message': 'Invalid filter clause'}})})
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        base_url = mock.patch.object(Client, 'BASE_URL', self.server.url)
+        base_url.start()
+        self.addCleanup(base_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_items_split_across_chunks_are_parsed_with_links(self):
+        body = json.dumps({'@odata.context': 'ctx', 'value': self.ITEMS,
+                           '@odata.nextLink': 'https://graph/next?$skiptoken=2'}).encode()
+        stream = ChunkedStream(body, chunk_size=7)
+        links = {}
+
+        items = list(Client._parse_items_stream(stream, links))
+
+        self.assertEqual(items, self.ITEMS)
+        self.assertEqual(links, {'@odata.context': 'ctx', '@odata.nextLink': 'https://graph/next?$skiptoken=2'})
+        self.assertGreater(stream.reads, 1)
+
+    def test_items_of_all_pages_are_streamed(self):
+        items = list(self.client._stream_result_items('items', {}))
+
+        self.assertEqual(items, self.ITEMS)
+
+    def test_error_response_raises(self):
+        with self.assertRaises(BadRequest) as ctx:
+            list(self.client._stream_result_items('bad-filter', {}))
+
+        self.assertIn('Invalid filter clause', str(ctx.exception))
+
+
+class TestPagePrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.produced = 0
+
+    def pages(self, count=None, error_after=None):
+        page = 0
+        while count is None or page < count:
+            if page == error_after:
+                raise ValueError('page failed')
+            self.produced += 1
+            yield [page]
+            page += 1
+
+    def wait_for_producer(self):
+        # the producer either blocks on the full buffer or finishes
+        produced = -1
+        while produced != self.produced:
+            produced = self.produced
+            time.sleep(0.3)
+
+    def test_buffered_pages_are_bounded_by_depth(self):
+        pages = Client._prefetch_pages(self.pages(count=20), depth=3)
+
+        self.assertEqual(next(pages), [0])
+        self.wait_for_producer()
+
+        # the buffered pages and the page waiting for a free slot
+        self.assertEqual(self.produced, 1 + 3 + 1)
+        self.assertEqual(list(pages), [[i] for i in range(1, 20)])
+
+    def test_producer_error_is_raised_to_consumer(self):
+        pages = Client._prefetch_pages(self.pages(error_after=2), depth=5)
+
+        self.assertEqual(next(pages), [0])
+        self.assertEqual(next(pages), [1])
+        with self.assertRaisesRegex(ValueError, 'page failed'):
+            next(pages)
+
+    def test_producer_stops_when_consumer_abandons_pages(self):
+        pages = Client._prefetch_pages(self.pages(), depth=2)
+        next(pages)
+
+        pages.close()
+        self.wait_for_producer()
+        produced = self.produced
+        time.sleep(0.3)
+
+        self.assertEqual(self.produced, produced)
+        self.assertFalse([t for t in threading.enumerate() if t.name == 'page-prefetch' and t.is_alive()])
+
+
+class TestClientBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TokenServer(batch_responder=self.respond)
+        login_url = mock.patch.object(Client, 'OAUTH_LOGIN_URL', self.server.url + 'login')
+        login_url.start()
+        self.addCleanup(login_url.stop)
+        base_url = mock.patch.object(Client, 'BASE_URL', self.server.url)
+        base_url.start()
+        self.addCleanup(base_url.stop)
+        self.client = Client('refresh-0', 'secret', 'app', 'scope', max_requests_per_second=1000)
+        # statuses returned for the url before the success, in order
+        self.failures = {}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def respond(self, sub_request):
+        failures = self.failures.get(sub_request['url'])
+        status = failures.pop(0) if failures else 200
+        if status == 200:
+            return {'id': sub_request['id'], 'status': 200, 'body': {'url': sub_request['url']}}
+        return {'id': sub_request['id'], 'status': status, 'headers': {'Retry-After': '0'},
+                'body': {'error': {'code': f'error{status}', 'message': f'failed {status}'}}}
+
+    def test_requests_are_sent_in_batches_of_20(self):
+        urls = {i: f'/sites/site-{i}' for i in range(45)}
+
+        results = self.client.batch_get(urls)
+
+        self.assertEqual([len(batch) for batch in self.server.batches], [20, 20, 5])
+        self.assertEqual(results, {i: {'url': url} for i, url in urls.items()})
+
+    def test_throttled_and_failed_requests_are_retried(self):
+        self.failures = {'/sites/a': [429, 503], '/sites/b': [500]}
+
+        results = self.client.batch_get({'a': '/sites/a', 'b': '/sites/b', 'c': '/sites/c'})
+
+        self.assertEqual([[r['url'] for r in batch] for batch in self.server.batches],
+                         [['/sites/a', '/sites/b', '/sites/c'], ['/sites/a', '/sites/b'], ['/sites/a']])
+        self.assertEqual(results, {key: {'url': f'/sites/{key}'} for key in 'abc'})
+
+    def test_throttled_batch_request_is_retried_by_rate_limiter(self):
+        waits = []
+        self.client.rate_limiter = AdaptiveRateLimiter(time_func=lambda: 0.0, sleep_func=waits.append)
+        self.server.batch_failures = [429, 503]
+
+        results = self.client.batch_get({'a': '/sites/a', 'b': '/sites/b'})
+
+        self.assertEqual(results, {key: {'url': f'/sites/{key}'} for key in 'ab'})
+        self.assertEqual(len(self.server.batches), 1)
+        self.assertEqual(self.client.rate_limiter.metrics['throttle_events'], 2)
+        # both retries waited for the Retry-After period
+        self.assertEqual(len(waits), 2)
+        self.assertGreaterEqual(min(waits), 3)
+        self.assertEqual(self.client.metrics.totals['throttled'], 2)
+
+    def test_errors_are_returned_per_key(self):
+        self.failures = {'/sites/missing': [404]}
+
+        results = self.client.batch_get({'missing': '/sites/missing', 'found': '/sites/found'})
+
+        self.assertIsInstance(results['missing'], NotFound)
+        self.assertIn('failed 404', str(results['missing']))
+        self.assertEqual(results['found'], {'url': '/sites/found'})
+
+
+if __name__ == "__main__":
+    unittest.main()
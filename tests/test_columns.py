@@ -0,0 +1,46 @@
+import unittest
+
+from ms_graph import columns
+
+
+class TestColumns(unittest.TestCase):
+    RAW_COLUMNS = [{'name': 'ID', 'displayName': 'ID'},
+                   {'name': 'Title', 'displayName': 'Title'},
+                   {'name': 'ContentType', 'displayName': 'Content Type'},
+                   {'name': '_UIVersionString', 'displayName': 'Version'},
+                   {'name': 'Owner', 'displayName': 'Owner', 'personOrGroup': {'allowMultipleSelection': False}},
+                   {'name': 'Reviewers', 'displayName': 'Reviewers', 'personOrGroup': {'allowMultipleSelection': True}},
+                   {'name': 'Status', 'displayName': 'Title'}]
+
+    def process(self, **kwargs):
+        return columns.process_list_columns([dict(c) for c in self.RAW_COLUMNS], **kwargs)
+
+    def test_system_columns_are_skipped(self):
+        processed = self.process()
+
+        self.assertEqual([c['name'] for c in processed], ['ID', 'Title', 'OwnerLookupId', 'Reviewers', 'Status'])
+
+    def test_system_columns_are_included(self):
+        processed = self.process(include_system=True)
+
+        self.assertEqual([c['name'] for c in processed],
+                         ['ID', 'Title', 'ContentType', '_UIVersionString', 'OwnerLookupId', 'Reviewers', 'Status'])
+
+    def test_duplicate_display_names_are_made_unique(self):
+        self.assertEqual([c['displayName'] for c in self.process()],
+                         ['ID', 'Title_Title', 'Owner', 'Reviewers', 'Title_Status'])
+        self.assertEqual([c['displayName'] for c in self.process(use_display_colnames=False)],
+                         ['ID', 'Title', 'OwnerLookupId', 'Reviewers', 'Status'])
+
+    def test_fields_expand_selects_id_first(self):
+        self.assertEqual(columns.build_fields_expand(['ID', 'Title', 'OwnerLookupId']),
+                         'fields(select=id,Title,OwnerLookupId)')
+        self.assertEqual(columns.build_fields_expand(['Title', 'id']), 'fields(select=id,Title)')
+
+    def test_all_fields_are_expanded_without_selection(self):
+        self.assertEqual(columns.build_fields_expand(None), 'fields')
+        self.assertEqual(columns.build_fields_expand([]), 'fields')
+
+
+if __name__ == "__main__":
+    unittest.main()
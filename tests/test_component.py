@@ -3,12 +3,22 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import copy
+import csv
+import re
+import tempfile
+import threading
 import unittest
 import mock
 import os
 from freezegun import freeze_time
 
-from component import Component
+import component
+from component import Component, UserException, _combine_filters
+from metadata_cache import MetadataCache
+from ms_graph import columns
+from ms_graph.exceptions import BadRequest, Gone, InternalServerError
+from result import ListDataResultWriter, ListResultWriter
 
 
 class TestComponent(unittest.TestCase):
@@ -22,6 +32,627 @@ class TestComponent(unittest.TestCase):
             comp = Component()
             comp.run()
 
+    def test_invalid_discovery_pattern_raises_user_exception(self):
+        comp = Component.__new__(Component)
+        comp.cfg_params = {'discovery': {'list_name_pattern': 'Orders[0-9', 'pattern_type': 'regex'}}
+
+        with self.assertRaisesRegex(UserException, r'Invalid list name pattern "Orders\[0-9"'):
+            comp._add_discovered_lists([])
+
+    def test_filters_are_combined(self):
+        self.assertEqual(_combine_filters("fields/ID ge 1 and fields/ID lt 10", "fields/Status eq 'Active'"),
+                         "(fields/ID ge 1 and fields/ID lt 10) and (fields/Status eq 'Active')")
+        self.assertEqual(_combine_filters(None, "fields/Modified ge '2024-01-01T00:00:00Z'"),
+                         "fields/Modified ge '2024-01-01T00:00:00Z'")
+        self.assertIsNone(_combine_filters(None, ''))
+
+
+class FakeDataWriter:
+
+    def __init__(self):
+        self.rows = []
+
+    def write_rows(self, rows, user_values=None):
+        self.rows.extend(rows)
+
+
+def create_component(state=None, **params):
+    """
+    Component with a mocked client, without the configuration and the data folder.
+    """
+    comp = Component.__new__(Component)
+    comp.cfg_params = params
+    comp.client = mock.Mock()
+    comp.state = {'checkpoints': {}, 'delta_links': {}, 'watermarks': {}, **(state or {})}
+    comp._lock = threading.Lock()
+    comp._rows_written = {}
+    return comp
+
+
+def pages_failing_after(pages, error):
+    yield from pages
+    raise error
+
+
+def api_error(error_class, message='failed'):
+    return error_class('Calling endpoint items failed', {'error': {'code': 'error', 'message': message}})
+
+
+class TestParallelDownload(unittest.TestCase):
+    LISTS = [{'list_name': name, 'site_url_rel_path': '/sites/Sales', 'result_table_name': name.lower()}
+             for name in ('Orders', 'Invoices', 'Customers')]
+    COLUMNS = [{'name': 'ID', 'displayName': 'ID'}, {'name': 'Title', 'displayName': 'Title'}]
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.comp = create_component(base_host_name='tenant.sharepoint.com')
+        self.comp.tables_out_path = self.out_dir.name
+        self.comp.list_metadata_wr = ListResultWriter(self.out_dir.name)
+        self.comp.create_manifests = mock.Mock()
+        self.comp._metadata_cache = MetadataCache()
+        self.comp._list_runs = []
+        self.comp._page_sizes = {}
+        client = self.comp.client
+        client.get_site_lists_batch.return_value = {}
+        client.get_sites_by_relative_url_batch.side_effect = lambda host, paths: {p: {'id': 'site-1'} for p in paths}
+        client.get_site_lists_by_name_batch.side_effect = \
+            lambda keys: {(site_id, name): {'id': f'list-{name}', 'name': name} for site_id, name in keys}
+        client.get_site_list_columns_batch.side_effect = lambda keys: {k: copy.deepcopy(self.COLUMNS) for k in keys}
+        client.get_site_list_fields.side_effect = self.list_pages
+        # every list waits until all lists are being downloaded, a sequential download fails on the timeout
+        self.all_started = threading.Barrier(len(self.LISTS), timeout=5)
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def list_pages(self, site_id, list_id, select=None, page_size=None, filter=None):
+        self.all_started.wait()
+        for page in range(2):
+            yield [{'id': str(page), 'Title': f'{list_id} {page}'}]
+
+    def read_table(self, name):
+        with open(os.path.join(self.out_dir.name, name)) as table:
+            return list(csv.DictReader(table))
+
+    def test_lists_are_downloaded_in_parallel(self):
+        self.comp._download_lists(self.LISTS, max_workers=3)
+        self.comp.list_metadata_wr.close()
+
+        metadata = self.read_table('lists_metadata.csv')
+        self.assertEqual(sorted((r['id'], r['res_table_name']) for r in metadata),
+                         [('list-Customers', 'customers'), ('list-Invoices', 'invoices'), ('list-Orders', 'orders')])
+        for lst in self.LISTS:
+            with self.subTest(list_name=lst['list_name']):
+                rows = self.read_table(f"{lst['result_table_name']}_data.csv")
+                self.assertEqual([r['Title'] for r in rows], [f"list-{lst['list_name']} {page}" for page in range(2)])
+        self.assertEqual(self.comp._rows_written, {f"list-{lst['list_name']}": 2 for lst in self.LISTS})
+        self.assertEqual(len(self.comp._list_runs), 3)
+        self.assertEqual(self.comp.create_manifests.call_count, 6)
+
+    def test_failed_list_stops_the_run(self):
+        def list_pages(site_id, list_id, select=None, page_size=None, filter=None):
+            if list_id == 'list-Invoices':
+                raise api_error(InternalServerError, 'Invoices failed')
+            return iter([[{'id': '1', 'Title': 'a'}]])
+
+        self.comp.client.get_site_list_fields.side_effect = list_pages
+
+        with self.assertLogs(level='ERROR') as logs, self.assertRaises(SystemExit) as ctx:
+            self.comp._download_lists(self.LISTS, max_workers=3)
+
+        self.assertEqual(ctx.exception.code, 1)
+        self.assertIn('Invoices failed', '\n'.join(logs.output))
+
+    def test_unexpected_error_is_raised(self):
+        self.comp.client.get_site_list_fields.side_effect = ValueError('unexpected')
+
+        with self.assertRaisesRegex(ValueError, 'unexpected'):
+            self.comp._download_lists(self.LISTS, max_workers=3)
+
+
+class TestFileDownload(unittest.TestCase):
+    LIST_PAR = {'list_name': 'Docs', 'result_table_name': 'docs'}
+    LIBRARY = {'id': 'list-1', 'list': {'template': 'documentLibrary'}}
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.downloaded = []
+        self.comp = create_component({'file_etags': {'site-1/list-1': {'1': 'etag-1', '2': 'etag-2', '9': 'etag-9'}}},
+                                     max_parallel_downloads=3)
+        self.comp.files_out_path = self.out_dir.name
+        self.comp.client.download_drive_item.side_effect = self.download_drive_item
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def download_drive_item(self, drive_id, item_id, out_path, size=None):
+        self.downloaded.append(item_id)
+        with open(out_path, 'w') as out:
+            out.write(item_id)
+
+    def serve_files(self, *pages):
+        def drive_item(item_id, etag=None):
+            item = {'id': f'drive-item-{item_id}', 'name': f'{item_id}.txt', 'file': {},
+                    'parentReference': {'driveId': 'drive-1'}}
+            return item_id, {**item, 'eTag': etag} if etag else item
+
+        self.comp.client.get_site_list_drive_items.return_value = iter(
+            [[drive_item(*item) for item in page] for page in pages])
+
+    def test_unchanged_files_are_skipped(self):
+        self.serve_files([('1', 'etag-1'), ('2', 'etag-2-changed')], [('3', 'etag-3'), ('4',)])
+
+        self.comp._download_list_files('site-1', self.LIBRARY, self.LIST_PAR)
+
+        self.assertEqual(sorted(self.downloaded), ['drive-item-2', 'drive-item-3', 'drive-item-4'])
+        self.assertEqual(sorted(os.listdir(self.out_dir.name)),
+                         ['docs_2_2.txt', 'docs_2_2.txt.manifest', 'docs_3_3.txt', 'docs_3_3.txt.manifest',
+                          'docs_4_4.txt', 'docs_4_4.txt.manifest'])
+
+    def test_files_without_etag_are_always_downloaded(self):
+        self.comp.state['file_etags']['site-1/list-1'] = {'4': None}
+        self.serve_files([('4',)])
+
+        self.comp._download_list_files('site-1', self.LIBRARY, self.LIST_PAR)
+
+        self.assertEqual(self.downloaded, ['drive-item-4'])
+
+    def test_etags_of_current_files_are_stored(self):
+        self.serve_files([('1', 'etag-1'), ('2', 'etag-2-changed'), ('3', 'etag-3')])
+
+        self.comp._download_list_files('site-1', self.LIBRARY, self.LIST_PAR)
+
+        # the deleted file 9 is dropped
+        self.assertEqual(self.comp.state['file_etags'],
+                         {'site-1/list-1': {'1': 'etag-1', '2': 'etag-2-changed', '3': 'etag-3'}})
+
+    def test_files_are_downloaded_in_parallel(self):
+        # every download waits until all downloads are running, sequential downloads fail on the timeout
+        all_started = threading.Barrier(3, timeout=5)
+
+        def download_drive_item(*args, **kwargs):
+            all_started.wait()
+            self.download_drive_item(*args, **kwargs)
+
+        self.comp.client.download_drive_item.side_effect = download_drive_item
+        self.serve_files([('5', 'etag-5'), ('6', 'etag-6')], [('7', 'etag-7')])
+
+        self.comp._download_list_files('site-1', self.LIBRARY, self.LIST_PAR)
+
+        self.assertEqual(sorted(self.downloaded), ['drive-item-5', 'drive-item-6', 'drive-item-7'])
+
+    def test_failed_download_fails_the_list(self):
+        self.comp.client.download_drive_item.side_effect = api_error(InternalServerError, 'download failed')
+        self.serve_files([('5', 'etag-5')])
+
+        with self.assertRaisesRegex(InternalServerError, 'download failed'):
+            self.comp._download_list_files('site-1', self.LIBRARY, self.LIST_PAR)
+        self.assertEqual(self.comp.state['file_etags']['site-1/list-1'], {'1': 'etag-1', '2': 'etag-2', '9': 'etag-9'})
+
+
+class TestFieldProjection(unittest.TestCase):
+    RAW_COLUMNS = [{'name': 'ID', 'displayName': 'ID'},
+                   {'name': 'Title', 'displayName': 'Title'},
+                   {'name': '_UIVersionString', 'displayName': 'Version'},
+                   {'name': 'Owner', 'displayName': 'Project owner', 'personOrGroup': {'allowMultipleSelection': False}},
+                   {'name': 'Status', 'displayName': 'Status'}]
+
+    def get_fields_expand(self, **lst_par):
+        list_columns = Component._process_columns(self.RAW_COLUMNS, lst_par)
+        if lst_par.get('columns'):
+            list_columns = Component._filter_columns(list_columns, lst_par['columns'], 'Orders')
+        return columns.build_fields_expand(Component._get_field_projection(list_columns, lst_par))
+
+    def test_configured_columns_are_selected(self):
+        self.assertEqual(self.get_fields_expand(), 'fields(select=id,Title,OwnerLookupId,Status)')
+
+    def test_all_fields_with_additional_columns(self):
+        self.assertEqual(self.get_fields_expand(include_additional_cols=True), 'fields')
+
+    def test_column_subset_is_selected_by_api_and_display_names(self):
+        self.assertEqual(self.get_fields_expand(columns=['Project owner', 'Status']),
+                         'fields(select=id,OwnerLookupId,Status)')
+        self.assertEqual(self.get_fields_expand(columns=['Owner']), 'fields(select=id,OwnerLookupId)')
+        self.assertEqual(self.get_fields_expand(columns=['OwnerLookupId']), 'fields(select=id,OwnerLookupId)')
+
+    def test_column_subset_may_include_additional_columns(self):
+        self.assertEqual(self.get_fields_expand(include_additional_cols=True, columns=['_UIVersionString']),
+                         'fields(select=id,_UIVersionString)')
+
+    def test_missing_columns_are_reported(self):
+        with self.assertLogs(level='WARNING') as logs:
+            expand = self.get_fields_expand(columns=['Title', 'Deleted column'])
+
+        self.assertEqual(expand, 'fields(select=id,Title)')
+        self.assertIn("Columns ['Deleted column'] were not found", logs.output[0])
+
+    def test_selected_id_field_is_written_into_id_column(self):
+        out_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(out_dir.cleanup)
+        list_columns = Component._filter_columns(Component._process_columns(self.RAW_COLUMNS, {}), ['Owner'], 'Orders')
+        writer = ListDataResultWriter(out_dir.name, list_columns, 'orders')
+
+        # fields returned for the expand=fields(select=id,OwnerLookupId)
+        writer.write_rows([{'id': '7', 'OwnerLookupId': '12', '@odata.etag': 'x'}], user_values={'list_id': 'list-1'})
+        writer.close()
+
+        with open(os.path.join(out_dir.name, 'orders_data.csv')) as table:
+            self.assertEqual(list(csv.DictReader(table)),
+                             [{'ID': '7', 'Project owner': '12', 'list_id': 'list-1'}])
+
+
+class TestResumableDownload(unittest.TestCase):
+    LIST_PAR = {'list_name': 'Orders', 'result_table_name': 'orders'}
+
+    def setUp(self):
+        self.data_wr = FakeDataWriter()
+
+    def download(self, comp):
+        comp._collect_and_write_list_resumable('site-1', 'list-1', self.data_wr, self.LIST_PAR, None)
+
+    def test_checkpoint_is_stored_after_failure(self):
+        comp = create_component()
+        comp.client.get_site_list_item_pages.return_value = pages_failing_after(
+            [([{'id': '1'}, {'id': '2'}], 'link-2'), ([{'id': '3'}], 'link-3')], api_error(InternalServerError))
+
+        self.download(comp)
+
+        self.assertEqual([r['id'] for r in self.data_wr.rows], ['1', '2', '3'])
+        self.assertEqual(comp.state['checkpoints'],
+                         {'orders': {'list_id': 'list-1', 'next_link': 'link-3', 'rows_written': 3,
+                                     'select': None, 'filter': None}})
+
+    def test_failure_without_downloaded_pages_raises(self):
+        comp = create_component()
+        comp.client.get_site_list_item_pages.return_value = pages_failing_after([], api_error(InternalServerError))
+
+        with self.assertRaises(InternalServerError):
+            self.download(comp)
+        self.assertEqual(comp.state['checkpoints'], {})
+
+    def test_download_is_resumed_from_checkpoint(self):
+        comp = create_component({'checkpoints': {
+            'orders': {'list_id': 'list-1', 'next_link': 'link-3', 'rows_written': 3, 'select': None, 'filter': None}}})
+        comp.client.get_site_list_item_pages.return_value = iter([([{'id': '4'}], None)])
+
+        self.download(comp)
+
+        self.assertEqual(comp.client.get_site_list_item_pages.call_args[1]['next_link'], 'link-3')
+        self.assertEqual(self.data_wr.rows, [{'id': '4'}])
+        self.assertEqual(comp.state['checkpoints'], {})
+
+    def test_checkpoint_of_changed_query_is_discarded(self):
+        for select, item_filter in ((['ID', 'Title'], None), (None, "fields/Status eq 'Active'")):
+            with self.subTest(select=select, filter=item_filter):
+                self.data_wr = FakeDataWriter()
+                comp = create_component({'checkpoints': {
+                    'orders': {'list_id': 'list-1', 'next_link': 'link-3', 'rows_written': 3,
+                               'select': ['ID'], 'filter': None}}})
+                comp.client.get_site_list_item_pages.return_value = iter([([{'id': '1'}], None)])
+
+                with self.assertLogs(level='WARNING'):
+                    comp._collect_and_write_list_resumable('site-1', 'list-1', self.data_wr,
+                                                           {**self.LIST_PAR, 'filter': item_filter}, select)
+
+                call = comp.client.get_site_list_item_pages.call_args[1]
+                self.assertEqual((call['next_link'], call['select'], call['filter']), (None, select, item_filter))
+                self.assertEqual(self.data_wr.rows, [{'id': '1'}])
+                self.assertEqual(comp.state['checkpoints'], {})
+
+    def test_invalid_checkpoint_is_discarded(self):
+        comp = create_component({'checkpoints': {
+            'orders': {'list_id': 'list-1', 'next_link': 'expired-link', 'rows_written': 3,
+                       'select': None, 'filter': None}}})
+        comp.client.get_site_list_item_pages.side_effect = [pages_failing_after([], api_error(Gone)),
+                                                            iter([([{'id': '1'}], None)])]
+
+        self.download(comp)
+
+        self.assertEqual([c[1]['next_link'] for c in comp.client.get_site_list_item_pages.call_args_list],
+                         ['expired-link', None])
+        self.assertEqual(self.data_wr.rows, [{'id': '1'}])
+        self.assertEqual(comp.state['checkpoints'], {})
+
+
+class TestSlicedDownload(unittest.TestCase):
+    LIST_PAR = {'list_name': 'Orders', 'result_table_name': 'orders', 'parallel_slices': 3,
+                'filter': "fields/Status eq 'Active'"}
+    COLUMNS = [{'name': 'ID', 'displayName': 'ID'}, {'name': 'Title', 'displayName': 'Title'}]
+    SLICE_FILTERS = ["(fields/ID ge 1 and fields/ID lt 5) and (fields/Status eq 'Active')",
+                     "(fields/ID ge 5 and fields/ID lt 9) and (fields/Status eq 'Active')",
+                     "(fields/ID ge 9 and fields/ID lt 13) and (fields/Status eq 'Active')"]
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.comp = create_component()
+        self.comp.tables_out_path = self.out_dir.name
+        self.comp.create_manifests = mock.Mock()
+        self.comp.client.get_site_list_max_item_id.return_value = 10
+        # single page of each slice with the first item of its ID range
+        self.comp.client.get_site_list_fields.side_effect = \
+            lambda site_id, list_id, select, filter, page_size: iter([[{'id': re.search(r'ge (\d+)', filter).group(1),
+                                                                       'Title': 'a'}]])
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def download(self):
+        return self.comp._collect_and_write_list_sliced('site-1', 'list-1', self.COLUMNS, self.LIST_PAR,
+                                                        ['ID', 'Title'])
+
+    def test_id_ranges_are_downloaded_into_slices(self):
+        results = self.download()
+
+        filters = sorted(c[1]['filter'] for c in self.comp.client.get_site_list_fields.call_args_list)
+        self.assertEqual(filters, self.SLICE_FILTERS)
+        table_path = os.path.join(self.out_dir.name, 'orders_data.csv')
+        slices = {}
+        for name in sorted(os.listdir(table_path)):
+            with open(os.path.join(table_path, name)) as slice_file:
+                slices[name] = slice_file.read().split(',')[0]
+        self.assertEqual(slices, {'part_0000.csv': '1', 'part_0001.csv': '5', 'part_0002.csv': '9'})
+        self.assertEqual([r.full_path for r in results], [table_path])
+
+    def test_sliced_table_has_headless_manifest(self):
+        results = self.download()
+
+        self.comp._create_data_manifests(results, True)
+
+        self.assertEqual(self.comp.create_manifests.call_args_list,
+                         [mock.call(results=[], incremental=True),
+                          mock.call(results=results, headless=True, incremental=True)])
+
+    def test_empty_list_is_not_sliced(self):
+        self.comp.client.get_site_list_max_item_id.return_value = 0
+
+        self.assertEqual(self.download(), [])
+        self.comp.client.get_site_list_fields.assert_not_called()
+
+    def test_failed_slice_fails_download_and_all_writers_are_closed(self):
+        writers = []
+        create_writer = self.comp._create_data_writer
+
+        def create_tracked_writer(*args, **kwargs):
+            writers.append(mock.Mock(wraps=create_writer(*args, **kwargs)))
+            return writers[-1]
+
+        self.comp._create_data_writer = create_tracked_writer
+        self.comp.client.get_site_list_fields.side_effect = \
+            lambda site_id, list_id, select, filter, page_size: \
+            pages_failing_after([], api_error(InternalServerError)) if 'ge 5 ' in filter else iter([[{'id': '1'}]])
+
+        with self.assertRaises(InternalServerError):
+            self.download()
+        self.assertEqual(len(writers), 3)
+        for writer in writers:
+            writer.close.assert_called_once_with()
+
+
+class TestWatermarkDownload(unittest.TestCase):
+    WATERMARK_KEY = 'site-1/list-1'
+    ITEMS = [{'id': '1', 'Modified': '2024-01-05T10:00:00Z'},
+             {'id': '2', 'Modified': '2024-01-20T08:00:00Z'},
+             {'id': '3', 'Modified': '2024-01-12T00:00:00Z'}]
+
+    def setUp(self):
+        self.data_wr = FakeDataWriter()
+
+    def download(self, comp, item_filter=None, select=None):
+        lst_par = {'list_name': 'Orders', 'result_table_name': 'orders', 'filter': item_filter}
+        comp._collect_and_write_list_watermark('site-1', 'list-1', self.data_wr, lst_par, select)
+
+    def requested_filters(self, comp):
+        return [c[1]['filter'] for c in comp.client.get_site_list_fields.call_args_list]
+
+    def test_first_run_downloads_all_items_and_stores_watermark(self):
+        comp = create_component()
+        comp.client.get_site_list_fields.return_value = iter([self.ITEMS[:2], self.ITEMS[2:]])
+
+        self.download(comp, select=['Title'])
+
+        self.assertEqual(self.requested_filters(comp), [None])
+        self.assertEqual(comp.client.get_site_list_fields.call_args[1]['select'], ['Title', 'Modified'])
+        self.assertEqual(self.data_wr.rows, self.ITEMS)
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY],
+                         {'watermark': '2024-01-20T08:00:00Z', 'filter': None})
+
+    def test_items_modified_since_watermark_are_requested(self):
+        comp = create_component({'watermarks': {
+            self.WATERMARK_KEY: {'watermark': '2024-01-10T00:00:00Z', 'filter': "fields/Status eq 'Open'"}}})
+        comp.client.get_site_list_fields.return_value = iter([self.ITEMS[1:]])
+
+        self.download(comp, item_filter="fields/Status eq 'Open'")
+
+        self.assertEqual(self.requested_filters(comp),
+                         ["(fields/Status eq 'Open') and (fields/Modified ge '2024-01-10T00:00:00Z')"])
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY]['watermark'], '2024-01-20T08:00:00Z')
+
+    def test_watermark_is_kept_without_modified_items(self):
+        stored = {'watermark': '2024-01-10T00:00:00Z', 'filter': None}
+        comp = create_component({'watermarks': {self.WATERMARK_KEY: dict(stored)}})
+        comp.client.get_site_list_fields.return_value = iter([[]])
+
+        self.download(comp)
+
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY], stored)
+
+    def test_changed_filter_resets_watermark(self):
+        comp = create_component({'watermarks': {
+            self.WATERMARK_KEY: {'watermark': '2024-01-30T00:00:00Z', 'filter': "fields/Status eq 'Open'"}}})
+        comp.client.get_site_list_fields.return_value = iter([self.ITEMS])
+
+        self.download(comp, item_filter="fields/Status ne 'Closed'")
+
+        self.assertEqual(self.requested_filters(comp), ["fields/Status ne 'Closed'"])
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY],
+                         {'watermark': '2024-01-20T08:00:00Z', 'filter': "fields/Status ne 'Closed'"})
+
+    def test_rejected_filter_falls_back_to_client_side_filtering(self):
+        comp = create_component({'watermarks': {
+            self.WATERMARK_KEY: {'watermark': '2024-01-10T00:00:00Z', 'filter': None}}})
+        comp.client.get_site_list_fields.side_effect = [
+            pages_failing_after([], api_error(BadRequest, 'Field Modified cannot be referenced in filter')),
+            iter([self.ITEMS[:2], self.ITEMS[2:]])]
+
+        with self.assertLogs(level='WARNING') as logs:
+            self.download(comp)
+
+        self.assertEqual(self.requested_filters(comp), ["fields/Modified ge '2024-01-10T00:00:00Z'", None])
+        self.assertEqual([r['id'] for r in self.data_wr.rows], ['2', '3'])
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY]['watermark'], '2024-01-20T08:00:00Z')
+        self.assertIn('Index the column', logs.output[0])
+
+    def test_failure_after_written_pages_is_raised(self):
+        stored = {'watermark': '2024-01-10T00:00:00Z', 'filter': None}
+        comp = create_component({'watermarks': {self.WATERMARK_KEY: dict(stored)}})
+        comp.client.get_site_list_fields.return_value = pages_failing_after([self.ITEMS[1:2]],
+                                                                            api_error(BadRequest))
+
+        with self.assertRaises(BadRequest):
+            self.download(comp)
+
+        self.assertEqual(comp.client.get_site_list_fields.call_count, 1)
+        self.assertEqual(comp.state['watermarks'][self.WATERMARK_KEY], stored)
+
+
+@mock.patch('component.DeletedItemsResultWriter')
+class TestDeltaDownload(unittest.TestCase):
+    DELTA_KEY = 'site-1/list-1'
+    SELECT = ['ID', 'Title']
+
+    def setUp(self):
+        self.data_wr = FakeDataWriter()
+
+    def download(self, comp, select=SELECT):
+        comp.tables_out_path = 'tables'
+        lst_par = {'list_name': 'Orders', 'result_table_name': 'orders'}
+        return comp._collect_and_write_list_delta('site-1', {'id': 'list-1'}, self.data_wr, lst_par, select)
+
+    def requested_links(self, comp):
+        return [c[0][2] for c in comp.client.get_site_list_items_delta.call_args_list]
+
+    def deleted_ids(self, deleted_writer_class):
+        return [c[0][0]['id'] for c in deleted_writer_class.return_value.write.call_args_list]
+
+    def test_changes_and_deleted_items_are_written(self, deleted_writer_class):
+        comp = create_component({'delta_links': {self.DELTA_KEY: {'delta_link': 'delta-1', 'select': self.SELECT}}})
+        comp.client.get_site_list_items_delta.return_value = iter([([{'id': '3'}], ['4'], None),
+                                                                   ([{'id': '5'}], ['6'], 'delta-2')])
+
+        self.download(comp)
+
+        self.assertEqual(self.requested_links(comp), ['delta-1'])
+        self.assertEqual(self.data_wr.rows, [{'id': '3'}, {'id': '5'}])
+        self.assertEqual(self.deleted_ids(deleted_writer_class), ['4', '6'])
+        self.assertEqual(comp.state['delta_links'][self.DELTA_KEY], {'delta_link': 'delta-2', 'select': self.SELECT})
+
+    def test_expired_delta_link_runs_full_sync(self, deleted_writer_class):
+        comp = create_component({'delta_links': {self.DELTA_KEY: {'delta_link': 'delta-1', 'select': self.SELECT}}})
+        comp.client.get_site_list_items_delta.side_effect = [pages_failing_after([], api_error(Gone)),
+                                                             iter([([{'id': '1'}, {'id': '2'}], [], 'delta-2')])]
+
+        self.download(comp)
+
+        self.assertEqual(self.requested_links(comp), ['delta-1', None])
+        self.assertEqual(self.data_wr.rows, [{'id': '1'}, {'id': '2'}])
+        self.assertEqual(comp.state['delta_links'][self.DELTA_KEY]['delta_link'], 'delta-2')
+
+    def test_changed_columns_run_full_sync(self, deleted_writer_class):
+        comp = create_component({'delta_links': {self.DELTA_KEY: {'delta_link': 'delta-1', 'select': self.SELECT}}})
+        comp.client.get_site_list_items_delta.return_value = iter([([{'id': '1'}], [], 'delta-2')])
+
+        self.download(comp, select=self.SELECT + ['Amount'])
+
+        self.assertEqual(self.requested_links(comp), [None])
+        self.assertEqual(comp.client.get_site_list_items_delta.call_args[1]['select'], self.SELECT + ['Amount'])
+        self.assertEqual(comp.state['delta_links'][self.DELTA_KEY],
+                         {'delta_link': 'delta-2', 'select': self.SELECT + ['Amount']})
+
+
+class TestListDownloadRetry(unittest.TestCase):
+    SITE = {'id': 'site-1'}
+    LIST = {'id': 'list-1', 'displayName': 'Orders'}
+    COLUMNS = [{'name': 'ID', 'displayName': 'ID'}, {'name': 'Status', 'displayName': 'Status'}]
+    LIST_PAR = {'list_name': 'Orders', 'site_url_rel_path': '/sites/root', 'result_table_name': 'orders'}
+
+    def setUp(self):
+        self.comp = create_component(base_host_name='tenant.sharepoint.com')
+        self.comp._metadata_cache = MetadataCache()
+        self.comp._list_runs = []
+        self.cache_key = self.comp._get_cache_key(self.LIST_PAR)
+        self.comp._metadata_cache.put(self.cache_key, self.SITE, self.LIST, self.COLUMNS)
+        self.comp._metadata_cache.mark_served(self.cache_key)
+        self.comp.client.get_site_by_relative_url.return_value = self.SITE
+        self.comp.client.get_site_list_by_name.return_value = self.LIST
+
+    def download(self, *data_results):
+        with mock.patch.object(self.comp, '_download_list_data', side_effect=data_results) as download_data:
+            results = self.comp._download_list(self.LIST_PAR, (self.SITE, self.LIST, self.COLUMNS))
+        return results, download_data
+
+    def test_changed_columns_are_refreshed_and_download_retried(self):
+        self.comp.client.get_site_list_column_definitions.return_value = self.COLUMNS[:1]
+
+        results, download_data = self.download(api_error(BadRequest, 'Column Status does not exist'), ['result'])
+
+        self.assertEqual(results, (['result'], False))
+        self.assertEqual([c['name'] for c in download_data.call_args[0][2]], ['ID'])
+        self.assertEqual(self.comp._metadata_cache.get(self.cache_key)['columns'], self.COLUMNS[:1])
+
+    def test_cache_is_kept_when_columns_did_not_change(self):
+        self.comp.client.get_site_list_column_definitions.return_value = self.COLUMNS
+
+        with self.assertRaisesRegex(BadRequest, 'Invalid filter'):
+            self.download(api_error(BadRequest, 'Invalid filter clause'), ['result'])
+
+        self.assertTrue(self.comp._metadata_cache.was_served(self.cache_key))
+        self.comp.client.get_site_list_by_name.assert_not_called()
+
+    def test_writer_is_closed_when_download_fails(self):
+        data_wr = mock.Mock()
+        self.comp.client.get_site_list_fields.side_effect = api_error(BadRequest)
+
+        with mock.patch.object(self.comp, '_create_data_writer', return_value=data_wr):
+            with self.assertRaises(BadRequest):
+                self.comp._collect_and_write_list('site-1', self.LIST, self.COLUMNS, self.LIST_PAR)
+
+        data_wr.close.assert_called_once_with()
+
+
+class TestDownloadMode(unittest.TestCase):
+
+    def test_mode_of_highest_precedence_is_used_and_others_reported(self):
+        comp = create_component(stream_item_pages=True)
+        lst_par = {'list_name': 'Orders', 'load_mode_incremental': 1, 'parallel_slices': 4, 'resumable': True}
+
+        with self.assertLogs(level='WARNING') as logs:
+            mode = comp._get_download_mode(lst_par)
+
+        self.assertEqual(mode, 'parallel_slices')
+        self.assertIn('ignoring "Resume failed downloads", "Stream item pages"', logs.output[0])
+
+    def test_paged_download_without_options(self):
+        comp = create_component()
+
+        self.assertIsNone(comp._get_download_mode({'list_name': 'Orders', 'parallel_slices': 1}))
+
+
+class TestAsyncIgnoredOptions(unittest.TestCase):
+
+    def test_enabled_unsupported_options_are_listed(self):
+        ignored = Component._get_async_ignored_options(
+            {'use_delta_query': True, 'filter': "fields/Status eq 'Active'", 'parallel_slices': 4,
+             'download_files': False}, component.ASYNC_IGNORED_LIST_OPTIONS)
+
+        self.assertEqual(ignored, '"Download only changes (delta query)", "Filter", "Parallel slices"')
+
+    def test_single_slice_and_unset_options_are_not_listed(self):
+        self.assertEqual(Component._get_async_ignored_options({'parallel_slices': 1, 'page_size': 0},
+                                                              component.ASYNC_IGNORED_LIST_OPTIONS), '')
+        self.assertEqual(Component._get_async_ignored_options({'adaptive_page_size': True, 'page_size': 0},
+                                                              component.ASYNC_IGNORED_OPTIONS),
+                         '"Adaptive page size"')
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
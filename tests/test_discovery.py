@@ -0,0 +1,66 @@
+import unittest
+
+import discovery
+from ms_graph.exceptions import Forbidden
+
+HOST = 'tenant.sharepoint.com'
+
+
+class FakeClient:
+    SITES = [{'id': 'site-hr', 'webUrl': f'https://{HOST}/sites/HR'},
+             {'id': 'site-root', 'webUrl': f'https://{HOST}'},
+             {'id': 'site-locked', 'webUrl': f'https://{HOST}/sites/Locked'},
+             {'id': 'personal', 'webUrl': 'https://tenant-my.sharepoint.com/personal/user'}]
+    LISTS = {'site-hr': [{'id': '3', 'displayName': 'Orders', 'list': {'template': 'genericList'}},
+                         {'id': '4', 'displayName': 'Documents', 'list': {'template': 'documentLibrary'}},
+                         {'id': '5', 'displayName': 'Hidden', 'list': {'hidden': True}}],
+             'site-root': [{'id': '1', 'displayName': 'Orders 2020', 'list': {'template': 'genericList'}}],
+             'site-locked': Forbidden('Calling endpoint /sites/site-locked/lists failed',
+                                      {'error': {'code': 'accessDenied'}})}
+
+    def __init__(self):
+        self.listed_sites = None
+
+    def search_sites(self, query, page_size=None):
+        yield from self.SITES
+
+    def get_sites_lists_batch(self, site_ids, page_size=None):
+        self.listed_sites = site_ids
+        return {site_id: self.LISTS[site_id] for site_id in site_ids}
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def test_discovers_visible_lists_of_searched_sites(self):
+        client = FakeClient()
+
+        discovered = discovery.discover_lists(client, HOST)
+
+        self.assertEqual(sorted(client.listed_sites), ['site-hr', 'site-locked', 'site-root'])
+        self.assertEqual([(path, sh_list['displayName']) for _, path, sh_list in discovered],
+                         [('/sites/HR', 'Orders'), ('/sites/root', 'Orders 2020')])
+
+    def test_document_libraries_are_included_on_request(self):
+        discovered = discovery.discover_lists(FakeClient(), HOST, include_document_libraries=True)
+
+        self.assertEqual([sh_list['displayName'] for _, _, sh_list in discovered],
+                         ['Documents', 'Orders', 'Orders 2020'])
+
+    def test_list_names_are_matched_by_glob_or_regex(self):
+        glob_matcher = discovery.compile_name_matcher('Orders*')
+        regex_matcher = discovery.compile_name_matcher(r'Orders \d+', discovery.PATTERN_REGEX)
+
+        self.assertEqual([glob_matcher(n) for n in ('Orders', 'Orders 2020', 'orders')], [True, True, False])
+        self.assertEqual([regex_matcher(n) for n in ('Orders', 'Orders 2020', 'Old Orders 2020')],
+                         [False, True, False])
+
+    def test_table_names_are_unique(self):
+        used_names = {'HR_Orders'}
+
+        self.assertEqual(discovery.build_table_name('/sites/HR', 'Orders', used_names, 'a1-b2-c3-d4-e5'),
+                         'HR_Orders_a1b2c3d4')
+        self.assertEqual(discovery.build_table_name('/sites/root', 'Orders (2020)', used_names), 'root_Orders_2020')
+
+
+if __name__ == "__main__":
+    unittest.main()
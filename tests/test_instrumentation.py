@@ -0,0 +1,46 @@
+import unittest
+
+from ms_graph.instrumentation import RequestMetrics, get_endpoint_template
+
+BASE_URL = 'https://graph.microsoft.com/v1.0/'
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+
+    def test_endpoint_ids_are_replaced_by_placeholders(self):
+        self.assertEqual(get_endpoint_template('/v1.0/sites/host.com:/sites/HR'), '/v1.0/sites/{site}')
+        self.assertEqual(get_endpoint_template('/v1.0/sites/host.com,1,2/lists/abc/items/delta'),
+                         '/v1.0/sites/{site}/lists/{list}/items/delta')
+        self.assertEqual(get_endpoint_template('/v1.0/sites/s/lists/abc/items/15'),
+                         '/v1.0/sites/{site}/lists/{list}/items/{item}')
+
+    def test_requests_are_aggregated_per_endpoint(self):
+        self.metrics.record(BASE_URL + 'sites/s1/lists/l1/items?$skiptoken=1', 200, 0.04, 1000)
+        self.metrics.record(BASE_URL + 'sites/s1/lists/l2/items', 429, 0.3, 100)
+        self.metrics.record(BASE_URL + 'sites/s1/lists/l2/items', 200, 12, 2000, retries=2)
+        self.metrics.record(BASE_URL + '$batch', 400, 0.1, 50)
+
+        endpoints = self.metrics.endpoints
+
+        self.assertEqual(endpoints['/v1.0/sites/{site}/lists/{list}/items'],
+                         {'requests': 3, 'errors': 0, 'throttled': 1, 'retries': 2, 'bytes_received': 3100,
+                          'latency_ms': {'avg': 4113.3, 'max': 12000.0,
+                                         'histogram': {'<=50': 1, '<=500': 1, '>10000': 1}}})
+        self.assertEqual(endpoints['/v1.0/$batch']['errors'], 1)
+
+    def test_requests_are_aggregated_per_list(self):
+        self.metrics.record(BASE_URL + 'sites/s1/lists/l1/items', 200, 0.5, 1000)
+        self.metrics.record(BASE_URL + 'sites/s1/lists/l1/items', 200, 0.25, 500)
+        self.metrics.record(BASE_URL + 'sites/s1', 200, 0.1, 10)
+        self.metrics.record_token_refresh()
+
+        self.assertEqual(self.metrics.lists, {'l1': {'requests': 2, 'bytes_received': 1500, 'request_time_s': 0.75}})
+        self.assertEqual(self.metrics.totals, {'requests': 3, 'retries': 0, 'throttled': 0, 'bytes_received': 1510,
+                                               'token_refreshes': 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from metadata_cache import MetadataCache
+
+SITE = {'id': 'tenant.sharepoint.com,1,2', 'webUrl': 'https://tenant.sharepoint.com'}
+LIST = {'id': 'list-1', 'eTag': '"1"', 'lastModifiedDateTime': '2020-01-01T00:00:00Z'}
+COLUMNS = [{'name': 'ID', 'displayName': 'ID'}]
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = MetadataCache(ttl_seconds=3600, time_func=self.clock.time)
+        self.key = MetadataCache.build_key('tenant.sharepoint.com', '/sites/root/', 'Orders')
+
+    def test_entry_expires_after_ttl(self):
+        self.cache.put(self.key, SITE, LIST, COLUMNS)
+        entry = self.cache.get(self.key)
+
+        self.assertTrue(self.cache.is_fresh(entry))
+        self.clock.now += 3600
+        self.assertFalse(self.cache.is_fresh(entry))
+        self.assertEqual(entry['site'], {'id': SITE['id']})
+        self.assertEqual(entry['columns'], COLUMNS)
+
+    def test_version_is_validated_by_etag_and_last_modified(self):
+        self.cache.put(self.key, SITE, LIST, COLUMNS)
+        entry = self.cache.get(self.key)
+
+        self.assertTrue(MetadataCache.is_valid_version(entry, dict(LIST)))
+        self.assertFalse(MetadataCache.is_valid_version(entry, {**LIST, 'eTag': '"2"'}))
+        self.assertFalse(MetadataCache.is_valid_version(entry, {**LIST, 'lastModifiedDateTime': None}))
+
+    def test_entry_without_version_is_never_valid(self):
+        self.cache.put(self.key, SITE, {'id': 'list-1'}, COLUMNS)
+
+        self.assertFalse(MetadataCache.is_valid_version(self.cache.get(self.key), {'id': 'list-1'}))
+
+    def test_only_entries_used_in_run_are_kept(self):
+        stored = {self.key: {'site': SITE, 'list': LIST, 'columns': COLUMNS, 'cached_at': 0},
+                  'removed/list': {'site': SITE, 'list': LIST, 'columns': COLUMNS, 'cached_at': 0}}
+        cache = MetadataCache(stored, ttl_seconds=3600, time_func=self.clock.time)
+
+        cache.get(self.key)
+
+        self.assertEqual(list(cache.entries), [self.key])
+
+    def test_invalidated_entry_is_no_longer_served(self):
+        self.cache.put(self.key, SITE, LIST, COLUMNS)
+        self.cache.mark_served(self.key)
+        self.assertTrue(self.cache.was_served(self.key))
+
+        self.cache.invalidate(self.key)
+
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertFalse(self.cache.was_served(self.key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from ms_graph.page_size import PageSize
+
+
+class TestPageSize(unittest.TestCase):
+
+    def test_fixed_size_is_not_adjusted(self):
+        page_size = PageSize(1000)
+
+        page_size.on_page(latency=0.1)
+        page_size.on_page(latency=60, retries=3)
+
+        self.assertEqual(page_size.size, 1000)
+        self.assertFalse(page_size.on_error())
+
+    def test_adaptive_size_grows_on_fast_pages_up_to_max(self):
+        page_size = PageSize(500, adaptive=True, max_size=3000)
+
+        for _ in range(5):
+            page_size.on_page(latency=0.5, page_bytes=1000)
+
+        self.assertEqual(page_size.size, 3000)
+        self.assertEqual((page_size.smallest_used, page_size.largest_used), (500, 3000))
+
+    def test_adaptive_size_does_not_grow_on_large_pages(self):
+        page_size = PageSize(500, adaptive=True, max_page_bytes=1000)
+
+        page_size.on_page(latency=0.5, page_bytes=600)
+        page_size.on_page(latency=4, page_bytes=100)
+
+        self.assertEqual(page_size.size, 500)
+
+    def test_adaptive_size_shrinks_on_slow_pages_retries_and_errors(self):
+        page_size = PageSize(4000, adaptive=True, min_size=500)
+
+        page_size.on_page(latency=10)
+        page_size.on_page(latency=0.1, retries=1)
+
+        self.assertEqual(page_size.size, 1000)
+        self.assertTrue(page_size.on_error())
+        self.assertEqual(page_size.size, 500)
+        self.assertFalse(page_size.on_error())
+
+    def test_size_is_applied_to_parameters_and_next_links(self):
+        page_size = PageSize(250)
+        base = 'https://graph.microsoft.com/v1.0/sites/s/lists/l/items'
+
+        self.assertEqual(page_size.apply(base, {'expand': 'fields'}), (base, {'expand': 'fields', '$top': 250}))
+        self.assertEqual(page_size.apply(base + '?$top=100&$skiptoken=UGFnZWQ', {}),
+                         (base + '?$top=250&$skiptoken=UGFnZWQ', {}))
+        self.assertEqual(page_size.apply(base + '?%24skiptoken=UGFnZWQ&%24top=100', {}),
+                         (base + '?%24skiptoken=UGFnZWQ&%24top=250', {}))
+        self.assertEqual(page_size.apply(base + '?$skiptoken=UGFnZWQ', {}), (base + '?$skiptoken=UGFnZWQ&$top=250', {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from ms_graph.rate_limiter import AdaptiveRateLimiter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveRateLimiter(max_rate=10, min_rate=1, increase_step=1, decrease_factor=0.5,
+                                           time_func=self.clock.time, sleep_func=self.clock.sleep)
+
+    def test_requests_are_paced_to_max_rate(self):
+        for _ in range(11):
+            self.limiter.acquire()
+
+        self.assertAlmostEqual(self.clock.now, 1.0)
+
+    def test_throttling_halves_rate_and_honors_retry_after(self):
+        self.limiter.acquire()
+        self.limiter.on_response(429, {'Retry-After': '5'})
+
+        self.limiter.acquire()
+
+        self.assertEqual(self.limiter.rate, 5)
+        self.assertAlmostEqual(self.clock.now, 5.0)
+        self.assertEqual(self.limiter.metrics['throttle_events'], 1)
+        self.assertAlmostEqual(self.limiter.metrics['wait_time_s'], 5.0)
+
+    def test_reserve_returns_wait_without_sleeping(self):
+        waits = [self.limiter.reserve() for _ in range(3)]
+
+        self.assertEqual([round(w, 3) for w in waits], [0, 0.1, 0.2])
+        self.assertEqual(self.clock.now, 0)
+
+    def test_rate_recovers_additively(self):
+        self.limiter.on_response(429, {'Retry-After': '0'})
+        self.limiter.on_response(429, {'Retry-After': '0'})
+        self.limiter.on_response(200, {})
+
+        self.assertEqual(self.limiter.rate, 3.5)
+
+    def test_rate_does_not_grow_on_errors(self):
+        self.limiter.on_response(429, {'Retry-After': '0'})
+        self.limiter.on_response(500, {})
+        self.limiter.on_response(504, {})
+        self.limiter.on_response(404, {})
+
+        self.assertEqual(self.limiter.rate, 5)
+
+    def test_rate_limit_headers_cap_rate(self):
+        self.limiter.on_response(200, {'RateLimit-Remaining': '20', 'RateLimit-Reset': '10'})
+
+        self.assertEqual(self.limiter.rate, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
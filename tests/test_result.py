@@ -0,0 +1,251 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from result import CompressedListDataWriter, ExplodedListDataWriter, ListDataParquetWriter, ListDataResultWriter, \
+    ListResultWriter, MultiValueResultWriter, LIST_ID, RES_TABLE_NAME, SITE_ID
+
+COLUMNS = [{'name': 'ID', 'displayName': 'ID'},
+           {'name': 'Title', 'displayName': 'Title'},
+           {'name': 'Amount', 'displayName': 'Amount', 'currency': {'locale': 'en-us'}},
+           {'name': 'Done', 'displayName': 'Done', 'boolean': {}},
+           {'name': 'Due', 'displayName': 'Due date', 'dateTime': {'format': 'dateOnly'}},
+           {'name': 'OwnerLookupId', 'displayName': 'Owner', 'personOrGroup': {'allowMultipleSelection': False}},
+           {'name': 'Tags', 'displayName': 'Tags', 'choice': {}}]
+
+
+class TestListDataResultWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def test_multi_values_are_serialized_to_json(self):
+        writer = ListDataResultWriter(self.out_dir.name, COLUMNS, 'orders')
+        writer.write_rows([{'id': '1', 'Title': ['a'], 'Amount': 10, 'Done': False, 'Tags': ['x', 'y']}],
+                          user_values={LIST_ID: 'list-1'})
+        # streamed items
+        writer.write_rows(({'id': str(i), 'Tags': 'z'} for i in range(2, 4)), user_values={LIST_ID: 'list-1'})
+        writer.close()
+
+        with open(os.path.join(self.out_dir.name, 'orders_data.csv')) as out:
+            rows = list(csv.reader(out))
+
+        self.assertEqual(rows[0], ['ID', 'Title', 'Amount', 'Done', 'Due date', 'Owner', 'Tags', LIST_ID])
+        self.assertEqual(rows[1], ['1', '["a"]', '10', 'False', '', '', '["x", "y"]', 'list-1'])
+        self.assertEqual([r[0] for r in rows[2:]], ['2', '3'])
+
+    def test_column_types_are_set_in_metadata(self):
+        writer = ListDataResultWriter(self.out_dir.name, COLUMNS, 'orders')
+
+        base_types = {name: metadata[0]['value'] for name, metadata in writer.table_def.column_metadata.items()}
+
+        self.assertEqual(base_types, {'ID': 'INTEGER', 'Title': 'STRING', 'Amount': 'NUMERIC', 'Done': 'BOOLEAN',
+                                      'Due date': 'TIMESTAMP', 'Owner': 'INTEGER', 'Tags': 'STRING'})
+
+
+class TestCompressedListDataWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.table_path = os.path.join(self.out_dir.name, 'orders_data.csv')
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def read_slices(self):
+        slices = {}
+        for name in sorted(os.listdir(self.table_path)):
+            with gzip.open(os.path.join(self.table_path, name), 'rt', newline='') as slice_file:
+                slices[name] = list(csv.reader(slice_file))
+        return slices
+
+    def test_rows_are_written_into_compressed_slices_of_bounded_size(self):
+        writer = CompressedListDataWriter(self.out_dir.name, COLUMNS, 'orders', slice_size=50)
+        for start in range(0, 12, 4):
+            writer.write_rows([{'id': str(i), 'Title': 'item title'} for i in range(start, start + 4)],
+                              user_values={LIST_ID: 'list-1'})
+        writer.close()
+
+        slices = self.read_slices()
+
+        self.assertEqual(list(slices), ['part_0000.csv.gz', 'part_0001.csv.gz', 'part_0002.csv.gz'])
+        rows = [row for slice_rows in slices.values() for row in slice_rows]
+        self.assertEqual([row[0] for row in rows], [str(i) for i in range(12)])
+        self.assertEqual(rows[0], ['0', 'item title', '', '', '', '', '', 'list-1'])
+        self.assertEqual([r.full_path for r in writer.collect_results()], [self.table_path])
+
+    def test_empty_slice_is_written_without_rows(self):
+        writer = CompressedListDataWriter(self.out_dir.name, COLUMNS, 'orders', slice_size=50,
+                                          slice_name='part_0003')
+        writer.write_rows([], user_values={LIST_ID: 'list-1'})
+        writer.close()
+
+        self.assertEqual(self.read_slices(), {'part_0003_0000.csv.gz': []})
+
+    def test_pending_pages_are_bounded_and_errors_raised(self):
+        writer = CompressedListDataWriter(self.out_dir.name, COLUMNS, 'orders', slice_size=50)
+        writer.MAX_PENDING_PAGES = 1
+        with mock.patch.object(writer, '_open_slice', side_effect=OSError('No space left on device')):
+            writer.write_rows([{'id': '1'}])
+            writer._compression.join(timeout=5)
+            with self.assertRaisesRegex(OSError, 'No space left'):
+                for i in range(10):
+                    writer.write_rows([{'id': str(i)}])
+            with self.assertRaisesRegex(OSError, 'No space left'):
+                writer.close()
+
+        self.assertEqual(writer._pages.maxsize, 1)
+
+
+class TestListResultWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.out_path = os.path.join(self.out_dir.name, 'lists_metadata.csv')
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def test_rows_are_written_in_batches(self):
+        writer = ListResultWriter(self.out_dir.name)
+        writer.BATCH_SIZE = 2
+        for i in range(3):
+            writer.write({'id': str(i), 'name': f'List{i}', 'createdBy': {'user': {'displayName': 'Jane'}}},
+                         user_values={SITE_ID: 'site-1', RES_TABLE_NAME: f'list_{i}'})
+        writer._out_file.flush()
+
+        with open(self.out_path) as out:
+            self.assertEqual(len(list(csv.reader(out))), 3)
+
+        writer.close()
+        with open(self.out_path) as out:
+            rows = list(csv.DictReader(out))
+
+        self.assertEqual([r['res_table_name'] for r in rows], ['list_0', 'list_1', 'list_2'])
+        self.assertEqual((rows[0]['name'], rows[0]['createdBy_user'], rows[0]['lastModifiedBy_user']),
+                         ('List0', 'Jane', ''))
+        self.assertEqual([r.table_def.name for r in writer.collect_results()], ['lists_metadata'])
+
+    def test_no_file_without_lists(self):
+        writer = ListResultWriter(self.out_dir.name)
+        writer.close()
+
+        self.assertEqual(writer.collect_results(), [])
+        self.assertFalse(os.path.exists(self.out_path))
+
+
+class TestExplodedListDataWriter(unittest.TestCase):
+    PEOPLE = {'name': 'Reviewers', 'displayName': 'Reviewers', 'personOrGroup': {'allowMultipleSelection': True}}
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def read_csv(self, file_name):
+        with open(os.path.join(self.out_dir.name, file_name)) as out:
+            return list(csv.reader(out))
+
+    def test_multi_values_are_written_into_child_tables(self):
+        writer = ExplodedListDataWriter(ListDataResultWriter(self.out_dir.name, COLUMNS[:2], 'orders'),
+                                        [MultiValueResultWriter(self.out_dir.name, self.PEOPLE, 'orders'),
+                                         MultiValueResultWriter(self.out_dir.name, COLUMNS[-1], 'orders')])
+        items = [{'id': '1', 'Title': 'a', 'Tags': ['x', 'y'],
+                  'Reviewers': [{'LookupId': 7, 'LookupValue': 'John'}, {'LookupId': 9, 'LookupValue': 'Jane'}]},
+                 {'id': '2', 'Title': 'b', 'Tags': []}]
+        writer.write_rows(iter(items), user_values={LIST_ID: 'list-1'})
+        writer.close()
+
+        self.assertEqual(sorted(r.file_name for r in writer.collect_results()),
+                         ['orders_data.csv', 'orders_data__Reviewers.csv', 'orders_data__Tags.csv'])
+        self.assertEqual(self.read_csv('orders_data.csv'), [['ID', 'Title', LIST_ID],
+                                                            ['1', 'a', 'list-1'], ['2', 'b', 'list-1']])
+        self.assertEqual(self.read_csv('orders_data__Reviewers.csv'),
+                         [MultiValueResultWriter.COLS, ['1', 'list-1', '0', 'John', '7'],
+                          ['1', 'list-1', '1', 'Jane', '9']])
+        self.assertEqual(self.read_csv('orders_data__Tags.csv'),
+                         [MultiValueResultWriter.COLS, ['1', 'list-1', '0', 'x', ''], ['1', 'list-1', '1', 'y', '']])
+
+    def test_no_child_table_without_values(self):
+        writer = MultiValueResultWriter(self.out_dir.name, self.PEOPLE, 'orders')
+        writer.write_rows([{'id': '1'}], user_values={LIST_ID: 'list-1'})
+        writer.close()
+
+        self.assertEqual(writer.collect_results(), [])
+
+
+class TestListDataParquetWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def write(self, pages, row_group_size=None):
+        writer = ListDataParquetWriter(self.out_dir.name, COLUMNS, 'orders')
+        if row_group_size:
+            writer.ROW_GROUP_SIZE = row_group_size
+        for page in pages:
+            writer.write_rows(page, user_values={LIST_ID: 'list-1'})
+        writer.close()
+        return writer.full_path
+
+    def test_columns_are_typed_by_column_definitions(self):
+        path = self.write([[{'id': '1', 'Title': 'a', 'Amount': 10, 'Done': True, 'Due': '2020-01-31T00:00:00Z',
+                             'OwnerLookupId': '7', 'Tags': ['x', 'y']},
+                            {'id': '2', 'Amount': 2.5}]])
+
+        table = pq.read_table(path)
+
+        self.assertEqual(table.schema.names, ['ID', 'Title', 'Amount', 'Done', 'Due date', 'Owner', 'Tags', LIST_ID])
+        self.assertEqual(table.schema.field('ID').type, pa.int64())
+        self.assertEqual(table.schema.field('Amount').type, pa.float64())
+        self.assertEqual(table.schema.field('Done').type, pa.bool_())
+        self.assertTrue(pa.types.is_timestamp(table.schema.field('Due date').type))
+        rows = table.to_pylist()
+        self.assertEqual(rows[0]['Tags'], '["x", "y"]')
+        self.assertEqual(rows[0]['Due date'].isoformat(), '2020-01-31T00:00:00+00:00')
+        self.assertEqual((rows[1]['ID'], rows[1]['Title'], rows[1]['Amount'], rows[1]['Owner']), (2, None, 2.5, None))
+        self.assertEqual({r[LIST_ID] for r in rows}, {'list-1'})
+
+    def test_rows_are_written_in_row_groups(self):
+        path = self.write([[{'id': str(i)} for i in range(start, start + 3)] for start in range(0, 9, 3)],
+                          row_group_size=4)
+
+        parquet_file = pq.ParquetFile(path)
+
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.read().column('ID').to_pylist(), list(range(9)))
+
+    def test_invalid_values_are_stored_as_nulls(self):
+        path = self.write([[{'id': '1', 'Amount': 'n/a'}, {'id': '2', 'Amount': '3.5'}]])
+
+        self.assertEqual(pq.read_table(path).column('Amount').to_pylist(), [None, 3.5])
+
+    def test_file_manifest_is_written(self):
+        path = self.write([[{'id': '1'}]])
+
+        with open(path + '.manifest') as manifest:
+            self.assertEqual(json.load(manifest)['tags'], ['orders_data'])
+        self.assertEqual(os.path.basename(path), 'orders_data.parquet')
+
+    def test_no_file_without_rows(self):
+        ListDataParquetWriter(self.out_dir.name, COLUMNS, 'orders').close()
+
+        self.assertEqual(os.listdir(self.out_dir.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()